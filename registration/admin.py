@@ -1,17 +1,31 @@
 # +-+ coding: utf-8 +-+
 
-from django.contrib import admin
+from collections import Counter
+
+from django import forms
+from django.contrib import admin, messages
 
 from registration.models import Booking, Transaction, Event, WebPage, Day, Document, Attachment, Rate, Discipline, Price, \
-    Product, ProductVariant
+    Product, ProductVariant, AGE_BANDS, FULL_AGE
+from registration import search
 
-from django.db.models import Sum, Count, F, When, Case, IntegerField
-from django.db.models.functions import Coalesce
+from django.db.models import Count
 from django.utils.html import format_html
 from django.utils import timezone
 from import_export import resources
 from import_export.admin import ExportMixin
 from import_export.fields import Field
+from import_export.formats import base_formats
+from import_export.forms import ExportForm
+from import_export.signals import post_export
+from django.core.exceptions import PermissionDenied
+from django.http import StreamingHttpResponse, FileResponse, Http404, HttpResponseRedirect
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from registration.export import stream_csv, write_xlsx
+from registration.attachments import missing_documents
+from registration.statistics import get_event_statistics
+from registration.quotas import CANCELED, SoldOut, places, sold_out
 from django.template import defaultfilters
 from django.utils.translation import gettext_lazy as _
 
@@ -32,6 +46,7 @@ class DisciplineInline(admin.TabularInline):
 
 class RateInline(admin.TabularInline):
     model = Rate
+    readonly_fields = ("booked",)
 
 
 class DocumentInline(admin.TabularInline):
@@ -47,54 +62,145 @@ class PreisInline(admin.TabularInline):
 
 
 def checkin(modeladmin, request, queryset):
-    for b in queryset:
-        b.checkin = timezone.now()
-        b.save()
+    count = queryset.filter(checkin_date__isnull=True).exclude(state="canceled").update(checkin_date=timezone.now())
+    modeladmin.message_user(request, _("%d bookings checked in.") % count)
 
 
 checkin.short_description = "Einchecken" 
 
 
-class BookingResource(resources.ModelResource):
-    class Meta:
-        model = Booking
-    
-    def dehydrate_paket(self, booking):
-        return str(booking.paket)
+class RateAdmin(admin.ModelAdmin):
+    list_display = ["label", "event", "dob_from", "dob_to", "non_rider", "capacity", "booked"]
 
-    def dehydrate_anreise(self, booking):
-        return str(booking.anreise)
+    inlines = [PreisInline]
 
-    def dehydrate_abreise(self, booking):
-        return str(booking.abreise)
+    def save_model(self, request, obj, form, change):
+        super(RateAdmin, self).save_model(request, obj, form, change)
+        self.report_repricing(request, [obj])
+
+    def save_formset(self, request, form, formset, change):
+        super(RateAdmin, self).save_formset(request, form, formset, change)
+        edited = formset.new_objects + [obj for obj, fields in formset.changed_objects] + formset.deleted_objects
+        self.report_repricing(request, edited)
+
+    def report_repricing(self, request, objects):
+        results = [obj._reprice_result for obj in objects if hasattr(obj, "_reprice_result")]
+        if results:
+            self.message_user(request, _("%(changed)d of %(checked)d affected bookings were repriced.") % {
+                "changed": sum(result.changed for result in results),
+                "checked": sum(result.checked for result in results),
+            })
+
+
+class PaymentFilter(admin.SimpleListFilter):
+    title = _("payment")
+    parameter_name = "payment"
+
+    def lookups(self, request, model_admin):
+        return (
+            ("open", _("open")),
+            ("settled", _("settled")),
+            ("overpaid", _("overpaid")),
+        )
+
+    def queryset(self, request, queryset):
+        if self.value() == "open":
+            return queryset.filter(open_amount__gt=0)
+        if self.value() == "settled":
+            return queryset.filter(open_amount=0)
+        if self.value() == "overpaid":
+            return queryset.filter(open_amount__lt=0)
+        return queryset
+
+
+class AgeFilter(admin.SimpleListFilter):
+    """Age at the beginning of the event, with the number of bookings per band"""
+    title = _("age")
+    parameter_name = "age"
+
+    def lookups(self, request, model_admin):
+        counts = dict(
+            model_admin.get_queryset(request).order_by().values_list("age_band").annotate(count=Count("pk"))
+        )
+        minors = sum(counts.get(label, 0) for label, minimum in AGE_BANDS if minimum < FULL_AGE)
+        adults = sum(counts.get(label, 0) for label, minimum in AGE_BANDS if minimum >= FULL_AGE)
+        return [
+            ("minor", "%s (%d)" % (_("under 18"), minors)),
+            ("adult", "%s (%d)" % (_("18 and older"), adults)),
+        ] + [(label, "%s (%d)" % (label, counts.get(label, 0))) for label, minimum in AGE_BANDS]
+
+    def queryset(self, request, queryset):
+        if self.value() in ("minor", "adult"):
+            return queryset.filter(is_minor=self.value() == "minor")
+        if self.value():
+            return queryset.filter(age_band=self.value())
+        return queryset
+
+
+class StreamingExportMixin(ExportMixin):
+    """Streams CSV and XLSX exports instead of building a tablib dataset in memory"""
+    formats = [base_formats.CSV, base_formats.XLSX]
+
+    def export_action(self, request, *args, **kwargs):
+        if not self.has_export_permission(request):
+            raise PermissionDenied
+
+        formats = self.get_export_formats()
+        form = ExportForm(formats, request.POST or None)
+        if not form.is_valid():
+            return super(StreamingExportMixin, self).export_action(request, *args, **kwargs)
+
+        file_format = formats[int(form.cleaned_data["file_format"])]()
+        queryset = self.get_export_queryset(request)
+        filename = self.get_export_filename(request, queryset, file_format)
+
+        if isinstance(file_format, base_formats.XLSX):
+            response = FileResponse(write_xlsx(queryset), as_attachment=True, filename=filename,
+                                    content_type=file_format.get_content_type())
+        else:
+            response = StreamingHttpResponse(stream_csv(queryset), content_type=file_format.get_content_type())
+            response["Content-Disposition"] = 'attachment; filename="%s"' % filename
 
-    def dehydrate_rate(self, booking):
-        return str(booking.rate)
+        post_export.send(sender=None, model=self.model)
+        return response
 
-    def dehydrate_food(self, booking):
-        return booking.get_food_display()
 
-    def dehydrate_disciplines(self, booking):
-        return ", ".join(map(lambda x: x.code, booking.disciplines.all()))
+class BookingForm(forms.ModelForm):
+    """Reports a sold-out rate or variant as a form error instead of failing on save."""
 
+    def clean(self):
+        cleaned_data = super(BookingForm, self).clean()
+        if not any(field in self.fields for field in ("rate", "variants", "state")):
+            return cleaned_data
 
-class RateAdmin(admin.ModelAdmin):
-    list_display = ["label", "event", "dob_from", "dob_to", "non_rider"]
+        # the instance still holds the saved values, the form's are copied to it after clean
+        booking = self.instance
+        variant_ids = set(booking.variants.values_list("pk", flat=True)) if booking.pk else set()
+        old = places(booking.rate_id, variant_ids) if booking.pk and booking.state != CANCELED else Counter()
 
-    inlines = [PreisInline]
+        rate = cleaned_data.get("rate") if "rate" in self.fields else booking.rate
+        if "variants" in self.fields:
+            variant_ids = {variant.pk for variant in cleaned_data.get("variants") or ()}
+        state = cleaned_data.get("state", booking.state) if "state" in self.fields else booking.state
+        new = places(rate.pk if rate else None, variant_ids) if state != CANCELED else Counter()
+
+        for obj in sold_out(new - old):
+            field = "rate" if isinstance(obj, Rate) else "variants"
+            self.add_error(field if field in self.fields else None, SoldOut(obj))
+        return cleaned_data
 
 
-class BookingAdmin(ExportMixin, admin.ModelAdmin):
+class BookingAdmin(StreamingExportMixin, admin.ModelAdmin):
+    form = BookingForm
     list_display = ("event", "date_short", "code", "last_name", "first_name", 
                     "date_of_birth", "age", "club", "food", "show_paid", "show_open", "colored_state",
                     "checkin_date")
 
-    list_filter = ("event", "checkin_date", "state", "food", "club")
+    list_filter = ("event", "checkin_date", "state", PaymentFilter, AgeFilter, "food", "club")
     search_fields = ("first_name", "last_name", "club", "code")
     list_display_links = ["code"]
     actions = [checkin]
     csv_fields = ("last_name", "first_name", "club", "code")
-    resource_class = BookingResource
 
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
 
@@ -107,10 +213,11 @@ class BookingAdmin(ExportMixin, admin.ModelAdmin):
         return super(BookingAdmin, self).formfield_for_foreignkey(db_field, request, **kwargs)
 
     def age(self, obj):
-        color = "green" if obj.full_age() else "red"
-        return format_html("<span style='color: {}'>{}</span>", color, obj.age().years)
+        # annotated by get_queryset, see BookingQuerySet.with_age
+        color = "red" if obj.is_minor else "green"
+        return format_html("<span style='color: {}'>{}</span>", color, obj.age_at_start)
 
-    age.admin_order_field = "date_of_birth"
+    age.admin_order_field = "age_at_start"
     age.short_description = _("age")
 
     def date_short(self, obj):
@@ -120,7 +227,7 @@ class BookingAdmin(ExportMixin, admin.ModelAdmin):
 
     fieldsets = (
         (None, {
-            "fields": ["date", "code", "amount", "event"],
+            "fields": ["date", "code", ("amount", "paid", "fees", "open_amount"), "event"],
         }),
         (_("Personal data"), {
             "fields": [("first_name", "last_name", "sex"), ("email", "club"), "date_of_birth"],
@@ -129,21 +236,33 @@ class BookingAdmin(ExportMixin, admin.ModelAdmin):
             "fields": ["address", ("zipcode", "city"), "country", "phone"]
         }),
         (_("Participation details"), {
-            "fields": [("arrival", "departure", "rate"), ("disciplines", )],
+            "fields": [("arrival", "departure", "rate"), ("disciplines", ), ("variants", )],
         }),
         (_("Workflow"), {
             "fields": [("notes", "internal_notes"), "state"]
         }),
     )
 
-    readonly_fields = ["amount", "date"]
+    readonly_fields = ["amount", "paid", "fees", "open_amount", "date"]
 
     def get_queryset(self, request):
-        qs = Booking.objects.prefetch_related("transaction_set").annotate(paid=Sum('transaction__betrag'), open_amount=F("amount")-Sum("transaction__betrag"))
+        qs = super(BookingAdmin, self).get_queryset(request).with_age()
         if not request.user.is_superuser:
             return qs.filter(event__admin=request.user)
         return qs
 
+    def changeform_view(self, request, *args, **kwargs):
+        try:
+            return super(BookingAdmin, self).changeform_view(request, *args, **kwargs)
+        except SoldOut as e:
+            # the last place was taken after the form was validated, nothing was saved
+            self.message_user(request, e.messages[0], messages.ERROR)
+            return HttpResponseRedirect(request.get_full_path())
+
+    def get_search_results(self, request, queryset, search_term):
+        # search_fields only make the admin show the search box, see registration.search
+        return search.filter_bookings(queryset, search_term), False
+
     def colored_state(self, inst):
         color = "orange"
         if inst.state == "confirmed":
@@ -156,18 +275,15 @@ class BookingAdmin(ExportMixin, admin.ModelAdmin):
     colored_state.admin_order_field = "status"
 
     def show_paid(self, inst):
-        return inst.paid or 0.0
+        return inst.paid
 
     show_paid.admin_order_field = 'paid'
     show_paid.short_description = _("paid")
 
     def show_open(self, inst):
-        if inst.open_amount is None:
-            return inst.amount
-        else:
-            return inst.open_amount
+        return inst.open_amount
 
-    show_open.admin_order_field = 'offen'
+    show_open.admin_order_field = 'open_amount'
     show_open.short_description = _("open")
 
     inlines = [ AttachmentInline, TransactionInline ]
@@ -195,7 +311,7 @@ class TransactionAdmin(ExportMixin, admin.ModelAdmin):
 
 
 class EventAdmin(admin.ModelAdmin):
-    list_display = ("name", "host","begin_date", "end_date")
+    list_display = ("name", "host","begin_date", "end_date", "statistics_link", "missing_documents_link")
     prepopulated_fields = {"slug": ("name",)}
 
     fieldsets = (
@@ -240,6 +356,75 @@ class EventAdmin(admin.ModelAdmin):
             return qs
         return qs.filter(admin=request.user)
 
+    def get_urls(self):
+        urls = [
+            path("<path:object_id>/statistics/", self.admin_site.admin_view(self.statistics_view),
+                 name="registration_event_statistics"),
+            path("<path:object_id>/missing-documents/", self.admin_site.admin_view(self.missing_documents_view),
+                 name="registration_event_missing_documents"),
+        ]
+        return urls + super(EventAdmin, self).get_urls()
+
+    def statistics_link(self, obj):
+        return format_html("<a href='{}'>{}</a>", reverse("admin:registration_event_statistics", args=[obj.pk]),
+                           _("Statistics"))
+
+    statistics_link.short_description = _("Statistics")
+
+    def statistics_view(self, request, object_id):
+        event = self.get_object(request, object_id)
+        if event is None:
+            raise Http404
+
+        statistics = get_event_statistics(event)
+        context = dict(
+            self.admin_site.each_context(request),
+            title=_("Statistics of %s") % event,
+            opts=self.model._meta,
+            original=event,
+            statistics=statistics,
+            breakdowns=[
+                (_("state"), statistics["state"]),
+                (_("food"), statistics["food"]),
+                (_("rate"), statistics["rate"]),
+                (_("country"), statistics["country"]),
+                (_("club"), statistics["club"]),
+                (_("age"), statistics["age_band"]),
+                (_("registrations per day"), statistics["day"]),
+            ],
+        )
+        return TemplateResponse(request, "admin/registration/event/statistics.html", context)
+
+    def missing_documents_link(self, obj):
+        return format_html("<a href='{}'>{}</a>",
+                           reverse("admin:registration_event_missing_documents", args=[obj.pk]),
+                           _("Missing documents"))
+
+    missing_documents_link.short_description = _("Missing documents")
+
+    def missing_documents_view(self, request, object_id):
+        event = self.get_object(request, object_id)
+        if event is None:
+            raise Http404
+
+        # only what the table shows, it has thousands of rows for large events
+        bookings = Booking.objects.only("code", "first_name", "last_name", "club")
+        # at the check-in desk only those still to come are of interest
+        waiting = request.GET.get("checked_in") == "0"
+        if waiting:
+            bookings = bookings.filter(checkin_date__isnull=True)
+        report = missing_documents(event, bookings)
+        context = dict(
+            self.admin_site.each_context(request),
+            title=_("Missing documents of %s") % event,
+            opts=self.model._meta,
+            original=event,
+            report=report,
+            waiting=waiting,
+            totals=Counter(document for booking, documents in report for document in documents).most_common(),
+        )
+        return TemplateResponse(request, "admin/registration/event/missing_documents.html", context)
+
 
 class WebPageAdmin(admin.ModelAdmin):
     list_display = ("event", "slug", "name", "icon", "order")
@@ -252,6 +437,7 @@ class WebPageAdmin(admin.ModelAdmin):
 
 class ProductVariantInline(admin.TabularInline):
     model = ProductVariant
+    readonly_fields = ("booked",)
 
 class ProductAdmin(admin.ModelAdmin):
     list_display = ("kind", "name", "order", "event")
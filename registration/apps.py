@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class RegistrationConfig(AppConfig):
     name = 'registration'
+
+    def ready(self):
+        # connect the signal handlers
+        from registration import signals
@@ -0,0 +1,58 @@
+"""Documents that bookings still have to upload, for a whole event at once.
+
+A document flagged ``upload`` is required from every booking that isn't
+canceled; if it's also flagged ``u18``, only from bookings under 18 at the
+beginning of the event (``BookingQuerySet.with_age``). The report takes two
+queries however many bookings there are: one for the required documents, one
+for the bookings missing at least one of them. The latter checks every
+document with an ``EXISTS`` on the unique (booking, document) index, so
+bookings that are complete are never loaded.
+"""
+from django.db.models import Exists, OuterRef, Q
+
+from registration.models import Attachment, Booking, Document
+
+CANCELED = "canceled"
+
+
+def uploaded_field(document):
+    return "uploaded_%d" % document.pk
+
+
+def required_documents(event):
+    return list(Document.objects.filter(event=event, upload=True))
+
+
+def missing_documents(event, bookings=None):
+    """The bookings of ``event`` with required documents not uploaded yet.
+
+    Returns ``(booking, documents)`` pairs ordered by name; ``bookings`` can
+    restrict the report, e.g. to those not checked in. The bookings are
+    annotated with their age.
+    """
+    documents = required_documents(event)
+    if not documents:
+        return []
+
+    if bookings is None:
+        bookings = Booking.objects.all()
+    bookings = bookings.filter(event=event).exclude(state=CANCELED).with_age()
+
+    missing = Q()
+    for document in documents:
+        field = uploaded_field(document)
+        bookings = bookings.annotate(**{
+            field: Exists(Attachment.objects.filter(booking=OuterRef("pk"), document=document)),
+        })
+        condition = Q(**{field: False})
+        if document.u18:
+            condition &= Q(is_minor=True)
+        missing |= condition
+
+    report = []
+    for booking in bookings.filter(missing).order_by("last_name", "first_name", "id"):
+        report.append((booking, [
+            document for document in documents
+            if not getattr(booking, uploaded_field(document)) and (booking.is_minor or not document.u18)
+        ]))
+    return report
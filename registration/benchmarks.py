@@ -0,0 +1,200 @@
+"""Latency and query count benchmarks of the hot paths, see ``run_benchmarks``.
+
+Each benchmark is run a few times after a warm-up; the median and the 95th
+percentile of the wall time and the number of SQL queries of the last run are
+reported. Queries are counted on every database, reads may go to a replica
+(see ``registration.routing``). Responses cached by ``registration.graphql_cache`` are cleared
+before every run, so GraphQL numbers are those of a cache miss.
+
+Results are plain JSON, ``compare`` reports the benchmarks that got slower
+or run more queries than in an earlier result file.
+"""
+import json
+import platform
+import statistics
+import subprocess
+import time
+from collections import OrderedDict
+from contextlib import ExitStack
+
+import django
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connections
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from registration.export import stream_csv, write_xlsx
+from registration.models import Booking, Event, Transaction
+from registration.pagination import to_cursor
+
+ALL_EVENTS = """
+query AllEvents {
+  allEvents { edges { node { id name beginDate isOpen
+    rates { edges { node { label prices { edges { node { validFrom validUntil price priceDay } } } } } }
+    products { edges { node { name variants { edges { node { name price } } } } } }
+  } } }
+}
+"""
+
+EVENT = """
+query Event($id: Int) {
+  event(id: $id) { name
+    arrival { day } departure { day }
+    rates { edges { node { label disciplines { edges { node { code label } } }
+                                prices { edges { node { price priceDay } } } } } }
+    products { edges { node { name variants { edges { node { name price } } } } } }
+    disciplines { edges { node { code label } } }
+    documents { edges { node { name } } }
+  }
+}
+"""
+
+BOOKINGS_PAGE = """
+query Bookings($event: Int, $after: String) {
+  allBookings(event: $event, first: 100, after: $after) {
+    edges { node { code firstName lastName club } }
+    pageInfo { hasNextPage endCursor }
+  }
+}
+"""
+
+
+class Benchmark(object):
+    def __init__(self, name, run, setup=None):
+        self.name = name
+        self.run = run
+        self.setup = setup
+
+    def measure(self, repeat, warmup=1):
+        timings, queries = [], 0
+        for i in range(warmup + repeat):
+            if self.setup:
+                self.setup()
+            with ExitStack() as stack:
+                contexts = [stack.enter_context(CaptureQueriesContext(connections[alias])) for alias in connections]
+                started = time.perf_counter()
+                self.run()
+                elapsed = (time.perf_counter() - started) * 1000
+            if i >= warmup:
+                timings.append(elapsed)
+                queries = sum(len(context.captured_queries) for context in contexts)
+        timings.sort()
+        return OrderedDict([
+            ("median_ms", round(statistics.median(timings), 3)),
+            ("p95_ms", round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3)),
+            ("min_ms", round(timings[0], 3)),
+            ("queries", queries),
+            ("runs", repeat),
+        ])
+
+
+def graphql(client, query, variables=None):
+    def run():
+        response = client.post("/graphql", json.dumps({"query": query, "variables": variables or {}}),
+                               content_type="application/json")
+        data = response.json()
+        if response.status_code != 200 or data.get("errors"):
+            raise RuntimeError("%s: %s" % (response.status_code, data))
+    return run
+
+
+def get(client, url):
+    def run():
+        response = client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError("%s: %s" % (url, response.status_code))
+        if response.streaming:
+            b"".join(response.streaming_content)
+    return run
+
+
+def consume(iterable):
+    def run():
+        for item in iterable():
+            pass
+    return run
+
+
+def benchmarks(event, user):
+    client = Client()
+    client.force_login(user)
+    bookings = Booking.objects.filter(event=event)
+    middle = bookings.order_by("date", "id")[bookings.count() // 2]
+    changelist = "/admin/registration/booking/?event__id__exact=%d" % event.pk
+
+    def export_xlsx():
+        write_xlsx(bookings).close()
+
+    return [
+        Benchmark("graphql.allEvents", graphql(client, ALL_EVENTS), setup=cache.clear),
+        Benchmark("graphql.event", graphql(client, EVENT, {"id": event.pk}), setup=cache.clear),
+        Benchmark("graphql.allBookings.first", graphql(client, BOOKINGS_PAGE, {"event": event.pk})),
+        Benchmark("graphql.allBookings.middle",
+                  graphql(client, BOOKINGS_PAGE, {"event": event.pk, "after": to_cursor(middle)})),
+        Benchmark("admin.booking.changelist", get(client, changelist)),
+        Benchmark("admin.booking.changelist.open", get(client, changelist + "&payment=open&o=-11")),
+        Benchmark("admin.booking.search", get(client, changelist + "&q=" + middle.last_name[:4])),
+        Benchmark("export.csv", consume(lambda: stream_csv(bookings))),
+        Benchmark("export.xlsx", export_xlsx),
+    ]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(event, user, repeat=5, only=None):
+    results = OrderedDict()
+    # the test client's host name; without debug mode like in production
+    with override_settings(ALLOWED_HOSTS=["testserver"], DEBUG=False):
+        for benchmark in benchmarks(event, user):
+            if only and not any(name in benchmark.name for name in only):
+                continue
+            results[benchmark.name] = benchmark.measure(repeat)
+    return OrderedDict([
+        ("revision", git_revision()),
+        ("created", time.strftime("%Y-%m-%dT%H:%M:%S%z")),
+        ("environment", OrderedDict([
+            ("python", platform.python_version()),
+            ("django", django.get_version()),
+            ("database", connections["default"].vendor),
+        ])),
+        ("data", OrderedDict([
+            ("event", event.slug),
+            ("bookings", Booking.objects.filter(event=event).count()),
+            ("all_bookings", Booking.objects.count()),
+            ("transactions", Transaction.objects.count()),
+            ("events", Event.objects.count()),
+        ])),
+        ("results", results),
+    ])
+
+
+def compare(baseline, current, threshold=1.2):
+    """Lines describing the changes from ``baseline`` to ``current``, and whether any is a regression."""
+    lines, regressed = [], False
+    for name, result in current["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            lines.append("%-34s %9.1fms %5d queries (new)" % (name, result["median_ms"], result["queries"]))
+            continue
+        ratio = result["median_ms"] / before["median_ms"] if before["median_ms"] else 1
+        slower = ratio > threshold or result["queries"] > before["queries"]
+        regressed = regressed or slower
+        lines.append("%-34s %9.1fms -> %9.1fms (%+5.0f%%) %5d -> %5d queries%s" % (
+            name, before["median_ms"], result["median_ms"], (ratio - 1) * 100,
+            before["queries"], result["queries"], "  REGRESSION" if slower else "",
+        ))
+    return lines, regressed
+
+
+def benchmark_user():
+    user, created = User.objects.get_or_create(username="benchmark", defaults={
+        "is_staff": True, "is_superuser": True, "email": "benchmark@example.com",
+    })
+    return user
@@ -0,0 +1,138 @@
+"""Collision-free booking codes.
+
+Every code is a keyed permutation of a counter value: a small Feistel network
+maps the counter bijectively onto all 8 character strings of ``[a-z0-9]``. As
+long as no counter value is used twice no code is, so inserting a booking never
+runs into the unique constraint and never has to be retried.
+
+Counter values are reserved from the ``CodeSequence`` row in blocks, with one
+atomic UPDATE, and handed out from an in-process pool. The key is generated
+with ``secrets`` when the sequence is created, so codes cannot be predicted
+from one another.
+"""
+import hashlib
+import hmac
+import secrets
+import string
+import threading
+from collections import deque
+
+from django.db import connection, transaction
+from django.db.models import F
+
+ALPHABET = string.ascii_lowercase + string.digits
+CODE_LENGTH = 8
+DOMAIN = len(ALPHABET) ** CODE_LENGTH
+
+# 2 ** (2 * HALF_BITS) is the smallest even power of two covering DOMAIN
+HALF_BITS = 21
+HALF_MASK = (1 << HALF_BITS) - 1
+ROUNDS = 4
+
+BLOCK_SIZE = 100
+SEQUENCE_NAME = "booking"
+
+_pool = deque()
+_lock = threading.Lock()
+
+
+def _round(key, number, value):
+    digest = hmac.new(key, bytes([number]) + value.to_bytes(3, "big"), hashlib.sha256).digest()
+    return int.from_bytes(digest[:3], "big") & HALF_MASK
+
+
+def permute(value, key):
+    """Maps ``value`` in ``range(DOMAIN)`` to a unique other value in that range.
+
+    The Feistel network is a bijection on 42 bit numbers. Results outside the
+    domain are fed through it again (cycle walking) until they fall inside,
+    which keeps the mapping a bijection on the domain itself.
+    """
+    if not 0 <= value < DOMAIN:
+        raise ValueError("Booking code space exhausted")
+
+    while True:
+        left, right = value >> HALF_BITS, value & HALF_MASK
+        for number in range(ROUNDS):
+            left, right = right, left ^ _round(key, number, right)
+        value = (left << HALF_BITS) | right
+        if value < DOMAIN:
+            return value
+
+
+def encode(value):
+    chars = []
+    for i in range(CODE_LENGTH):
+        value, digit = divmod(value, len(ALPHABET))
+        chars.append(ALPHABET[digit])
+    return "".join(reversed(chars))
+
+
+def reserve_block(size=BLOCK_SIZE):
+    """Reserves ``size`` counter values and returns the codes derived from them.
+
+    Codes that are already taken, e.g. random codes issued before this
+    allocator existed or codes typed in by hand, are left out.
+    """
+    from registration.models import Booking, CodeSequence
+
+    sequence = CodeSequence.objects.filter(name=SEQUENCE_NAME)
+    with transaction.atomic():
+        # write first, so the row is locked before it is read
+        if not sequence.update(next_value=F("next_value") + size):
+            CodeSequence.objects.get_or_create(name=SEQUENCE_NAME, defaults={"key": secrets.token_hex(32)})
+            sequence.update(next_value=F("next_value") + size)
+        key, end = sequence.values_list("key", "next_value").get()
+
+    key = bytes.fromhex(key)
+    codes = [encode(permute(value, key)) for value in range(end - size, end)]
+    taken = set(Booking.objects.filter(code__in=codes).values_list("code", flat=True))
+    return [code for code in codes if code not in taken]
+
+
+class PendingBlock(object):
+    """Codes reserved inside a transaction.
+
+    The reservation is undone if the transaction rolls back, so until it
+    commits the codes must not be handed to anyone else. The block is
+    registered with ``on_commit``: Django drops it on rollback and calls it on
+    commit, which moves the leftover codes to the shared pool.
+    """
+
+    def __init__(self, codes):
+        self.codes = deque(codes)
+
+    def __call__(self):
+        with _lock:
+            _pool.extend(self.codes)
+        self.codes.clear()
+
+
+def pending_block():
+    for savepoints, func in connection.run_on_commit:
+        if isinstance(func, PendingBlock) and func.codes:
+            return func
+    return None
+
+
+def next_code():
+    if connection.in_atomic_block:
+        block = pending_block()
+        if block is not None:
+            return block.codes.popleft()
+
+    with _lock:
+        if _pool:
+            return _pool.popleft()
+
+    codes = reserve_block()
+    while not codes:
+        codes = reserve_block()
+
+    code, rest = codes[0], codes[1:]
+    if connection.in_atomic_block:
+        transaction.on_commit(PendingBlock(rest))
+    else:
+        with _lock:
+            _pool.extend(rest)
+    return code
@@ -0,0 +1,124 @@
+"""Parsed document cache and persisted queries for the GraphQL endpoint.
+
+The frontend only sends a handful of distinct queries, so parsing and
+validating them on every request is wasted work. ``ValidatedDocumentBackend``
+does both once per query string and keeps the result in a bounded LRU.
+
+Persisted queries are registered at deploy time with the ``register_queries``
+management command. Clients may then send only the SHA-256 hash of a query in
+the Apollo ``persistedQuery`` extension instead of the query itself. Each
+process keeps the registered queries it has seen until ``register_queries``
+bumps the registry version in the shared cache.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import cache
+from graphql.backend.base import GraphQLDocument
+from graphql.backend.core import GraphQLCoreBackend
+from graphql.execution import ExecutionResult, execute
+from graphql.language import ast
+from graphql.language.parser import parse
+from graphql.validation import validate
+
+DOCUMENT_CACHE_SIZE = getattr(settings, "GRAPHQL_DOCUMENT_CACHE_SIZE", 256)
+REGISTRY_VERSION_KEY = "registration:persisted-queries-version"
+
+
+def query_hash(query):
+    return hashlib.sha256(query.encode("utf-8")).hexdigest()
+
+
+def invalid(errors, *args, **kwargs):
+    return ExecutionResult(errors=errors, invalid=True)
+
+
+class ValidatedDocumentBackend(GraphQLCoreBackend):
+    """Backend that parses and validates each distinct query only once"""
+
+    def __init__(self, max_size=DOCUMENT_CACHE_SIZE, executor=None):
+        super(ValidatedDocumentBackend, self).__init__(executor)
+        self.max_size = max_size
+        self.documents = OrderedDict()
+        self.lock = threading.Lock()
+
+    def document_from_string(self, schema, document_string):
+        key = (schema, query_hash(document_string))
+        with self.lock:
+            document = self.documents.get(key)
+            if document is not None:
+                self.documents.move_to_end(key)
+                return document
+
+        # syntax errors are raised and reported by the view, they are not cached
+        document_ast = parse(document_string)
+        errors = validate(schema, document_ast)
+        if errors:
+            run = partial(invalid, errors)
+        else:
+            run = partial(execute, schema, document_ast, **self.execute_params)
+        document = GraphQLDocument(schema=schema, document_string=document_string, document_ast=document_ast,
+                                   execute=run)
+
+        with self.lock:
+            self.documents[key] = document
+            while len(self.documents) > self.max_size:
+                self.documents.popitem(last=False)
+        return document
+
+
+backend = ValidatedDocumentBackend()
+
+# hash -> query text, kept until the registry version changes
+_persisted = {}
+_operations = None
+_version = None
+
+
+def bump_registry_version():
+    """Makes all processes forget the registered queries they loaded, after ``register_queries``."""
+    # from the clock, so it differs from the version the processes saw even if it was evicted
+    cache.set(REGISTRY_VERSION_KEY, int(time.time() * 1000000), None)
+
+
+def refresh():
+    global _operations, _version
+    version = cache.get(REGISTRY_VERSION_KEY)
+    if version != _version:
+        _persisted.clear()
+        _operations = None
+        _version = version
+
+
+def persisted_query(sha256):
+    """The registered query with the given hash, or None."""
+    from registration.models import PersistedQuery
+
+    refresh()
+    query = _persisted.get(sha256)
+    if query is None:
+        query = PersistedQuery.objects.filter(sha256=sha256).values_list("query", flat=True).first()
+        if query is not None:
+            _persisted[sha256] = query
+    return query
+
+
+def registered_operations():
+    """Names of the operations of all registered queries, loaded once per registry version like the queries."""
+    global _operations
+    refresh()
+    if _operations is None:
+        from registration.models import PersistedQuery
+
+        names = set()
+        for query in PersistedQuery.objects.values_list("query", flat=True):
+            names.update(
+                definition.name.value for definition in parse(query).definitions
+                if isinstance(definition, ast.OperationDefinition) and definition.name
+            )
+        _operations = frozenset(names)
+    return _operations
@@ -0,0 +1,66 @@
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import date
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from registration import routing
+from registration.models import Price, Rate
+
+CACHE_KEY = "registration:rate-index:%s"
+
+# explicit invalidation reaches other processes through the shared cache (see
+# CACHES), the timeout bounds how long a per-process cache could be stale
+CACHE_TIMEOUT = 300
+
+
+class RateIndex(object):
+    """The active rates of one event, indexed by their date of birth band.
+
+    The rates are sorted by the lower bound of the band, so a lookup bisects
+    to the rates starting at or before the date of birth and only checks their
+    upper bound and price windows. Rates with prices are only eligible on
+    days one of their prices is valid.
+    """
+
+    def __init__(self, rates, prices):
+        self.rates = sorted(rates, key=lambda rate: rate.dob_from or date.min)
+        self.starts = [rate.dob_from or date.min for rate in self.rates]
+        self.positions = {rate.pk: position for position, rate in enumerate(rates)}
+        self.windows = defaultdict(list)
+        for rate_id, valid_from, valid_until in prices:
+            self.windows[rate_id].append((valid_from or date.min, valid_until or date.max))
+
+    @classmethod
+    def build(cls, event_id):
+        rates = list(Rate.objects.filter(event_id=event_id, is_active=True))
+        prices = Price.objects.filter(rate__in=rates).values_list("rate_id", "valid_from", "valid_until")
+        return cls(rates, prices)
+
+    def is_bookable(self, rate, on):
+        windows = self.windows.get(rate.pk)
+        return not windows or any(start <= on <= end for start, end in windows)
+
+    def eligible(self, date_of_birth, on=None):
+        on = on or timezone.localdate()
+        candidates = self.rates[:bisect_right(self.starts, date_of_birth)]
+        rates = [
+            rate for rate in candidates
+            if (rate.dob_to is None or date_of_birth <= rate.dob_to) and self.is_bookable(rate, on)
+        ]
+        return sorted(rates, key=lambda rate: self.positions[rate.pk])
+
+
+def get_rate_index(event_id):
+    key = CACHE_KEY % event_id
+    index = cache.get(key)
+    if index is None:
+        with routing.primary():
+            index = RateIndex.build(event_id)
+        cache.set(key, index, CACHE_TIMEOUT)
+    return index
+
+
+def invalidate_rate_index(event_id):
+    cache.delete(CACHE_KEY % event_id)
@@ -0,0 +1,137 @@
+import csv
+import tempfile
+from datetime import datetime
+from itertools import chain, groupby
+from operator import itemgetter
+
+from django.utils import timezone
+from openpyxl import Workbook
+
+from registration.models import Booking, ESSEN_CHOICES
+
+# (field used for the header, lookup passed to values())
+COLUMNS = (
+    ("id", "id"),
+    ("event", "event__name"),
+    ("code", "code"),
+    ("date", "date"),
+    ("checkin_date", "checkin_date"),
+    ("first_name", "first_name"),
+    ("last_name", "last_name"),
+    ("sex", "sex"),
+    ("email", "email"),
+    ("club", "club"),
+    ("date_of_birth", "date_of_birth"),
+    ("address", "address"),
+    ("zipcode", "zipcode"),
+    ("city", "city"),
+    ("country", "country"),
+    ("phone", "phone"),
+    ("food", "food"),
+    ("arrival", "arrival__day"),
+    ("departure", "departure__day"),
+    ("rate", "rate__label"),
+    ("disciplines", None),
+    ("variants", None),
+    ("notes", "notes"),
+    ("amount", "amount"),
+    ("state", "state"),
+    ("internal_notes", "internal_notes"),
+)
+
+def headers():
+    return [str(Booking._meta.get_field(name).verbose_name) for name, lookup in COLUMNS]
+
+
+class RelatedColumn(object):
+    """Joins a many-to-many relation onto rows that are streamed ordered by booking id.
+
+    ``rows`` are ``(booking_id, label)`` pairs ordered by booking id as well,
+    so both sides are walked in step like a merge join and never held in
+    memory as a whole.
+    """
+
+    def __init__(self, rows):
+        self.groups = groupby(rows, key=itemgetter(0))
+        self.current = next(self.groups, None)
+
+    def get(self, booking_id):
+        while self.current is not None and self.current[0] < booking_id:
+            self.current = next(self.groups, None)
+        if self.current is not None and self.current[0] == booking_id:
+            return ", ".join(label for pk, label in self.current[1])
+        return ""
+
+
+def iter_rows(queryset, chunk_size=2000):
+    """Yields the export rows of ``queryset`` with three queries in total.
+
+    Labels are translated when this is called: the rows may only be generated
+    while the response streams, when the request's language isn't active any more.
+    """
+    food_labels = {key: str(label) for key, label in ESSEN_CHOICES}
+    return generate_rows(queryset, chunk_size, food_labels)
+
+
+def generate_rows(queryset, chunk_size, food_labels):
+    pks = queryset.order_by().values("pk")
+    disciplines = RelatedColumn(
+        Booking.disciplines.through.objects.filter(booking__in=pks)
+        .order_by("booking_id", "discipline__order", "discipline__code")
+        .values_list("booking_id", "discipline__code")
+        .iterator(chunk_size=chunk_size)
+    )
+    variants = RelatedColumn(
+        Booking.variants.through.objects.filter(booking__in=pks)
+        .order_by("booking_id", "productvariant__product__order", "productvariant__order")
+        .values_list("booking_id", "productvariant__name")
+        .iterator(chunk_size=chunk_size)
+    )
+
+    lookups = [lookup for name, lookup in COLUMNS if lookup]
+    for values in Booking.objects.filter(pk__in=pks).order_by("pk").values(*lookups).iterator(chunk_size=chunk_size):
+        values["food"] = food_labels.get(values["food"], values["food"])
+        row = []
+        for name, lookup in COLUMNS:
+            if name == "disciplines":
+                row.append(disciplines.get(values["id"]))
+            elif name == "variants":
+                row.append(variants.get(values["id"]))
+            else:
+                value = values[lookup]
+                if isinstance(value, datetime):
+                    value = timezone.localtime(value).replace(tzinfo=None)
+                row.append(value)
+        yield row
+
+
+class Echo(object):
+    """File-like object that hands back what is written, for streaming csv"""
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(queryset):
+    writer = csv.writer(Echo())
+    # headers and rows are translated now, not while streaming
+    header, rows = writer.writerow(headers()), iter_rows(queryset)
+    return chain([header], (writer.writerow(row) for row in rows))
+
+
+def write_xlsx(queryset):
+    """Writes the export into a temporary file using openpyxl's write-only mode.
+
+    XLSX is a zip archive and can't be streamed as it is generated, but in
+    write-only mode openpyxl spools rows to disk instead of keeping them.
+    """
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(headers())
+    for row in iter_rows(queryset):
+        sheet.append(row)
+
+    output = tempfile.TemporaryFile()
+    workbook.save(output)
+    output.seek(0)
+    return output
@@ -0,0 +1,135 @@
+"""Response cache for the public, read-only part of the GraphQL API.
+
+Only queries whose top-level fields are listed in ``CACHEABLE_FIELDS`` are
+cached: they return event configuration that changes rarely, never bookings.
+Queries selecting one of the ``VOLATILE_FIELDS`` anywhere, such as the places
+left of a quota, aren't cached either.
+Cache keys contain a version number per event (and one for all events), which
+the signal handlers bump whenever something belonging to the event is saved or
+deleted, so stale entries are never hit again and simply expire. The versions
+only reach all worker processes through a cache they share, see ``CACHES``.
+"""
+import gzip
+import hashlib
+import json
+import time
+
+from django.core.cache import cache
+from django.utils import timezone
+from graphql.language import ast
+from graphql.language.parser import parse
+
+# top-level field: name of the argument holding the event id (None: all events)
+CACHEABLE_FIELDS = {
+    "allEvents": None,
+    "event": "id",
+    "eligibleRates": "eventId",
+    "eligibleRatesBatch": "eventId",
+}
+
+# fields changing with every booking, responses selecting them anywhere are not cached
+VOLATILE_FIELDS = {"remaining"}
+
+ALL_EVENTS = "all"
+VERSION_KEY = "registration:graphql-version:%s"
+RESPONSE_KEY = "registration:graphql-response:%s"
+RESPONSE_TIMEOUT = 60 * 60
+
+
+def get_version(event_id):
+    key = VERSION_KEY % event_id
+    version = cache.get(key)
+    if version is None:
+        # start from the clock, so a version that was evicted from the cache
+        # can't be reset to a number stale responses are stored under
+        cache.add(key, int(time.time() * 1000000))
+        version = cache.get(key)
+    return version
+
+
+def bump_version(event_id):
+    for name in (event_id, ALL_EVENTS):
+        try:
+            cache.incr(VERSION_KEY % name)
+        except ValueError:
+            cache.set(VERSION_KEY % name, int(time.time() * 1000000))
+
+
+def argument_value(field, name, variables):
+    for argument in field.arguments or ():
+        if argument.name.value != name:
+            continue
+        value = argument.value
+        if isinstance(value, ast.Variable):
+            return (variables or {}).get(value.name.value)
+        if isinstance(value, (ast.IntValue, ast.StringValue)):
+            return value.value
+    return None
+
+
+def selected_fields(document):
+    """Names of all fields selected anywhere in the document, fragments included."""
+    names = set()
+    selection_sets = [d.selection_set for d in document.definitions if getattr(d, "selection_set", None)]
+    while selection_sets:
+        for selection in selection_sets.pop().selections:
+            if isinstance(selection, ast.Field):
+                names.add(selection.name.value)
+            if getattr(selection, "selection_set", None):
+                selection_sets.append(selection.selection_set)
+    return names
+
+
+def cached_events(query, variables, operation_name):
+    """The events a read-only operation depends on, or None if it can't be cached.
+
+    ``ALL_EVENTS`` stands for fields that span all events or don't name one.
+    """
+    try:
+        document = parse(query)
+    except Exception:
+        return None
+
+    operations = [d for d in document.definitions if isinstance(d, ast.OperationDefinition)]
+    if operation_name:
+        operations = [o for o in operations if o.name and o.name.value == operation_name]
+    if len(operations) != 1 or operations[0].operation != "query":
+        return None
+    if selected_fields(document) & VOLATILE_FIELDS:
+        return None
+
+    events = set()
+    for selection in operations[0].selection_set.selections:
+        if not isinstance(selection, ast.Field) or selection.name.value not in CACHEABLE_FIELDS:
+            return None
+        argument = CACHEABLE_FIELDS[selection.name.value]
+        event_id = argument_value(selection, argument, variables) if argument else None
+        events.add(str(event_id) if event_id is not None else ALL_EVENTS)
+    return events
+
+
+def response_key(query, variables, operation_name):
+    events = cached_events(query, variables, operation_name)
+    if events is None:
+        return None
+
+    versions = sorted((event, get_version(event)) for event in events)
+    # the date is part of the key because rate eligibility defaults to today
+    raw = json.dumps([query, variables, operation_name, versions, str(timezone.localdate())], sort_keys=True)
+    return RESPONSE_KEY % hashlib.sha256(raw.encode()).hexdigest()
+
+
+def make_entry(content):
+    return {
+        "content": content,
+        "gzip": gzip.compress(content),
+        "etag": '"%s"' % hashlib.sha256(content).hexdigest()[:32],
+    }
+
+
+def get_entry(key):
+    return cache.get(key)
+
+
+def set_entry(key, entry):
+    cache.set(key, entry, RESPONSE_TIMEOUT)
@@ -0,0 +1,216 @@
+"""Group registration: many bookings for one event in a single request.
+
+All rows are validated against the configuration of the event, which is
+loaded once, instead of looking up every related object per row. The rules
+on rates and products are shared with ``createBooking``, which checks them
+for its single booking with ``rate_errors`` and ``variant_errors``. The valid
+rows are inserted with ``bulk_create``, their disciplines and products with
+one ``bulk_create`` on each through table, all in one transaction. Invalid
+rows are reported with their errors and don't keep the others from being
+booked.
+
+Rate and product quotas are taken for the whole group with one UPDATE per
+rate and variant. Only if that fails, because some are sold out, they are
+taken row by row so that as many rows as possible are booked.
+"""
+from collections import Counter, namedtuple
+
+from django.db import transaction
+from django.utils import timezone
+from django.utils.translation import gettext as _
+from rest_framework import serializers
+
+from registration.codes import next_code
+from registration.eligibility import get_rate_index
+from registration.models import Booking, Day, Discipline, ProductVariant, Rate
+from registration.pricing import PriceTimeline, booking_date
+from registration.quotas import SoldOut, places, take
+from registration.statistics import invalidate_event_statistics
+
+MAX_GROUP_SIZE = 200
+
+RowResult = namedtuple("RowResult", "index booking errors")
+
+
+class GroupBookingSerializer(serializers.ModelSerializer):
+    """Field validation of one group member.
+
+    Related objects are only given by id here, ``EventConfig`` checks them.
+    """
+    arrival = serializers.IntegerField(required=False, allow_null=True)
+    departure = serializers.IntegerField(required=False, allow_null=True)
+    rate = serializers.IntegerField(required=False, allow_null=True)
+    disciplines = serializers.ListField(child=serializers.IntegerField(), required=False)
+    variants = serializers.ListField(child=serializers.IntegerField(), required=False)
+
+    class Meta:
+        model = Booking
+        fields = ("disciplines", "date_of_birth", "email", "last_name",
+                  "club", "first_name", "notes", "address", "zipcode", "city", "phone",
+                  "arrival", "departure", "rate", "variants")
+
+
+def rate_errors(rate_index, rate_id, date_of_birth, today):
+    if rate_id is not None and rate_id not in {rate.pk for rate in rate_index.eligible(date_of_birth, today)}:
+        return [_("This rate can't be booked for this date of birth.")]
+    return []
+
+
+def variant_errors(products, required_products):
+    """Errors of the chosen variants, given by the ids of their products."""
+    if len(products) != len(set(products)):
+        return [_("Only one variant per product can be chosen.")]
+    missing = [product.name for pk, product in required_products.items() if pk not in products]
+    if missing:
+        return [_("Required products missing: %s") % ", ".join(sorted(missing))]
+    return []
+
+
+class EventConfig(object):
+    """Rates, days, disciplines and products of an event, loaded once."""
+
+    def __init__(self, event):
+        self.event = event
+        self.rate_index = get_rate_index(event.pk)
+        self.days = {day.pk: day for day in Day.objects.filter(event=event)}
+        self.disciplines = set(Discipline.objects.filter(event=event).values_list("pk", flat=True))
+        self.rate_disciplines = {}
+        for rate_id, discipline_id in Rate.disciplines.through.objects.filter(
+                rate__event=event).values_list("rate_id", "discipline_id"):
+            self.rate_disciplines.setdefault(rate_id, set()).add(discipline_id)
+        self.variants = {
+            variant.pk: variant for variant in ProductVariant.objects.filter(product__event=event).select_related("product")
+        }
+        self.required_products = {
+            variant.product_id: variant.product for variant in self.variants.values() if variant.product.required
+        }
+        self.timeline = PriceTimeline(event.pk)
+
+    def validate(self, data, today):
+        """Errors of one row that passed field validation, as ``{field: [messages]}``."""
+        errors = {}
+
+        rate_id = data.get("rate")
+        rate_messages = rate_errors(self.rate_index, rate_id, data["date_of_birth"], today)
+        if rate_messages:
+            errors["rate"] = rate_messages
+
+        arrival, departure = self.days.get(data.get("arrival")), self.days.get(data.get("departure"))
+        if data.get("arrival") is not None and (arrival is None or not arrival.arrival):
+            errors["arrival"] = [_("Not an arrival day of this event.")]
+        if data.get("departure") is not None and (departure is None or not departure.departure):
+            errors["departure"] = [_("Not a departure day of this event.")]
+        positions = self.timeline.positions
+        if arrival and departure and positions.get(departure.pk, 0) < positions.get(arrival.pk, 0):
+            errors["departure"] = [_("The departure must not be before the arrival.")]
+
+        disciplines = set(data.get("disciplines", ()))
+        allowed = self.rate_disciplines.get(rate_id) or self.disciplines
+        if disciplines - allowed:
+            errors["disciplines"] = [_("Unknown disciplines: %s") % ", ".join(map(str, sorted(disciplines - allowed)))]
+
+        variants = data.get("variants", ())
+        unknown = [pk for pk in variants if pk not in self.variants]
+        products = [self.variants[pk].product_id for pk in variants if pk in self.variants]
+        if unknown:
+            errors["variants"] = [_("Unknown products: %s") % ", ".join(map(str, sorted(unknown)))]
+        else:
+            variant_messages = variant_errors(products, self.required_products)
+            if variant_messages:
+                errors["variants"] = variant_messages
+
+        return errors
+
+    def amount(self, data, on):
+        amount = self.timeline.amount(data.get("rate"), on, data.get("arrival"), data.get("departure"))
+        return amount + sum(self.variants[pk].price for pk in data.get("variants", ()))
+
+
+def messages(detail):
+    """Flattens the nested errors of list fields into a list of messages."""
+    if isinstance(detail, dict):
+        return [message for value in detail.values() for message in messages(value)]
+    if isinstance(detail, list):
+        return [message for value in detail for message in messages(value)]
+    return [str(detail)]
+
+
+def row_places(data):
+    return places(data.get("rate"), data.get("variants", ()))
+
+
+def take_places(valid, results):
+    """Takes the quota places of the valid rows, returns the rows that got theirs."""
+    try:
+        take(sum((row_places(data) for index, data in valid), Counter()))
+        return valid
+    except SoldOut:
+        pass
+
+    booked = []
+    for index, data in valid:
+        try:
+            take(row_places(data))
+        except SoldOut as e:
+            field = "rate" if isinstance(e.obj, Rate) else "variants"
+            results[index] = RowResult(index, None, {field: list(e.messages)})
+        else:
+            booked.append((index, data))
+    return booked
+
+
+def create_bookings(event, rows):
+    """Validates ``rows`` and books the valid ones, returns a ``RowResult`` per row."""
+    today = timezone.localdate()
+    config = EventConfig(event)
+
+    results, valid = [], []
+    for index, row in enumerate(rows):
+        serializer = GroupBookingSerializer(data=row)
+        if not serializer.is_valid():
+            errors = {field: messages(detail) for field, detail in serializer.errors.items()}
+            results.append(RowResult(index, None, errors))
+            continue
+        errors = config.validate(serializer.validated_data, today)
+        results.append(RowResult(index, None, errors))
+        if not errors:
+            valid.append((index, serializer.validated_data))
+
+    if not valid:
+        return results
+
+    now = timezone.now()
+    with transaction.atomic():
+        valid = take_places(valid, results)
+        bookings = []
+        for index, data in valid:
+            booking = Booking(event=event, code=next_code(), date=now, **{
+                field: value for field, value in data.items()
+                if field not in ("rate", "arrival", "departure", "disciplines", "variants")
+            })
+            booking.rate_id, booking.arrival_id, booking.departure_id = data.get("rate"), data.get("arrival"), data.get("departure")
+            booking.amount = booking.open_amount = config.amount(data, booking_date(now))
+            bookings.append(booking)
+
+        Booking.objects.bulk_create(bookings)
+        if any(booking.pk is None for booking in bookings):
+            # only some databases return the primary keys of inserted rows
+            pks = dict(Booking.objects.filter(code__in=[b.code for b in bookings]).values_list("code", "pk"))
+            for booking in bookings:
+                booking.pk = pks[booking.code]
+
+        Booking.disciplines.through.objects.bulk_create([
+            Booking.disciplines.through(booking_id=booking.pk, discipline_id=discipline_id)
+            for booking, (index, data) in zip(bookings, valid)
+            for discipline_id in set(data.get("disciplines", ()))
+        ])
+        Booking.variants.through.objects.bulk_create([
+            Booking.variants.through(booking_id=booking.pk, productvariant_id=variant_id)
+            for booking, (index, data) in zip(bookings, valid)
+            for variant_id in data.get("variants", ())
+        ])
+
+    invalidate_event_statistics(event.pk)
+    for booking, (index, data) in zip(bookings, valid):
+        results[index] = RowResult(index, booking, {})
+    return results
@@ -0,0 +1,101 @@
+"""ASGI handler that runs the views in a bounded thread pool.
+
+Under ASGI the server's event loop holds the connections: request bodies are
+received and responses sent without a thread, so slow clients and idle
+keep-alive connections cost nothing. Only the view, with its middleware,
+runs in one of ``ASGI_THREADS`` threads. That bounds the number of database
+connections, one per thread, however many requests are waiting.
+
+Django 3.0 has no async views and refuses ORM calls from the event loop, so
+the GraphQL view runs as a whole in the pool as well: graphql-core's asyncio
+executor would call the (synchronous) resolvers on the loop. Streaming
+responses, like the CSV export, query the database while they are sent;
+their parts are produced on a thread of their own.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.base import BaseHandler
+from django.db import close_old_connections
+
+# more threads only wait for each other on SQLite, which writes one transaction at a time
+THREADS = getattr(settings, "ASGI_THREADS", 4)
+
+_end = object()
+
+
+class PooledASGIHandler(ASGIHandler):
+    def __init__(self, threads=THREADS):
+        super(PooledASGIHandler, self).__init__()
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="asgi")
+
+    def run(self, func, *args):
+        return asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+
+    def respond(self, request):
+        response = BaseHandler.get_response(self, request)
+        if response.streaming:
+            # closed by the thread producing its parts (see send_response), this one is done with the database
+            close_old_connections()
+        else:
+            # sends request_finished in this thread, which closes its database connection
+            response.close()
+        return response
+
+    async def get_response(self, request):
+        # a coroutine, so ASGIHandler awaits it instead of using its own thread pool
+        return await self.run(self.respond, request)
+
+    async def send_response(self, response, send):
+        # replaces ASGIHandler.send_response, which would close the response a second time
+        await send({
+            "type": "http.response.start",
+            "status": response.status_code,
+            "headers": self.headers(response),
+        })
+        if not response.streaming:
+            for chunk, last in self.chunk_bytes(response.content):
+                await send({"type": "http.response.body", "body": chunk, "more_body": not last})
+            if not response.closed:
+                # an error response of ASGIHandler itself, that no view produced
+                await self.run(response.close)
+            return
+
+        # the parts are produced on one thread of their own: they query the
+        # database over the same connection, and the pool isn't held up by slow clients
+        streamer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="asgi-stream")
+        loop = asyncio.get_event_loop()
+        parts = iter(response)
+        try:
+            while True:
+                part = await loop.run_in_executor(streamer, next, parts, _end)
+                if part is _end:
+                    break
+                for chunk, last in self.chunk_bytes(part):
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body"})
+        finally:
+            await loop.run_in_executor(streamer, response.close)
+            streamer.shutdown(wait=False)
+
+    @staticmethod
+    def headers(response):
+        headers = [
+            (header.encode("ascii") if isinstance(header, str) else header,
+             value.encode("latin1") if isinstance(value, str) else value)
+            for header, value in response.items()
+        ]
+        headers.extend(
+            (b"Set-Cookie", cookie.output(header="").encode("ascii").strip())
+            for cookie in response.cookies.values()
+        )
+        return headers
+
+
+def get_asgi_application():
+    import django
+
+    django.setup(set_prefix=False)
+    return PooledASGIHandler()
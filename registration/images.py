@@ -0,0 +1,172 @@
+"""Resized, recompressed copies of event logos and images on pages.
+
+Derivatives are built with Pillow on a background thread once the upload is
+committed, never while a request waits, and stored under the SHA-256 of the
+original: the same image uploaded again, under whatever name, is resized only
+once. Each width is stored as WebP and as JPEG (PNG for images with
+transparency) for clients that can't show WebP. Until the derivatives are
+built, ``srcset`` is empty and clients use the original.
+"""
+import hashlib
+import io
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps
+
+from registration.graphql_cache import bump_version
+from registration.models import ImageDerivative
+
+logger = logging.getLogger(__name__)
+
+WIDTHS = getattr(settings, "IMAGE_DERIVATIVE_WIDTHS", (160, 320, 640, 1280))
+QUALITY = 80
+WEBP = "webp"
+EXTENSIONS = {"webp": "webp", "jpeg": "jpg", "png": "png"}
+IMG_RE = re.compile(r"<img\b[^>]*>", re.IGNORECASE)
+SRC_RE = re.compile(r"""\bsrc\s*=\s*["']([^"']+)["']""", re.IGNORECASE)
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="image-derivatives")
+
+
+def file_hash(name):
+    digest = hashlib.sha256()
+    with default_storage.open(name, "rb") as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def derivative_name(sha256, width, image_format):
+    return "derivatives/%s/%s/%d.%s" % (sha256[:2], sha256, width, EXTENSIONS[image_format])
+
+
+def encode(image, image_format):
+    out = io.BytesIO()
+    if image_format == "webp":
+        image.save(out, "WEBP", quality=QUALITY, method=4)
+    elif image_format == "jpeg":
+        image.convert("RGB").save(out, "JPEG", quality=QUALITY, optimize=True, progressive=True)
+    else:
+        image.save(out, "PNG", optimize=True)
+    return out.getvalue()
+
+
+def render(name, sha256):
+    """Resizes the image ``name`` to all widths, returns the unsaved derivatives."""
+    with default_storage.open(name, "rb") as f:
+        image = Image.open(f)
+        # JPEGs are decoded at a reduced scale right away when that's enough
+        image.draft("RGB", (max(WIDTHS), max(WIDTHS)))
+        image = ImageOps.exif_transpose(image)
+        image.load()
+
+    transparent = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+    image = image.convert("RGBA" if transparent else "RGB")
+    fallback = "png" if transparent else "jpeg"
+
+    # widths larger than the original are left out, the original size is kept instead
+    widths = sorted({min(width, image.width) for width in WIDTHS})
+    derivatives = []
+    for width in reversed(widths):
+        height = max(1, round(image.height * width / image.width))
+        # each width is scaled from the previous, larger one
+        image = image.resize((width, height), Image.LANCZOS) if width != image.width else image
+        for image_format in (WEBP, fallback):
+            file_name = derivative_name(sha256, width, image_format)
+            if not default_storage.exists(file_name):
+                default_storage.save(file_name, ContentFile(encode(image, image_format)))
+            derivatives.append(ImageDerivative(
+                source=name, sha256=sha256, width=width, height=height, format=image_format, file=file_name,
+            ))
+    return derivatives
+
+
+def build(name):
+    """Creates the derivatives of the stored image ``name`` unless they are up to date."""
+    sha256 = file_hash(name)
+    current = ImageDerivative.objects.filter(source=name)
+    if current.filter(sha256=sha256).exists():
+        return False
+
+    # the same image under another name: its files can be used as they are
+    known = {}
+    for row in ImageDerivative.objects.filter(sha256=sha256):
+        known.setdefault((row.width, row.format), ImageDerivative(
+            source=name, sha256=sha256, width=row.width, height=row.height, format=row.format, file=row.file,
+        ))
+    derivatives = list(known.values()) or render(name, sha256)
+
+    with transaction.atomic():
+        current.delete()
+        ImageDerivative.objects.bulk_create(derivatives)
+    return True
+
+
+def build_safely(names, event_ids):
+    try:
+        changed = False
+        for name in names:
+            try:
+                changed = build(name) or changed
+            except (OSError, ValueError, Image.DecompressionBombError):
+                logger.exception("could not build the derivatives of %s", name)
+        if changed:
+            for event_id in event_ids:
+                bump_version(event_id)
+    finally:
+        close_old_connections()
+
+
+def schedule(names, event_ids=()):
+    """Builds the derivatives of ``names`` in the background after the current transaction."""
+    names = [name for name in names if name]
+    if names:
+        transaction.on_commit(lambda: _executor.submit(build_safely, names, list(event_ids)))
+
+
+def media_name(url):
+    """The storage name of a media URL (like the ``src`` of an image on a page), or None."""
+    path = unquote(url.split("?", 1)[0].split("#", 1)[0])
+    if settings.MEDIA_URL and path.startswith(settings.MEDIA_URL):
+        return path[len(settings.MEDIA_URL):]
+    return None
+
+
+def page_images(html):
+    names = (media_name(match) for match in SRC_RE.findall(html or ""))
+    return sorted({name for name in names if name})
+
+
+def srcset(derivatives, image_format=WEBP):
+    rows = sorted((row for row in derivatives if row.format == image_format), key=lambda row: row.width)
+    return ", ".join("%s %dw" % (default_storage.url(row.file), row.width) for row in rows)
+
+
+def fallback_srcset(derivatives):
+    formats = {row.format for row in derivatives} - {WEBP}
+    return srcset(derivatives, formats.pop()) if formats else ""
+
+
+def add_srcsets(html, derivatives):
+    """Adds a ``srcset`` to the images in ``html`` derivatives exist for."""
+    by_source = {}
+    for row in derivatives:
+        by_source.setdefault(row.source, []).append(row)
+
+    def replace(match):
+        tag = match.group(0)
+        src = SRC_RE.search(tag)
+        rows = by_source.get(media_name(src.group(1))) if src else None
+        if not rows or re.search(r"\bsrcset\s*=", tag, re.IGNORECASE):
+            return tag
+        end = -2 if tag.endswith("/>") else -1
+        return '%s srcset="%s" sizes="100vw"%s' % (tag[:end].rstrip(), srcset(rows), tag[end:])
+
+    return IMG_RE.sub(replace, html)
@@ -0,0 +1,253 @@
+"""Timing and SQL instrumentation for the GraphQL endpoint.
+
+``CachedGraphQLView`` runs every operation inside ``profile_operation``,
+which counts and times the SQL queries of all database connections and
+attributes them to the field being resolved at that moment. The graphene
+middleware ``InstrumentationMiddleware`` times the resolvers and keeps track
+of that field. Queries of DataLoader batches are attributed to the loader.
+
+Field paths leave out list indexes, so all rows of a list share one entry.
+When the operation is done it is written to the ``registration.graphql`` log
+as one JSON line, added to the in-process ``metrics`` and checked against the
+query budget. Operation names and aliases are chosen by the client, so the
+metrics only keep operations of registered queries (see
+``registration.documents``) under their name, all others under ``(other)``,
+and at most ``METRICS_FIELDS`` paths per operation.
+
+Settings:
+
+``GRAPHQL_QUERY_BUDGET``
+    maximum number of SQL queries of any operation (default: no limit)
+``GRAPHQL_QUERY_BUDGETS``
+    maximum per operation name, overriding the default
+``GRAPHQL_QUERY_BUDGET_STRICT``
+    raise ``QueryBudgetExceeded`` instead of logging a warning, for tests
+"""
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+from graphql.language import ast
+from promise import Promise
+
+from registration import documents
+
+logger = logging.getLogger("registration.graphql")
+
+# SQL that runs while no field is being resolved, e.g. in the view
+OUTSIDE = "(operation)"
+# slowest fields written to the log
+LOG_FIELDS = 10
+# metrics of unregistered operations, and of the paths beyond METRICS_FIELDS
+OTHER = "(other)"
+METRICS_FIELDS = 200
+
+_local = threading.local()
+_lock = threading.Lock()
+_metrics = {}
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def elapsed(started):
+    return (time.perf_counter() - started) * 1000
+
+
+class FieldStats(object):
+    __slots__ = ("calls", "ms", "sql", "sql_ms")
+
+    def __init__(self):
+        self.calls = 0
+        self.ms = 0.0
+        self.sql = 0
+        self.sql_ms = 0.0
+
+    def add(self, other):
+        self.calls += other.calls
+        self.ms += other.ms
+        self.sql += other.sql
+        self.sql_ms += other.sql_ms
+
+    def as_dict(self):
+        return {"calls": self.calls, "ms": round(self.ms, 3), "sql": self.sql, "sql_ms": round(self.sql_ms, 3)}
+
+
+class OperationProfile(object):
+    def __init__(self, operation_name):
+        self.operation_name = operation_name or "anonymous"
+        self.fields = defaultdict(FieldStats)
+        self.path = None
+        self.sql = 0
+        self.sql_ms = 0.0
+        self.ms = 0.0
+
+    def execute_sql(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            ms = elapsed(started)
+            stats = self.fields[self.path or OUTSIDE]
+            stats.sql += 1
+            stats.sql_ms += ms
+            self.sql += 1
+            self.sql_ms += ms
+
+    def as_dict(self):
+        slowest = sorted(self.fields.items(), key=lambda item: -item[1].ms)[:LOG_FIELDS]
+        return {
+            "operation": self.operation_name,
+            "ms": round(self.ms, 3),
+            "sql": self.sql,
+            "sql_ms": round(self.sql_ms, 3),
+            "fields": {path: stats.as_dict() for path, stats in slowest},
+            "sql_fields": {path: stats.as_dict() for path, stats in self.fields.items() if stats.sql},
+        }
+
+
+def current_profile():
+    return getattr(_local, "profile", None)
+
+
+@contextmanager
+def field(path):
+    """Attributes the SQL queries run inside the block to ``path``."""
+    profile = current_profile()
+    if profile is None:
+        yield
+        return
+
+    previous, profile.path = profile.path, path
+    try:
+        yield
+    finally:
+        profile.path = previous
+
+
+def query_budget(operation_name):
+    budgets = getattr(settings, "GRAPHQL_QUERY_BUDGETS", {})
+    return budgets.get(operation_name, getattr(settings, "GRAPHQL_QUERY_BUDGET", None))
+
+
+@contextmanager
+def profile_operation(operation_name):
+    profile = OperationProfile(operation_name)
+    _local.profile = profile
+    started = time.perf_counter()
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(profile.execute_sql))
+            yield profile
+    finally:
+        _local.profile = None
+        profile.ms = elapsed(started)
+
+    logger.info(json.dumps(profile.as_dict(), sort_keys=True))
+    record(profile)
+
+    budget = query_budget(profile.operation_name)
+    if budget is not None and profile.sql > budget:
+        message = "GraphQL operation %s ran %d SQL queries, its budget is %d: %s" % (
+            profile.operation_name, profile.sql, budget,
+            ", ".join("%s=%d" % (path, stats.sql) for path, stats in profile.fields.items() if stats.sql),
+        )
+        if getattr(settings, "GRAPHQL_QUERY_BUDGET_STRICT", False):
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+
+
+def record(profile):
+    name = profile.operation_name if profile.operation_name in documents.registered_operations() else OTHER
+    with _lock:
+        metrics = _metrics.get(name)
+        if metrics is None:
+            metrics = _metrics[name] = {
+                "count": 0, "ms": 0.0, "max_ms": 0.0, "sql": 0, "max_sql": 0, "fields": defaultdict(FieldStats),
+            }
+        metrics["count"] += 1
+        metrics["ms"] += profile.ms
+        metrics["max_ms"] = max(metrics["max_ms"], profile.ms)
+        metrics["sql"] += profile.sql
+        metrics["max_sql"] = max(metrics["max_sql"], profile.sql)
+        fields = metrics["fields"]
+        for path, stats in profile.fields.items():
+            if path not in fields and len(fields) >= METRICS_FIELDS:
+                path = OTHER
+            fields[path].add(stats)
+
+
+def metrics():
+    """Totals per operation name since the process started, for the metrics view."""
+    with _lock:
+        return {
+            name: {
+                "count": values["count"],
+                "avg_ms": round(values["ms"] / values["count"], 3),
+                "max_ms": round(values["max_ms"], 3),
+                "avg_sql": round(values["sql"] / values["count"], 2),
+                "max_sql": values["max_sql"],
+                "fields": {path: stats.as_dict() for path, stats in sorted(values["fields"].items())},
+            }
+            for name, values in _metrics.items()
+        }
+
+
+def reset_metrics():
+    with _lock:
+        _metrics.clear()
+
+
+def operation_name(document_ast):
+    """Name of the only operation of a document, if it has one."""
+    operations = [d for d in document_ast.definitions if isinstance(d, ast.OperationDefinition)]
+    if len(operations) == 1 and operations[0].name:
+        return operations[0].name.value
+    return None
+
+
+def field_path(path):
+    return ".".join(str(key) for key in path if not isinstance(key, int))
+
+
+class InstrumentationMiddleware(object):
+    """Graphene middleware timing each resolver of a profiled operation.
+
+    Resolvers returning a promise are timed until the promise is resolved.
+    """
+
+    def resolve(self, next, root, info, **args):
+        profile = current_profile()
+        if profile is None:
+            return next(root, info, **args)
+
+        path = field_path(info.path)
+        started = time.perf_counter()
+        with field(path):
+            result = next(root, info, **args)
+
+        if not Promise.is_thenable(result):
+            self.record(profile, path, started)
+            return result
+
+        def resolved(value):
+            self.record(profile, path, started)
+            return value
+
+        def rejected(error):
+            self.record(profile, path, started)
+            raise error
+
+        return Promise.resolve(result).then(resolved, rejected)
+
+    def record(self, profile, path, started):
+        stats = profile.fields[path]
+        stats.calls += 1
+        stats.ms += elapsed(started)
@@ -0,0 +1,36 @@
+from django.db.models import DecimalField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from registration.models import Booking, Transaction
+
+
+def transaction_sum(field):
+    totals = Transaction.objects.filter(booking=OuterRef("pk")).order_by().values("booking")
+    return Coalesce(
+        Subquery(totals.annotate(total=Sum(field)).values("total"), output_field=DecimalField()),
+        Value(0),
+    )
+
+
+def refresh_balances(queryset):
+    """Recomputes paid, fees and open amount of the bookings in ``queryset``.
+
+    The columns are derived from the transactions with correlated subqueries,
+    so this is two UPDATE statements no matter how many bookings are affected,
+    and a concurrent write can't leave a stale running total behind.
+    """
+    queryset = Booking.objects.filter(pk__in=queryset.values("pk"))
+    queryset.update(paid=transaction_sum("betrag"), fees=transaction_sum("gebuehr"))
+    queryset.update(open_amount=F("amount") - F("paid"))
+
+
+def stale_balances(queryset):
+    """Bookings whose stored balance does not match their transactions."""
+    return queryset.annotate(
+        actual_paid=transaction_sum("betrag"),
+        actual_fees=transaction_sum("gebuehr"),
+    ).exclude(
+        paid=F("actual_paid"),
+        fees=F("actual_fees"),
+        open_amount=F("amount") - F("actual_paid"),
+    )
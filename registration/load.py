@@ -0,0 +1,196 @@
+"""A simulated opening of the registration, against a running server.
+
+Every virtual user does what the registration form does: it loads the events
+(which sets the CSRF cookie), the event, the rates it can book for its date of
+birth, and then books, with a variant of every required product. ``spike`` starts all users at the same moment, like
+when the registration opens, and keeps them registering for a while. The
+users are threads using plain ``http.client`` connections, so the numbers
+are those of the server and not of an HTTP library.
+
+Run the server against a copy of the database: every round creates a booking.
+"""
+import http.client
+import json
+import random
+import statistics
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urlsplit
+
+from registration.models import Day, ProductVariant, Rate
+
+ALL_EVENTS = "query AllEvents { allEvents { edges { node { id name beginDate isOpen } } } }"
+
+EVENT = """
+query Event($id: Int) {
+  event(id: $id) { name
+    arrival { id day } departure { id day }
+    rates { edges { node { label prices { edges { node { price priceDay } } } } } }
+    products { edges { node { name variants { edges { node { name price } } } } } }
+  }
+}
+"""
+
+ELIGIBLE_RATES = """
+query EligibleRates($eventId: Int!, $dateOfBirth: Date!) {
+  eligibleRates(eventId: $eventId, dateOfBirth: $dateOfBirth) { id label remaining }
+}
+"""
+
+CREATE_BOOKING = """
+mutation CreateBooking($input: BookingCreateMutationInput!) {
+  createBooking(input: $input) { code errors { field messages } }
+}
+"""
+
+OPERATIONS = ("allEvents", "event", "eligibleRates", "createBooking")
+
+
+class RequestFailed(Exception):
+    pass
+
+
+class User(object):
+    """One person registering, over a keep-alive connection"""
+
+    def __init__(self, url, timeout=60):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.path = parts.path.rstrip("/") + "/graphql"
+        self.timeout = timeout
+        self.connection = None
+        self.cookies = {}
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {}, Accept="application/json")
+        if self.cookies:
+            headers["Cookie"] = "; ".join("%s=%s" % item for item in self.cookies.items())
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            self.connection.close()
+            self.connection = None
+            raise RequestFailed(repr(e))
+        for header in response.headers.get_all("Set-Cookie") or ():
+            self.cookies.update((name, morsel.value) for name, morsel in SimpleCookie(header).items())
+        if response.status != 200:
+            raise RequestFailed("HTTP %d" % response.status)
+        result = json.loads(data.decode("utf-8"))
+        if result.get("errors"):
+            raise RequestFailed(str(result["errors"])[:200])
+        return result["data"]
+
+    def get(self, query):
+        return self.request("GET", "%s?%s" % (self.path, urlencode({"query": query})))
+
+    def post(self, query, variables):
+        body = json.dumps({"query": query, "variables": variables})
+        return self.request("POST", self.path, body, {
+            "Content-Type": "application/json",
+            "X-CSRFToken": self.cookies.get("csrftoken", ""),
+            "Referer": "http://%s:%d/" % (self.host, self.port),
+        })
+
+
+def booking_input(rng, event, rates, arrivals, departures, required, number):
+    rate = rng.choice(rates)
+    youngest = event.begin_day - timedelta(days=1) if rate.dob_to is None else rate.dob_to
+    oldest = event.begin_day.replace(year=event.begin_day.year - 80) if rate.dob_from is None else rate.dob_from
+    date_of_birth = oldest + timedelta(days=rng.randint(0, (youngest - oldest).days))
+    return {
+        "event": event.pk, "rate": rate.pk, "firstName": "Spike", "lastName": "User %d" % number,
+        "email": "spike%d@example.com" % number, "dateOfBirth": date_of_birth.isoformat(),
+        "arrival": rng.choice(arrivals), "departure": rng.choice(departures),
+        "variants": [rng.choice(variants) for product, variants in sorted(required.items())],
+    }
+
+
+def percentile(timings, share):
+    return timings[min(len(timings) - 1, int(len(timings) * share))]
+
+
+def spike(url, event, users=64, duration=20, seed=1):
+    """Lets ``users`` register at ``event`` at once for ``duration`` seconds, returns the results."""
+    rates = list(Rate.objects.filter(event=event, non_rider=False))
+    arrivals = list(Day.objects.filter(event=event, arrival=True).values_list("pk", flat=True))
+    departures = list(Day.objects.filter(event=event, departure=True).values_list("pk", flat=True))
+    required = {}
+    for product_id, variant_id in ProductVariant.objects.filter(
+            product__event=event, product__required=True).values_list("product_id", "pk"):
+        required.setdefault(product_id, []).append(variant_id)
+    start = threading.Barrier(users + 1)
+    lock = threading.Lock()
+    timings = {operation: [] for operation in OPERATIONS}
+    errors = []
+    counter = iter(range(10 ** 9))
+
+    def register(operation, run):
+        started = time.perf_counter()
+        try:
+            run()
+        except RequestFailed as e:
+            with lock:
+                errors.append("%s: %s" % (operation, e))
+            return False
+        elapsed = (time.perf_counter() - started) * 1000
+        with lock:
+            timings[operation].append(elapsed)
+        return True
+
+    def run_user(index):
+        rng = random.Random(seed * 100000 + index)
+        user = User(url)
+        start.wait()
+        while time.perf_counter() < deadline:
+            with lock:
+                number = next(counter)
+            data = booking_input(rng, event, rates, arrivals, departures, required, number)
+            steps = (
+                ("allEvents", lambda: user.get(ALL_EVENTS)),
+                ("event", lambda: user.post(EVENT, {"id": event.pk})),
+                ("eligibleRates", lambda: user.post(ELIGIBLE_RATES, {"eventId": event.pk,
+                                                                     "dateOfBirth": data["dateOfBirth"]})),
+                ("createBooking", lambda: user.post(CREATE_BOOKING, {"input": data})),
+            )
+            for operation, run in steps:
+                if time.perf_counter() >= deadline or not register(operation, run):
+                    break
+
+    threads = [threading.Thread(target=run_user, args=(i,), daemon=True) for i in range(users)]
+    for thread in threads:
+        thread.start()
+    deadline = time.perf_counter() + duration
+    start.wait()
+    began = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - began
+
+    results = OrderedDict()
+    for operation in OPERATIONS:
+        values = sorted(timings[operation])
+        results[operation] = OrderedDict([
+            ("requests", len(values)),
+            ("median_ms", round(statistics.median(values), 1) if values else None),
+            ("p95_ms", round(percentile(values, 0.95), 1) if values else None),
+            ("p99_ms", round(percentile(values, 0.99), 1) if values else None),
+        ])
+    requests = sum(len(values) for values in timings.values())
+    return OrderedDict([
+        ("url", url),
+        ("users", users),
+        ("seconds", round(elapsed, 1)),
+        ("requests", requests),
+        ("requests_per_s", round(requests / elapsed, 1)),
+        ("bookings_per_s", round(len(timings["createBooking"]) / elapsed, 1)),
+        ("errors", len(errors)),
+        ("first_errors", errors[:5]),
+        ("operations", results),
+    ])
@@ -0,0 +1,49 @@
+from collections import defaultdict
+
+from django.db.models import F
+from promise import Promise
+from promise.dataloader import DataLoader
+
+from .instrumentation import field
+
+
+class RelatedLoader(DataLoader):
+    """Loads a related list for many parents with a single query.
+
+    ``lookup`` is the query path from the child queryset back to the parent,
+    e.g. ``"event"`` for ``Rate.objects`` or ``"rate"`` for the reverse side of
+    the ``Rate.disciplines`` many-to-many relation.
+    """
+
+    def __init__(self, queryset, lookup, name=None):
+        super(RelatedLoader, self).__init__()
+        self.queryset = queryset
+        self.lookup = lookup
+        self.name = name or lookup
+
+    def batch_load_fn(self, keys):
+        rows = self.queryset.filter(**{"%s__in" % self.lookup: keys}).annotate(_loader_key=F(self.lookup))
+
+        grouped = defaultdict(list)
+        with field("loader:%s" % self.name):
+            for obj in rows:
+                grouped[obj._loader_key].append(obj)
+
+        return Promise.resolve([grouped.get(key, []) for key in keys])
+
+
+def get_loader(info, name, queryset, lookup):
+    """Returns the loader ``name`` of the current request, creating it on first use.
+
+    Loaders live on the request so that their cache never outlives it.
+    """
+    context = info.context
+    loaders = getattr(context, "_dataloaders", None)
+    if loaders is None:
+        loaders = {}
+        if context is not None:
+            context._dataloaders = loaders
+
+    if name not in loaders:
+        loaders[name] = RelatedLoader(queryset, lookup, name)
+    return loaders[name]
@@ -0,0 +1,85 @@
+import threading
+import time
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from registration.models import Booking, Event, generate_code
+
+CREATE_BOOKING = """
+mutation($input: BookingCreateMutationInput!) {
+  createBooking(input: $input) { code errors { field messages } }
+}
+"""
+
+
+class Command(BaseCommand):
+    help = "Measures the booking code issue rate under concurrent load"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=8)
+        parser.add_argument("--count", type=int, default=500, help="codes to issue per thread")
+        parser.add_argument(
+            "--event",
+            help="slug of an event to run createBooking mutations against instead of only allocating codes, "
+                 "the bookings are deleted again afterwards",
+        )
+
+    def handle(self, *args, **options):
+        event = None
+        if options["event"]:
+            try:
+                event = Event.objects.get(slug=options["event"])
+            except Event.DoesNotExist:
+                raise CommandError("Event '%s' does not exist" % options["event"])
+
+        codes, errors = [], []
+        start = threading.Barrier(options["threads"] + 1)
+        issue = self.create_booking if event else lambda event, number: generate_code()
+
+        def worker(number):
+            start.wait()
+            try:
+                for i in range(options["count"]):
+                    try:
+                        codes.append(issue(event, number * options["count"] + i))
+                    except Exception as e:
+                        errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(options["threads"])]
+        for thread in threads:
+            thread.start()
+        start.wait()
+        began = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - began
+
+        if event:
+            Booking.objects.filter(code__in=codes).delete()
+
+        self.stdout.write("%d codes issued by %d threads in %.3fs (%.0f codes/s)" % (
+            len(codes), options["threads"], elapsed, len(codes) / elapsed))
+        self.stdout.write("duplicates: %d, errors: %d" % (len(codes) - len(set(codes)), len(errors)))
+        for error in errors[:5]:
+            self.stderr.write(repr(error))
+
+    def create_booking(self, event, number):
+        from registration.schema import schema
+
+        result = schema.execute(CREATE_BOOKING, variables={"input": {
+            "event": event.pk,
+            "firstName": "Benchmark",
+            "lastName": str(number),
+            "email": "benchmark@example.com",
+            "dateOfBirth": date(2000, 1, 1).isoformat(),
+        }})
+        if result.errors:
+            raise result.errors[0]
+        payload = result.data["createBooking"]
+        if payload["errors"]:
+            raise CommandError(payload["errors"])
+        return payload["code"]
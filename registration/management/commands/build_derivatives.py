@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from registration.graphql_cache import bump_version
+from registration.images import build, page_images
+from registration.models import Event, WebPage
+
+
+class Command(BaseCommand):
+    help = "Builds the resized copies of all event logos and images on pages that don't have them yet"
+
+    def handle(self, *args, **options):
+        sources = {}
+        for pk, logo in Event.objects.exclude(logo="").exclude(logo__isnull=True).values_list("pk", "logo"):
+            sources.setdefault(logo, set()).add(pk)
+        for event_id, html in WebPage.objects.values_list("event_id", "html"):
+            for name in page_images(html):
+                sources.setdefault(name, set()).add(event_id)
+
+        built = 0
+        for name, event_ids in sorted(sources.items()):
+            try:
+                changed = build(name)
+            except (OSError, ValueError) as e:
+                self.stderr.write("%s: %s" % (name, e))
+                continue
+            if changed:
+                built += 1
+                for event_id in event_ids:
+                    bump_version(event_id)
+        self.stdout.write("Built derivatives of %d of %d images" % (built, len(sources)))
@@ -0,0 +1,37 @@
+import sqlite3
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from registration.routing import DEFAULT, REPLICA
+
+
+class Command(BaseCommand):
+    help = "Copies the SQLite database to the replica, to try read replicas locally (see registration.routing)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--every", type=float,
+                            help="keep copying, every this many seconds, like a replica lagging behind")
+
+    def handle(self, *args, **options):
+        if REPLICA not in connections.databases:
+            raise CommandError("There is no replica database, set DATABASE_REPLICA")
+        databases = [connections.databases[alias] for alias in (DEFAULT, REPLICA)]
+        if any(database["ENGINE"] != "django.db.backends.sqlite3" for database in databases):
+            raise CommandError("Only SQLite databases can be copied, other databases replicate themselves")
+
+        while True:
+            started = time.perf_counter()
+            source, target = (sqlite3.connect(database["NAME"]) for database in databases)
+            try:
+                # a consistent snapshot, even while the primary is written to
+                source.backup(target)
+            finally:
+                source.close()
+                target.close()
+            self.stdout.write("Copied %s to %s in %.0fms" % (
+                databases[0]["NAME"], databases[1]["NAME"], (time.perf_counter() - started) * 1000))
+            if not options["every"]:
+                return
+            time.sleep(options["every"])
@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from registration import synthetic
+from registration.benchmarks import benchmark_user
+from registration.models import Transaction
+
+
+class Command(BaseCommand):
+    help = "Creates synthetic events with bookings and payments, e.g. for run_benchmarks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--events", type=int, default=1)
+        parser.add_argument("--bookings", type=int, default=10000, help="bookings per event")
+        parser.add_argument("--paid", type=float, default=0.7, help="share of the bookings with a payment")
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--delete", action="store_true", help="delete the synthetic events created before")
+
+    def handle(self, *args, **options):
+        if options["delete"]:
+            deleted, counts = synthetic.delete_all()
+            self.stdout.write("Deleted %d synthetic rows" % deleted)
+
+        started = time.perf_counter()
+        transactions = Transaction.objects.count()
+        events = synthetic.generate(
+            benchmark_user(), events=options["events"], bookings=options["bookings"],
+            transactions=options["paid"], seed=options["seed"],
+        )
+        self.stdout.write("Created %s with %d bookings each and %d transactions in %.1fs" % (
+            ", ".join(event.slug for event in events), options["bookings"],
+            Transaction.objects.count() - transactions, time.perf_counter() - started,
+        ))
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from registration.models import Booking, Event
+from registration.statements import import_statement, parse_camt053, parse_paypal_csv
+
+FORMATS = {
+    "camt": (parse_camt053, "wire"),
+    "paypal": (parse_paypal_csv, "paypal"),
+}
+
+
+class Command(BaseCommand):
+    help = "Imports the payments of a CAMT.053 bank statement or a PayPal CSV export as transactions"
+
+    def add_arguments(self, parser):
+        parser.add_argument("file")
+        parser.add_argument("--format", choices=FORMATS, help="guessed from the file extension if omitted")
+        parser.add_argument("--event", help="slug of the event, only its bookings are matched")
+        parser.add_argument("--dry-run", action="store_true", help="only show what would be imported")
+
+    def handle(self, *args, **options):
+        name = options["format"] or ("paypal" if options["file"].lower().endswith(".csv") else "camt")
+        parse, mittel = FORMATS[name]
+
+        bookings = Booking.objects.all()
+        if options["event"]:
+            try:
+                bookings = bookings.filter(event=Event.objects.get(slug=options["event"]))
+            except Event.DoesNotExist:
+                raise CommandError("Event '%s' does not exist" % options["event"])
+
+        with open(options["file"], "rb") as f:
+            try:
+                result = import_statement(parse(f), mittel, bookings, dry_run=options["dry_run"])
+            except ValueError as e:
+                raise CommandError(str(e))
+
+        for line in result.unmatched:
+            self.stdout.write("unmatched: %s %s %s %s" % (line.datum.date(), line.betrag, line.name, line.text[:60]))
+
+        methods = {}
+        for match in result.imported:
+            methods[match.method] = methods.get(match.method, 0) + 1
+        self.stdout.write("%d transactions %s (%s), %d already imported, %d unmatched" % (
+            len(result.imported), "would be imported" if options["dry_run"] else "imported",
+            ", ".join("%d by %s" % (count, method) for method, count in sorted(methods.items())) or "-",
+            result.duplicates, len(result.unmatched),
+        ))
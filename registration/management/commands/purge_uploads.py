@@ -0,0 +1,31 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from registration import uploads
+from registration.models import Upload
+
+
+class Command(BaseCommand):
+    help = "Removes chunked uploads that weren't continued for a while, together with their partial files, " \
+           "and stored files no attachment refers to any more"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=7, help="remove uploads not continued for this many days")
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options["days"])
+        stale = Upload.objects.filter(updated__lt=before)
+        count = 0
+        for upload in stale.iterator():
+            uploads.discard(upload)
+            count += 1
+        self.stdout.write("Removed %d uploads" % count)
+
+        # only old files, an upload completing right now stores its file before attaching it
+        count = 0
+        for name in list(uploads.unused_blobs(before)):
+            uploads.remove_unused(name)
+            count += 1
+        self.stdout.write("Removed %d unused files" % count)
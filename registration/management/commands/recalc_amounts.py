@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from registration.models import Booking, Event
+from registration.pricing import update_amounts
+
+
+class Command(BaseCommand):
+    help = "Recomputes the amount of every booking of an event"
+
+    def add_arguments(self, parser):
+        parser.add_argument("event", help="slug of the event")
+
+    def handle(self, *args, **options):
+        try:
+            event = Event.objects.get(slug=options["event"])
+        except Event.DoesNotExist:
+            raise CommandError("Event '%s' does not exist" % options["event"])
+
+        result = update_amounts(Booking.objects.filter(event=event))
+        self.stdout.write("%d of %d bookings of %s repriced" % (result.changed, result.checked, event))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from registration.ledger import refresh_balances, stale_balances
+from registration.models import Booking, Event
+
+
+class Command(BaseCommand):
+    help = "Checks the stored paid, fees and open amounts of the bookings against their transactions"
+
+    def add_arguments(self, parser):
+        parser.add_argument("event", nargs="?", help="slug of the event, all events if omitted")
+        parser.add_argument("--fix", action="store_true", help="recompute the balances that are off")
+
+    def handle(self, *args, **options):
+        bookings = Booking.objects.all()
+        if options["event"]:
+            try:
+                bookings = bookings.filter(event=Event.objects.get(slug=options["event"]))
+            except Event.DoesNotExist:
+                raise CommandError("Event '%s' does not exist" % options["event"])
+
+        stale = stale_balances(bookings).order_by("pk")
+        count = 0
+        for booking in stale.iterator():
+            count += 1
+            self.stdout.write("%s: paid %s (should be %s), fees %s (should be %s), open %s (should be %s)" % (
+                booking.code, booking.paid, booking.actual_paid, booking.fees, booking.actual_fees,
+                booking.open_amount, booking.amount - booking.actual_paid,
+            ))
+
+        if count and options["fix"]:
+            refresh_balances(stale)
+            self.stdout.write("%d balances fixed" % count)
+        else:
+            self.stdout.write("%d balances off" % count)
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from graphql.error import GraphQLSyntaxError
+from graphql.language.parser import parse
+from graphql.validation import validate
+
+from registration.documents import bump_registry_version, query_hash
+from registration.models import PersistedQuery
+from unicycle_events.schema import schema
+
+
+class Command(BaseCommand):
+    help = "Registers the GraphQL queries of the frontend as persisted queries, one query document per file"
+
+    def add_arguments(self, parser):
+        parser.add_argument("files", nargs="+", help=".graphql files")
+        parser.add_argument("--replace", action="store_true", help="remove registered queries not given")
+
+    def handle(self, *args, **options):
+        queries = {}
+        for path in options["files"]:
+            with open(path, encoding="utf-8") as f:
+                query = f.read()
+
+            # only validated, running a mutation at deploy time would write data
+            try:
+                errors = validate(schema, parse(query))
+            except GraphQLSyntaxError as e:
+                errors = [e]
+            if errors:
+                raise CommandError("%s: %s" % (path, "; ".join(str(e) for e in errors)))
+            queries[query_hash(query)] = (path, query)
+
+        with transaction.atomic():
+            for sha256, (path, query) in queries.items():
+                PersistedQuery.objects.update_or_create(sha256=sha256, defaults={"name": path, "query": query})
+            if options["replace"]:
+                PersistedQuery.objects.exclude(sha256__in=queries).delete()
+        # running processes still have the queries registered before
+        bump_registry_version()
+
+        for sha256, (path, query) in sorted(queries.items(), key=lambda item: item[1][0]):
+            self.stdout.write("%s %s" % (sha256, path))
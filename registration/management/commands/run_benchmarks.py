@@ -0,0 +1,49 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+
+from registration import benchmarks, synthetic
+from registration.models import Event
+
+
+class Command(BaseCommand):
+    help = "Measures latency and query counts of the GraphQL API, the booking admin and the exports"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--event", help="slug of the event to use, by default the largest synthetic event")
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--only", nargs="*", help="run the benchmarks whose name contains one of these")
+        parser.add_argument("--output", help="write the results as JSON to this file")
+        parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+        parser.add_argument("--threshold", type=float, default=1.2,
+                            help="slowdown of the median that counts as a regression")
+
+    def handle(self, *args, **options):
+        if options["event"]:
+            event = Event.objects.filter(slug=options["event"]).first()
+        else:
+            event = Event.objects.filter(slug__startswith=synthetic.SLUG_PREFIX) \
+                .annotate(bookings=Count("booking")).order_by("-bookings").first()
+        if event is None:
+            raise CommandError("No event to benchmark, create one with generate_data")
+
+        results = benchmarks.run(event, benchmarks.benchmark_user(), repeat=options["repeat"], only=options["only"])
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(results, f, indent=2)
+
+        self.stdout.write("%(event)s: %(bookings)d bookings (%(all_bookings)d in total)" % results["data"])
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                lines, regressed = benchmarks.compare(json.load(f), results, options["threshold"])
+            for line in lines:
+                self.stdout.write(line)
+            if regressed:
+                raise CommandError("Some benchmarks regressed")
+            return
+
+        for name, result in results["results"].items():
+            self.stdout.write("%-34s median %9.1fms  p95 %9.1fms  %5d queries" % (
+                name, result["median_ms"], result["p95_ms"], result["queries"]))
+
@@ -0,0 +1,43 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+
+from registration import load, synthetic
+from registration.models import Event
+
+
+class Command(BaseCommand):
+    help = "Simulates the opening of the registration against a running server, see registration.load"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://127.0.0.1:8000", help="where the server listens")
+        parser.add_argument("--event", help="slug of the event to register for, by default the largest synthetic event")
+        parser.add_argument("--users", type=int, default=64, help="number of people registering at once")
+        parser.add_argument("--duration", type=int, default=20, help="seconds")
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--output", help="write the results as JSON to this file")
+
+    def handle(self, *args, **options):
+        if options["event"]:
+            event = Event.objects.filter(slug=options["event"]).first()
+        else:
+            event = Event.objects.filter(slug__startswith=synthetic.SLUG_PREFIX) \
+                .annotate(bookings=Count("booking")).order_by("-bookings").first()
+        if event is None:
+            raise CommandError("No event to register for, create one with generate_data")
+
+        results = load.spike(options["url"], event, users=options["users"], duration=options["duration"],
+                             seed=options["seed"])
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(results, f, indent=2)
+
+        self.stdout.write("%(users)d users, %(seconds).1fs: %(requests_per_s).1f requests/s, "
+                          "%(bookings_per_s).1f bookings/s, %(errors)d errors" % results)
+        for error in results["first_errors"]:
+            self.stdout.write("  " + error)
+        for operation, result in results["operations"].items():
+            if result["requests"]:
+                self.stdout.write("%-14s %6d requests  median %8.1fms  p95 %8.1fms  p99 %8.1fms" % (
+                    operation, result["requests"], result["median_ms"], result["p95_ms"], result["p99_ms"]))
@@ -0,0 +1,92 @@
+import hashlib
+import hmac
+import threading
+import time
+import uuid
+from collections import Counter
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from registration.models import Booking, Event
+from registration.payments import SIGNATURE_HEADER
+
+
+class Command(BaseCommand):
+    help = "Stands in for PayPal: sends signed payment notifications for the open bookings of an event to the webhook"
+
+    def add_arguments(self, parser):
+        parser.add_argument("event", help="slug of the event")
+        parser.add_argument("--url", default="http://localhost:8000/payments/paypal")
+        parser.add_argument("--threads", type=int, default=16)
+        parser.add_argument("--count", type=int, default=1000, help="notifications to send")
+        parser.add_argument("--resend", type=float, default=0.1, help="share of notifications sent twice")
+
+    def handle(self, *args, **options):
+        secret = getattr(settings, "PAYMENT_WEBHOOK_SECRET", None)
+        if not secret:
+            raise CommandError("PAYMENT_WEBHOOK_SECRET is not set")
+        try:
+            event = Event.objects.get(slug=options["event"])
+        except Event.DoesNotExist:
+            raise CommandError("Event '%s' does not exist" % options["event"])
+
+        bookings = list(Booking.objects.filter(event=event, open_amount__gt=0)
+                        .values_list("code", "open_amount", "first_name", "last_name")[:options["count"]])
+        connection.close()
+        if not bookings:
+            raise CommandError("The event has no open bookings")
+
+        bodies = []
+        for i in range(options["count"]):
+            code, amount, first_name, last_name = bookings[i % len(bookings)]
+            bodies.append(urlencode({
+                "txn_id": uuid.uuid4().hex[:17].upper(), "payment_status": "Completed", "custom": code,
+                "mc_gross": str(amount), "mc_fee": "0.59", "first_name": first_name, "last_name": last_name,
+                "payment_date": time.strftime("%H:%M:%S %b %d, %Y PST"),
+            }).encode())
+        bodies += bodies[:int(len(bodies) * options["resend"])]
+
+        header = SIGNATURE_HEADER[len("HTTP_"):].replace("_", "-").title()
+        statuses, latencies, lock = Counter(), [], threading.Lock()
+
+        def send(body):
+            request = Request(options["url"], data=body, headers={
+                header: hmac.new(secret.encode(), body, hashlib.sha256).hexdigest(),
+                "Content-Type": "application/x-www-form-urlencoded",
+            })
+            started = time.perf_counter()
+            try:
+                with urlopen(request) as response:
+                    status = response.status
+            except HTTPError as e:
+                status = e.code
+            except OSError:
+                # e.g. connections the server refused or reset under load
+                status = "error"
+            with lock:
+                statuses[status] += 1
+                latencies.append(time.perf_counter() - started)
+
+        def worker(number):
+            for body in bodies[number::options["threads"]]:
+                send(body)
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(options["threads"])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        self.stdout.write("%d notifications in %.2fs (%.0f/s), median %.1fms, p99 %.1fms, responses: %s" % (
+            len(bodies), elapsed, len(bodies) / elapsed,
+            latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000,
+            ", ".join("%s: %d" % item for item in sorted(statuses.items(), key=str)),
+        ))
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.5 on 2026-10-17 14:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0005_booking_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='booking',
+            name='variants',
+            field=models.ManyToManyField(blank=True, to='registration.ProductVariant', verbose_name='products'),
+        ),
+    ]
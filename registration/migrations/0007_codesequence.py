@@ -0,0 +1,22 @@
+# Generated by Django 3.0.5 on 2026-10-17 14:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0006_booking_variants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CodeSequence',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=30, unique=True)),
+                ('key', models.CharField(max_length=64)),
+                ('next_value', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 3.0.5 on 2026-10-17 14:27
+
+from django.db import migrations, models
+from django.db.models import DecimalField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_balances(apps, schema_editor):
+    Booking = apps.get_model("registration", "Booking")
+    Transaction = apps.get_model("registration", "Transaction")
+
+    def transaction_sum(field):
+        totals = Transaction.objects.filter(booking=OuterRef("pk")).order_by().values("booking")
+        return Coalesce(
+            Subquery(totals.annotate(total=Sum(field)).values("total"), output_field=DecimalField()),
+            Value(0),
+        )
+
+    Booking.objects.update(paid=transaction_sum("betrag"), fees=transaction_sum("gebuehr"))
+    Booking.objects.update(open_amount=F("amount") - F("paid"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0007_codesequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='booking',
+            name='fees',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=8, verbose_name='fees'),
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='open_amount',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=8, verbose_name='open'),
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='paid',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=8, verbose_name='paid'),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['event', 'open_amount'], name='booking_event_open_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['event', 'paid'], name='booking_event_paid_idx'),
+        ),
+        migrations.RunPython(fill_balances, migrations.RunPython.noop),
+    ]
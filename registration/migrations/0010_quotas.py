@@ -0,0 +1,50 @@
+# Generated by Django 3.0.5 on 2026-10-17 14:40
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def count_booked(apps, schema_editor):
+    Booking = apps.get_model("registration", "Booking")
+    Rate = apps.get_model("registration", "Rate")
+    ProductVariant = apps.get_model("registration", "ProductVariant")
+
+    def booked(**lookup):
+        bookings = Booking.objects.exclude(state="canceled").filter(**lookup).order_by()
+        counts = bookings.values(*lookup).annotate(count=Count("pk")).values("count")
+        return Coalesce(Subquery(counts, output_field=IntegerField()), Value(0))
+
+    Rate.objects.update(booked=booked(rate=OuterRef("pk")))
+    ProductVariant.objects.update(booked=booked(variants=OuterRef("pk")))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0009_persistedquery'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productvariant',
+            name='booked',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='booked'),
+        ),
+        migrations.AddField(
+            model_name='productvariant',
+            name='capacity',
+            field=models.PositiveIntegerField(blank=True, help_text='Number of places, unlimited if left empty', null=True, verbose_name='capacity'),
+        ),
+        migrations.AddField(
+            model_name='rate',
+            name='booked',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='booked'),
+        ),
+        migrations.AddField(
+            model_name='rate',
+            name='capacity',
+            field=models.PositiveIntegerField(blank=True, help_text='Number of places, unlimited if left empty', null=True, verbose_name='capacity'),
+        ),
+        migrations.RunPython(count_booked, migrations.RunPython.noop),
+    ]
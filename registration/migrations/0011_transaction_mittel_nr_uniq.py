@@ -0,0 +1,32 @@
+# Generated by Django 3.0.5 on 2026-10-17 14:56
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def number_duplicates(apps, schema_editor):
+    # the oldest transaction keeps its nr, the others get their id appended
+    Transaction = apps.get_model("registration", "Transaction")
+    duplicates = Transaction.objects.exclude(nr="").order_by().values("mittel", "nr") \
+        .annotate(count=Count("pk")).filter(count__gt=1)
+    for duplicate in duplicates:
+        transactions = Transaction.objects.filter(mittel=duplicate["mittel"], nr=duplicate["nr"]).order_by("pk")
+        for transaction in transactions[1:]:
+            suffix = "#%d" % transaction.pk
+            transaction.nr = transaction.nr[:255 - len(suffix)] + suffix
+            transaction.save(update_fields=["nr"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0010_quotas'),
+    ]
+
+    operations = [
+        migrations.RunPython(number_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='transaction',
+            constraint=models.UniqueConstraint(condition=models.Q(_negated=True, nr=''), fields=('mittel', 'nr'), name='transaction_mittel_nr_uniq'),
+        ),
+    ]
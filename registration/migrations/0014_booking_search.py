@@ -0,0 +1,49 @@
+# Full-text index of the bookings, see registration.search
+
+from django.db import migrations
+
+COLUMNS = "code, first_name, last_name, club"
+
+CREATE = [
+    "CREATE VIRTUAL TABLE registration_booking_search USING fts5("
+    + COLUMNS + ", tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "INSERT INTO registration_booking_search(rowid, " + COLUMNS + ") "
+    "SELECT id, code, first_name, last_name, club FROM registration_booking",
+    "CREATE TRIGGER registration_booking_search_insert AFTER INSERT ON registration_booking BEGIN "
+    "INSERT INTO registration_booking_search(rowid, " + COLUMNS + ") "
+    "VALUES (new.id, new.code, new.first_name, new.last_name, new.club); END",
+    "CREATE TRIGGER registration_booking_search_update "
+    "AFTER UPDATE OF " + COLUMNS + " ON registration_booking BEGIN "
+    "UPDATE registration_booking_search SET code = new.code, first_name = new.first_name, "
+    "last_name = new.last_name, club = new.club WHERE rowid = old.id; END",
+    "CREATE TRIGGER registration_booking_search_delete AFTER DELETE ON registration_booking BEGIN "
+    "DELETE FROM registration_booking_search WHERE rowid = old.id; END",
+]
+
+DROP = [
+    "DROP TRIGGER IF EXISTS registration_booking_search_insert",
+    "DROP TRIGGER IF EXISTS registration_booking_search_update",
+    "DROP TRIGGER IF EXISTS registration_booking_search_delete",
+    "DROP TABLE IF EXISTS registration_booking_search",
+]
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        # other databases search with LIKE, see registration.search
+        if schema_editor.connection.vendor != "sqlite":
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0013_imagederivative'),
+    ]
+
+    operations = [
+        migrations.RunPython(run(CREATE), run(DROP)),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.0.5 on 2026-10-17 15:13
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def fill_begin_day(apps, schema_editor):
+    Event = apps.get_model('registration', 'Event')
+    for event in Event.objects.all():
+        event.begin_day = timezone.localtime(event.begin_date).date()
+        event.save(update_fields=['begin_day'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0014_booking_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='begin_day',
+            field=models.DateField(editable=False, null=True),
+        ),
+        migrations.RunPython(fill_begin_day, migrations.RunPython.noop),
+    ]
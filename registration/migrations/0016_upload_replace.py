@@ -0,0 +1,18 @@
+# Generated by Django 3.0.5 on 2026-10-17 16:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0015_event_begin_day'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upload',
+            name='replace',
+            field=models.BooleanField(default=False, help_text='Replaces the document if it was uploaded before'),
+        ),
+    ]
@@ -1,7 +1,11 @@
 # +-+ coding: utf-8 +-+
-from django.db import models
-import random
-import string
+import hashlib
+import os
+from collections import Counter
+
+from django.db import models, transaction
+from django.db.models import BooleanField, Case, CharField, ExpressionWrapper, F, IntegerField, Q, Sum, Value, When
+from django.db.models.functions import Cast, Replace, TruncDate
 from django.utils import timezone
 from django.urls import reverse
 from django.utils.http import urlencode
@@ -35,11 +39,42 @@ GESCHLECHT_CHOICES = (
 )
 
 
+def local_day(value):
+    return timezone.localtime(value).date() if value else None
+
+
+class EventQuerySet(models.QuerySet):
+    """Sets begin_day on bulk writes, which neither call Event.save nor send pre_save"""
+
+    def update(self, **kwargs):
+        if "begin_date" in kwargs and "begin_day" not in kwargs:
+            value = kwargs["begin_date"]
+            kwargs["begin_day"] = TruncDate(value) if hasattr(value, "resolve_expression") else local_day(value)
+        return super(EventQuerySet, self).update(**kwargs)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for event in objs:
+            event.begin_day = local_day(event.begin_date)
+        return super(EventQuerySet, self).bulk_create(objs, *args, **kwargs)
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        if "begin_date" in fields:
+            objs = list(objs)
+            for event in objs:
+                event.begin_day = local_day(event.begin_date)
+            fields = list(fields) + ["begin_day"]
+        return super(EventQuerySet, self).bulk_update(objs, fields, *args, **kwargs)
+
+
 class Event(models.Model):
     name = models.CharField(max_length=100)
     slug = models.SlugField(_("short name"), help_text=_("Short name for the URL, only use alphanumeric characters and dashes, e.g. 'arizona-muni-event-2021'"), unique=True)
     begin_date = models.DateTimeField(_("begin date"))
     end_date = models.DateTimeField(_("end date"))
+    # local date of begin_date, kept in step by EventQuerySet and a pre_save handler,
+    # for ages computed by the database (BookingQuerySet.with_age)
+    begin_day = models.DateField(editable=False, null=True)
     description = models.TextField(_("description"))
     logo = models.ImageField(_("logo"), upload_to="logos", blank=True, null=True)
     is_open = models.BooleanField(default=True, help_text=_("Registration is currently open"))
@@ -97,6 +132,8 @@ class Event(models.Model):
 
     admin = models.ForeignKey("auth.User", on_delete=models.CASCADE, help_text="Dieser Benutzer kann das Event verwalten")
 
+    objects = EventQuerySet.as_manager()
+
     def get_absolute_url(self):
         return reverse("convention:seite", args=[self.slug])
 
@@ -122,7 +159,24 @@ class Event(models.Model):
         ordering = ("-begin_date", "-end_date")  
 
 
-class Rate(models.Model):
+class Quota(models.Model):
+    """Limited number of places, taken and released by registration.quotas"""
+    capacity = models.PositiveIntegerField(_("capacity"), null=True, blank=True, help_text=_("Number of places, unlimited if left empty"))
+    booked = models.PositiveIntegerField(_("booked"), default=0, editable=False)
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        # booked is only changed with atomic updates, never write back the value loaded with the object
+        if not self._state.adding and not kwargs.get("force_insert") and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.concrete_fields if not field.primary_key and field.name != "booked"
+            ]
+        super(Quota, self).save(*args, **kwargs)
+
+
+class Rate(Quota):
     event = models.ForeignKey("Event", related_name="rates", on_delete=models.CASCADE)
     label = models.CharField(max_length=100)
 
@@ -196,7 +250,7 @@ class Product(models.Model):
         return self.name
 
 
-class ProductVariant(models.Model):
+class ProductVariant(Quota):
     product = models.ForeignKey("Product", on_delete=models.CASCADE, related_name="variants")
     name = models.CharField(_("name"), max_length=100)
     price = models.DecimalField(_("price"), max_digits=8, decimal_places=2)
@@ -228,7 +282,14 @@ class Document(models.Model):
         ordering = ("order", "name")
 
 
+def blob_name(sha256):
+    """Attachment files are stored by their content, each distinct file only once."""
+    return "blobs/%s/%s/%s" % (sha256[:2], sha256[2:4], sha256)
+
+
 def anhang_path(instance, filename):
+    if instance.sha256:
+        return blob_name(instance.sha256)
     return "attachments/%s/%s" % (instance.booking.code, filename)
 
 
@@ -236,14 +297,53 @@ class Attachment(models.Model):
     booking = models.ForeignKey("Booking", on_delete=models.CASCADE)
     document = models.ForeignKey("Document", on_delete=models.CASCADE)
     file = models.FileField(upload_to=anhang_path)
+    filename = models.CharField(_("file name"), max_length=255, blank=True)
+    sha256 = models.CharField(max_length=64, blank=True, db_index=True, editable=False)
     date = models.DateTimeField(auto_now=True)
 
+    def __str__(self):
+        return self.filename or os.path.basename(self.file.name)
+
+    def save(self, *args, **kwargs):
+        if self.file and not self.file._committed:
+            # uploaded in one piece, e.g. in the admin
+            digest = hashlib.sha256()
+            for chunk in self.file.chunks():
+                digest.update(chunk)
+            self.sha256 = digest.hexdigest()
+            self.filename = os.path.basename(self.file.name)
+            if self.file.storage.exists(blob_name(self.sha256)):
+                self.file.name = blob_name(self.sha256)
+                self.file._committed = True
+        super(Attachment, self).save(*args, **kwargs)
+
     class Meta:
         unique_together = ("booking", "document")
         verbose_name = _("attachment")
         verbose_name_plural = _("attachments")
 
 
+class Upload(models.Model):
+    """An attachment uploaded in chunks that isn't complete yet, see registration.uploads"""
+    token = models.CharField(max_length=64, unique=True, editable=False)
+    booking = models.ForeignKey("Booking", on_delete=models.CASCADE)
+    document = models.ForeignKey("Document", on_delete=models.CASCADE, related_name="uploads")
+    filename = models.CharField(_("file name"), max_length=255)
+    size = models.BigIntegerField(_("size"))
+    offset = models.BigIntegerField(default=0)
+    sha256 = models.CharField(max_length=64, blank=True, help_text="Expected hash of the file, if known")
+    replace = models.BooleanField(default=False, help_text="Replaces the document if it was uploaded before")
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "%s (%d/%d)" % (self.filename, self.offset, self.size)
+
+    class Meta:
+        verbose_name = _("upload")
+        verbose_name_plural = _("uploads")
+
+
 class Day(models.Model):
     event = models.ForeignKey("event", on_delete=models.CASCADE, related_name="days")
     day = models.CharField("Tag", max_length=100)
@@ -293,8 +393,86 @@ class WebPage(models.Model):
         ordering = ("order",)
 
 
+class ImageDerivative(models.Model):
+    """A resized copy of an uploaded image, see registration.images"""
+    source = models.CharField(max_length=255, db_index=True, help_text="Storage name of the original")
+    sha256 = models.CharField(max_length=64, db_index=True, help_text="Hash of the original")
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    format = models.CharField(max_length=10)
+    file = models.CharField(max_length=255)
+
+    def __str__(self):
+        return self.file
+
+    class Meta:
+        unique_together = ("source", "width", "format")
+
+class CodeSequence(models.Model):
+    """Counter and secret key the booking codes are derived from, see registration.codes"""
+    name = models.CharField(max_length=30, unique=True)
+    key = models.CharField(max_length=64)
+    next_value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return self.name
+
+
+class PersistedQuery(models.Model):
+    """GraphQL query clients may refer to by its hash, see registration.documents"""
+    sha256 = models.CharField(max_length=64, unique=True)
+    name = models.CharField(_("name"), max_length=100, blank=True)
+    query = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name or self.sha256
+
+
 def generate_code():
-    return "".join(random.choice(string.ascii_lowercase+string.digits) for i in range(8))
+    from registration.codes import next_code
+    return next_code()
+
+
+# (label, minimum age at the beginning of the event), oldest first
+AGE_BANDS = (
+    ("50+", 50),
+    ("30-49", 30),
+    ("18-29", 18),
+    ("12-17", 12),
+    ("<12", 0),
+)
+FULL_AGE = 18
+
+
+def date_number(field):
+    # 2021-07-01 -> 20210701, with the database's own string functions: SQLite's
+    # date extraction runs Python code for every row
+    return Cast(Replace(Cast(field, CharField()), Value("-"), Value("")), IntegerField())
+
+
+class BookingQuerySet(models.QuerySet):
+    def with_age(self):
+        """Annotates the age at the beginning of the event, whether that's under 18 and the age band.
+
+        The age is the number of full years between the dates as numbers
+        like 20210701, divided by 10000, the same as ``Booking.age().years``.
+        """
+        age = ExpressionWrapper(
+            (date_number("event__begin_day") - date_number("date_of_birth")) / 10000,
+            output_field=IntegerField(),
+        )
+        return self.annotate(age_at_start=age).annotate(
+            # both stay NULL if the age is unknown, e.g. without a begin_day
+            is_minor=Case(When(age_at_start__lt=FULL_AGE, then=Value(True)),
+                          When(age_at_start__gte=FULL_AGE, then=Value(False)),
+                          default=None, output_field=BooleanField()),
+            age_band=Case(*[When(age_at_start__gte=minimum, then=Value(label)) for label, minimum in AGE_BANDS],
+                          default=None, output_field=CharField()),
+        )
+
+
+BALANCE_FIELDS = ("paid", "fees", "open_amount")
 
 
 class Booking(models.Model):
@@ -322,32 +500,70 @@ class Booking(models.Model):
     departure = models.ForeignKey("Day", null=True, blank=True, on_delete=models.SET_NULL, verbose_name=_("departure"), related_name="booking_departure")
     rate = models.ForeignKey("Rate", null=True, blank=True, on_delete=models.SET_NULL)
     disciplines = models.ManyToManyField("Discipline", blank=True)
+    variants = models.ManyToManyField("ProductVariant", blank=True, verbose_name=_("products"))
 
     notes = models.TextField(_("notes"), blank=True)
 
     amount = models.DecimalField(_("amount"), editable=False, max_digits=8, decimal_places=2, default=0, help_text="Gesamter vom Teilnehmer zu zahlender Betrag. Wird automatisch berechnet.")
+
+    # maintained from the transactions by registration.ledger
+    paid = models.DecimalField(_("paid"), editable=False, max_digits=8, decimal_places=2, default=0)
+    fees = models.DecimalField(_("fees"), editable=False, max_digits=8, decimal_places=2, default=0)
+    open_amount = models.DecimalField(_("open"), editable=False, max_digits=8, decimal_places=2, default=0)
     state = models.CharField(_("state"), max_length=15, choices=STATUS_CHOICES, default="open")
 
     internal_notes = models.TextField(_("internal notes"), blank=True)
 
+    objects = BookingQuerySet.as_manager()
+
     def get_absolute_url(self):
         return reverse("convention:show-booking", args=[self.event.slug]) + "?" + urlencode({ "code": self.code, "email": self.email })
 
     def calc_betrag(self):
-        betrag = 0
+        from registration.pricing import PriceTimeline, booking_date
+
+        timeline = PriceTimeline(self.event_id)
+        betrag = timeline.amount(self.rate_id, booking_date(self.date), self.arrival_id, self.departure_id)
 
-        # TODO: Calculate amount
+        if self.pk:
+            betrag += self.variants.aggregate(total=Sum("price"))["total"] or 0
 
         return betrag
 
+    def save(self, *args, **kwargs):
+        from registration.quotas import CANCELED, move, places
+
+        self.amount = self.calc_betrag()
+        if not self._state.adding and not kwargs.get("force_insert"):
+            # the balances are only changed by registration.ledger, never write back the values loaded with the object
+            fields = kwargs.get("update_fields")
+            if fields is None:
+                fields = [field.name for field in self._meta.concrete_fields if not field.primary_key]
+            kwargs["update_fields"] = [field for field in fields if field not in BALANCE_FIELDS]
+        else:
+            self.open_amount = self.amount - self.paid
+
+        saved = Booking.objects.filter(pk=self.pk).values_list("rate_id", "state").first() if self.pk else None
+        variant_ids = list(self.variants.values_list("pk", flat=True)) if saved else []
+        old = places(saved[0], variant_ids) if saved and saved[1] != CANCELED else Counter()
+        new = places(self.rate_id, variant_ids) if self.state != CANCELED else Counter()
+
+        with transaction.atomic():
+            move(old, new)
+            super(Booking, self).save(*args, **kwargs)
+            if "update_fields" in kwargs:
+                balances = Booking.objects.filter(pk=self.pk)
+                balances.update(open_amount=F("amount") - F("paid"))
+                self.paid, self.fees, self.open_amount = balances.values_list("paid", "fees", "open_amount").get()
+
 
     def age(self):
-        age = relativedelta(self.event.begin_date.date(), self.date_of_birth)
+        age = relativedelta(timezone.localtime(self.event.begin_date).date(), self.date_of_birth)
         return age
 
     def full_age(self):
         age = self.age()
-        if age.years >= 18:
+        if age.years >= FULL_AGE:
             return True
         else:
             return False
@@ -358,6 +574,17 @@ class Booking(models.Model):
 
         ordering = ("-date",)
 
+        # composite indexes matching the keyset pagination of allBookings: (filter, date, id)
+        indexes = [
+            models.Index(fields=["date", "id"], name="booking_date_id_idx"),
+            models.Index(fields=["event", "date", "id"], name="booking_event_date_idx"),
+            models.Index(fields=["event", "state", "date", "id"], name="booking_event_state_idx"),
+            models.Index(fields=["event", "club", "date", "id"], name="booking_event_club_idx"),
+            models.Index(fields=["event", "checkin_date", "date", "id"], name="booking_event_checkin_idx"),
+            models.Index(fields=["event", "open_amount"], name="booking_event_open_idx"),
+            models.Index(fields=["event", "paid"], name="booking_event_paid_idx"),
+        ]
+
     def __str__(self):
         return self.code
 
@@ -393,5 +620,10 @@ class Transaction(models.Model):
 
         ordering = ("-datum",)
 
+        # a payment provider's transaction can only be booked once
+        constraints = [
+            models.UniqueConstraint(fields=["mittel", "nr"], condition=~Q(nr=""), name="transaction_mittel_nr_uniq"),
+        ]
+
     def __str__(self):
         return str(self.id)
@@ -0,0 +1,66 @@
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from graphql import GraphQLError
+from graphql_relay.utils import base64, unbase64
+
+CURSOR_PREFIX = "keyset:"
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def to_cursor(obj, field="date"):
+    return base64("%s%s|%d" % (CURSOR_PREFIX, getattr(obj, field).isoformat(), obj.pk))
+
+
+def from_cursor(cursor):
+    try:
+        value = unbase64(cursor)
+    except (ValueError, TypeError):
+        value = ""
+
+    if not value.startswith(CURSOR_PREFIX):
+        raise GraphQLError("Invalid cursor: %s" % cursor)
+
+    stamp, _, pk = value[len(CURSOR_PREFIX):].rpartition("|")
+    stamp = parse_datetime(stamp)
+    if stamp is None or not pk.isdigit():
+        raise GraphQLError("Invalid cursor: %s" % cursor)
+    return stamp, int(pk)
+
+
+def keyset_page(queryset, first=None, after=None, last=None, before=None, field="date"):
+    """Returns one page of ``queryset``, newest first, seeking over ``(field, pk)``.
+
+    Instead of an OFFSET the page boundary is turned into a WHERE clause on the
+    cursor values, so every page is a single index range scan of at most
+    ``first + 1`` rows no matter how deep into the list it is.
+
+    Returns ``(rows, has_previous_page, has_next_page)``. As allowed by the
+    Relay spec, the flag for the direction we are not paginating in is
+    always false.
+    """
+    backwards = last is not None and first is None
+    size = last if backwards else first
+    if size is None:
+        size = DEFAULT_PAGE_SIZE
+    if size < 0:
+        raise GraphQLError("Page size must not be negative")
+    size = min(size, MAX_PAGE_SIZE)
+
+    cursor = before if backwards else after
+    if cursor:
+        stamp, pk = from_cursor(cursor)
+        if backwards:
+            queryset = queryset.filter(Q(**{field + "__gt": stamp}) | Q(**{field: stamp, "pk__gt": pk}))
+        else:
+            queryset = queryset.filter(Q(**{field + "__lt": stamp}) | Q(**{field: stamp, "pk__lt": pk}))
+
+    if backwards:
+        rows = list(queryset.order_by(field, "pk")[:size + 1])
+        has_more = len(rows) > size
+        rows = rows[:size][::-1]
+        return rows, has_more, False
+
+    rows = list(queryset.order_by("-" + field, "-pk")[:size + 1])
+    has_more = len(rows) > size
+    return rows[:size], False, has_more
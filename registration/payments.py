@@ -0,0 +1,215 @@
+"""Payment notifications sent by PayPal (IPN style) to the payment webhook.
+
+Notifications are signed with ``PAYMENT_WEBHOOK_SECRET``: the sender puts the
+hex HMAC-SHA256 of the request body into the ``X-Webhook-Signature`` header.
+
+The view doesn't write a notification itself. It hands it to the process'
+``BatchWriter`` and waits for it to be committed, which happens together with
+all other notifications that arrived in the meantime (group commit): one query
+for the bookings, one ``bulk_create`` and a few set-based UPDATEs per batch,
+instead of one transaction per notification. A notification is only
+acknowledged after it was written, and notifications sent again are ignored
+thanks to the unique index on ``(mittel, nr)``.
+"""
+import hashlib
+import hmac
+import logging
+import queue
+import threading
+from collections import namedtuple
+from concurrent.futures import Future
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+import pytz
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from registration.ledger import refresh_balances
+from registration.models import Booking, Transaction
+from registration.statistics import invalidate_event_statistics
+
+logger = logging.getLogger(__name__)
+
+MITTEL = "paypal"
+SIGNATURE_HEADER = "HTTP_X_WEBHOOK_SIGNATURE"
+PAYPAL_TIMEZONE = pytz.timezone("America/Los_Angeles")
+
+BATCH_SIZE = getattr(settings, "PAYMENT_WEBHOOK_BATCH_SIZE", 200)
+# how long the writer waits for more notifications before writing a batch
+BATCH_WAIT = getattr(settings, "PAYMENT_WEBHOOK_BATCH_WAIT", 0.01)
+# how long the webhook waits for its notification to be written
+WRITE_TIMEOUT = 10
+
+# payment_status: sign of the amount, None for notifications that are only acknowledged
+STATUSES = {
+    "Completed": 1,
+    "Refunded": -1,
+    "Reversed": -1,
+}
+
+Notification = namedtuple("Notification", "nr code status betrag gebuehr datum payer")
+
+
+def valid_signature(request):
+    secret = getattr(settings, "PAYMENT_WEBHOOK_SECRET", None)
+    if not secret:
+        return False
+    expected = hmac.new(secret.encode(), request.body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, request.META.get(SIGNATURE_HEADER, ""))
+
+
+def parse_date(value):
+    """Reads IPN dates like ``10:11:12 May 03, 2021 PDT`` (always Pacific time) and ISO dates."""
+    parsed = parse_datetime(value)
+    if parsed is not None:
+        return parsed if timezone.is_aware(parsed) else timezone.make_aware(parsed, timezone.utc)
+    try:
+        parsed = datetime.strptime(value.rsplit(" ", 1)[0], "%H:%M:%S %b %d, %Y")
+    except ValueError:
+        return timezone.now()
+    return PAYPAL_TIMEZONE.localize(parsed)
+
+
+def parse_notification(data):
+    """Reads a notification from the (form or JSON) fields sent by the provider."""
+    nr = (data.get("txn_id") or "").strip()
+    if not nr:
+        raise ValueError("txn_id missing")
+    status = (data.get("payment_status") or "").strip()
+    try:
+        betrag = Decimal(data.get("mc_gross") or "0")
+        gebuehr = abs(Decimal(data.get("mc_fee") or "0"))
+    except InvalidOperation:
+        raise ValueError("invalid amount")
+
+    sign = STATUSES.get(status)
+    if sign is not None:
+        betrag = abs(betrag) * sign
+    code = (data.get("custom") or data.get("invoice") or data.get("item_number") or "").strip().lower()
+    payer = " ".join(part for part in (data.get("first_name"), data.get("last_name")) if part)
+    return Notification(nr[:255], code, status, betrag, gebuehr, parse_date(data.get("payment_date") or ""), payer)
+
+
+def known_nrs(nrs):
+    return set(Transaction.objects.filter(mittel=MITTEL, nr__in=nrs).values_list("nr", flat=True))
+
+
+def write_batch(notifications):
+    """Books ``notifications`` at once, returns a status for each of them."""
+    results = [None] * len(notifications)
+    pending = []
+    for i, notification in enumerate(notifications):
+        if STATUSES.get(notification.status) is None:
+            results[i] = "ignored"
+        else:
+            pending.append(i)
+    if not pending:
+        return results
+
+    with transaction.atomic():
+        known = known_nrs({notifications[i].nr for i in pending})
+        bookings = dict(
+            Booking.objects.filter(code__in={notifications[i].code for i in pending})
+            .values_list("code", "pk")
+        )
+
+        rows, seen = {}, set()
+        for i in pending:
+            notification = notifications[i]
+            if notification.nr in known or notification.nr in seen:
+                results[i] = "duplicate"
+            elif notification.code not in bookings:
+                results[i] = "unknown_booking"
+                logger.warning("payment %s for unknown booking %r", notification.nr, notification.code)
+            else:
+                seen.add(notification.nr)
+                results[i] = "created"
+                rows[i] = Transaction(
+                    booking_id=bookings[notification.code], mittel=MITTEL, nr=notification.nr,
+                    typ="incoming" if notification.betrag >= 0 else "refund",
+                    betrag=notification.betrag, gebuehr=notification.gebuehr, datum=notification.datum,
+                    grund=("PayPal %s %s" % (notification.status, notification.payer)).strip()[:255],
+                )
+
+        while rows:
+            try:
+                with transaction.atomic():
+                    Transaction.objects.bulk_create(rows.values())
+                break
+            except IntegrityError:
+                # another process wrote some of the notifications meanwhile
+                known = known_nrs({row.nr for row in rows.values()})
+                if not known:
+                    raise
+                for i in [i for i, row in rows.items() if row.nr in known]:
+                    results[i] = "duplicate"
+                    del rows[i]
+
+        if rows:
+            booked = Booking.objects.filter(pk__in={row.booking_id for row in rows.values()})
+            refresh_balances(booked)
+            update_states(booked)
+
+    return results
+
+
+def update_states(bookings):
+    """Moves open bookings to in progress or confirmed, depending on what they paid."""
+    bookings = bookings.filter(state__in=("open", "progress"))
+    events = set(bookings.values_list("event_id", flat=True))
+    confirmed = bookings.filter(open_amount__lte=0).update(state="confirmed")
+    progress = bookings.filter(state="open", paid__gt=0).exclude(open_amount__lte=0).update(state="progress")
+    if confirmed or progress:
+        for event_id in events:
+            transaction.on_commit(lambda event_id=event_id: invalidate_event_statistics(event_id))
+
+
+class BatchWriter(object):
+    """Writes the notifications submitted by all threads in batches, on one thread."""
+
+    def __init__(self, batch_size=BATCH_SIZE, wait=BATCH_WAIT):
+        self.batch_size = batch_size
+        self.wait = wait
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, notification):
+        """Returns a future that resolves to the status once the notification is written."""
+        future = Future()
+        self.queue.put((notification, future))
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="payment-writer", daemon=True)
+                self.thread.start()
+        return future
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get(timeout=self.wait))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            close_old_connections()
+            try:
+                results = write_batch([notification for notification, future in batch])
+            except Exception as e:
+                logger.exception("writing %d payment notifications failed", len(batch))
+                for notification, future in batch:
+                    future.set_exception(e)
+            else:
+                for (notification, future), result in zip(batch, results):
+                    future.set_result(result)
+
+
+writer = BatchWriter()
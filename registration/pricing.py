@@ -0,0 +1,149 @@
+import operator
+from collections import defaultdict, namedtuple
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from functools import reduce
+
+from django.db.models import Q, Sum
+from django.utils import timezone
+
+from registration.models import Booking, Day, Price
+
+
+def booking_date(value):
+    """The local calendar date a booking was made on (today for new bookings)."""
+    if value is None:
+        return timezone.localdate()
+    return timezone.localtime(value).date()
+
+
+def price_sort_key(price):
+    # the narrowest window wins: prices ending earlier first, open-ended last
+    return (price.valid_until is None, price.valid_until or date.max)
+
+
+class PriceTimeline(object):
+    """The prices and days of one event, loaded once and kept in memory.
+
+    A booking is charged the price of its rate that is valid on the booking
+    date. ``price_day`` is multiplied with the number of days from arrival to
+    departure (both included), capped at the total ``price`` if there is one.
+    Without a per-day price or without arrival/departure days the total price
+    is used.
+    """
+
+    def __init__(self, event_id):
+        self.prices = defaultdict(list)
+        for price in Price.objects.filter(rate__event_id=event_id):
+            self.prices[price.rate_id].append(price)
+        for prices in self.prices.values():
+            prices.sort(key=price_sort_key)
+
+        days = Day.objects.filter(event_id=event_id).values_list("id", flat=True)
+        self.positions = {day_id: position for position, day_id in enumerate(days)}
+
+    def price_for(self, rate_id, on):
+        for price in self.prices.get(rate_id, ()):
+            if (price.valid_from is None or price.valid_from <= on) and \
+                    (price.valid_until is None or on <= price.valid_until):
+                return price
+        return None
+
+    def days(self, arrival_id, departure_id):
+        if arrival_id not in self.positions or departure_id not in self.positions:
+            return None
+        return max(self.positions[departure_id] - self.positions[arrival_id] + 1, 1)
+
+    def amount(self, rate_id, on, arrival_id, departure_id):
+        price = self.price_for(rate_id, on)
+        if price is None:
+            return Decimal(0)
+
+        days = self.days(arrival_id, departure_id)
+        if price.price_day is not None and days is not None:
+            amount = price.price_day * days
+            if price.price is not None:
+                amount = min(amount, price.price)
+            return amount
+
+        if price.price is not None:
+            return price.price
+        if price.price_day is not None:
+            return price.price_day * len(self.positions)
+        return Decimal(0)
+
+
+def variant_totals(queryset):
+    """Sum of the selected product variants per booking id, in one query."""
+    through = Booking.variants.through.objects.filter(booking__in=queryset.values("pk"))
+    return dict(through.values_list("booking_id").annotate(total=Sum("productvariant__price")))
+
+
+RepriceResult = namedtuple("RepriceResult", "checked changed")
+
+
+def update_amounts(queryset, batch_size=500):
+    """Reprices all bookings of ``queryset`` and writes the changed amounts.
+
+    Each event's timeline and all variant totals are loaded up front, the
+    bookings are then priced in a single pass over a ``values_list`` iterator
+    and written back with ``bulk_update``. Returns a ``RepriceResult`` with the
+    number of bookings checked and the number whose amount changed.
+    """
+    timelines = {}
+    extras = variant_totals(queryset)
+
+    checked = 0
+    changed = []
+    rows = queryset.order_by().values_list(
+        "id", "code", "event_id", "rate_id", "date", "arrival_id", "departure_id", "amount", "paid"
+    )
+    for pk, code, event_id, rate_id, booked, arrival_id, departure_id, current, paid in rows.iterator(chunk_size=2000):
+        if event_id not in timelines:
+            timelines[event_id] = PriceTimeline(event_id)
+
+        amount = timelines[event_id].amount(rate_id, booking_date(booked), arrival_id, departure_id)
+        amount += extras.get(pk) or 0
+        checked += 1
+        if amount != current:
+            # passing the code keeps the model from allocating a new one
+            changed.append(Booking(pk=pk, code=code, amount=amount, open_amount=amount - paid))
+
+    Booking.objects.bulk_update(changed, ["amount", "open_amount"], batch_size=batch_size)
+    return RepriceResult(checked, len(changed))
+
+
+def start_of(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def window_filter(rate_id, valid_from, valid_until):
+    """Bookings of a rate that were made inside a price's validity window."""
+    q = Q(rate_id=rate_id)
+    if valid_from is not None:
+        q &= Q(date__gte=start_of(valid_from))
+    if valid_until is not None:
+        q &= Q(date__lt=start_of(valid_until + timedelta(days=1)))
+    return q
+
+
+def dob_filter(rate_id, dob_from, dob_to):
+    """Bookings of a rate whose date of birth lies inside a DOB band."""
+    q = Q(rate_id=rate_id)
+    if dob_from is not None:
+        q &= Q(date_of_birth__gte=dob_from)
+    if dob_to is not None:
+        q &= Q(date_of_birth__lte=dob_to)
+    return q
+
+
+def reprice(*filters):
+    """Reprices the bookings matching any of ``filters``.
+
+    Used after a price or rate edit with the filters for the state before
+    and after the edit, so only bookings inside the edited interval are
+    touched.
+    """
+    if not filters:
+        return RepriceResult(0, 0)
+    return update_amounts(Booking.objects.filter(reduce(operator.or_, filters)))
@@ -0,0 +1,92 @@
+"""Capacity quotas of rates and product variants.
+
+``capacity`` is the number of places, ``booked`` the number taken by bookings
+that are not canceled. A place is taken with a single conditional UPDATE that
+only matches while there is room left, so concurrent bookings can't oversell
+without counting bookings or locking tables: the database serializes the
+updates of the row, and whoever comes too late updates nothing.
+
+Several places are taken in one transaction; if any of them is sold out the
+transaction is rolled back and none of them is taken.
+"""
+from collections import Counter
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils.translation import gettext as _
+
+from registration.models import ProductVariant, Rate
+
+CANCELED = "canceled"
+
+
+class SoldOut(ValidationError):
+    def __init__(self, obj):
+        super(SoldOut, self).__init__(_("%s is sold out.") % obj, code="sold_out")
+        self.obj = obj
+
+
+def places(rate_id, variant_ids):
+    """The places a booking takes, as a Counter of ``(model, pk)``."""
+    needed = Counter((ProductVariant, pk) for pk in variant_ids)
+    if rate_id is not None:
+        needed[Rate, rate_id] += 1
+    return needed
+
+
+def booking_places(booking, variant_ids=None):
+    if booking.state == CANCELED:
+        return Counter()
+    if variant_ids is None:
+        variant_ids = booking.variants.values_list("pk", flat=True) if booking.pk else ()
+    return places(booking.rate_id, variant_ids)
+
+
+def take(needed):
+    """Takes all ``needed`` places or raises ``SoldOut`` without taking any."""
+    # a fixed order keeps concurrent transactions from deadlocking
+    items = sorted((item for item in needed.items() if item[1] > 0),
+                   key=lambda item: (item[0][0]._meta.label, item[0][1]))
+    if not items:
+        return
+
+    with transaction.atomic():
+        for (model, pk), count in items:
+            room = Q(capacity__isnull=True) | Q(capacity__gte=F("booked") + count)
+            if not model.objects.filter(room, pk=pk).update(booked=F("booked") + count):
+                obj = model.objects.filter(pk=pk).first()
+                if obj is not None:
+                    raise SoldOut(obj)
+
+
+def sold_out(needed):
+    """The rates and variants without room for the ``needed`` places, checked without taking them.
+
+    Lets forms report a sold-out quota as an error; ``take`` still has the last word.
+    """
+    objects = []
+    for (model, pk), count in sorted(needed.items(), key=lambda item: (item[0][0]._meta.label, item[0][1])):
+        if count > 0:
+            obj = model.objects.filter(pk=pk).first()
+            if obj is not None and obj.capacity is not None and obj.capacity - obj.booked < count:
+                objects.append(obj)
+    return objects
+
+
+def release(needed):
+    for (model, pk), count in needed.items():
+        if count > 0:
+            model.objects.filter(pk=pk, booked__gte=count).update(booked=F("booked") - count)
+
+
+def move(old, new):
+    """Takes the places in ``new`` not in ``old`` and releases the ones no longer needed."""
+    take(new - old)
+    release(old - new)
+
+
+def remaining(obj):
+    if obj.capacity is None:
+        return None
+    return max(obj.capacity - obj.booked, 0)
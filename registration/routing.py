@@ -0,0 +1,123 @@
+"""Sends reads to a replica of the database where that is safe.
+
+If ``DATABASES`` has a ``replica`` alias, ``ReplicaMiddleware`` lets safe
+requests (GET, HEAD, OPTIONS), like the admin change lists, read from it;
+writes always go to ``default``. GraphQL requests are routed by operation:
+queries read from the replica, mutations use the primary, whatever the HTTP
+method (see ``CachedGraphQLView``).
+
+Reads use the primary again as soon as anything is written in the request,
+inside transactions, outside requests (commands, background threads) and in
+views decorated with ``primary_reads``. Writes are seen in the statements run
+on ``default``, not in ``db_for_write``: Django also asks the router for the
+database of transactions that only read, like the admin change form.
+
+After a request that wrote, the client gets a cookie that keeps its reads on
+the primary for ``REPLICA_STICKY_SECONDS``, so it sees its own writes while
+the replica catches up. Caches shared by all clients (GraphQL responses, rate
+index, event statistics) are filled inside ``primary()``: an entry built from
+a lagging replica would keep stale rows under a new version.
+
+Without a ``replica`` alias everything uses ``default``. For local tests,
+``copy_replica`` copies one SQLite file to another.
+"""
+import re
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+DEFAULT = "default"
+REPLICA = "replica"
+STICKY_COOKIE = "primary"
+STICKY_SECONDS = getattr(settings, "REPLICA_STICKY_SECONDS", 10)
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+WRITE_STATEMENT = re.compile(r"\s*(INSERT|UPDATE|DELETE|REPLACE|CREATE|ALTER|DROP|TRUNCATE)\b", re.IGNORECASE)
+
+_local = threading.local()
+
+
+def has_replica():
+    return REPLICA in connections.databases
+
+
+def use_replica():
+    """Lets the current request read from the replica, unless it wrote or must see its writes."""
+    _local.replica = not any(getattr(_local, flag, False) for flag in ("sticky", "wrote", "pinned"))
+
+
+def use_primary():
+    _local.replica = False
+
+
+@contextmanager
+def primary():
+    """Reads inside the block use the primary, even where the request could use the replica."""
+    pinned, replica = getattr(_local, "pinned", False), getattr(_local, "replica", False)
+    _local.pinned, _local.replica = True, False
+    try:
+        yield
+    finally:
+        _local.pinned = pinned
+        _local.replica = replica and not getattr(_local, "wrote", False)
+
+
+def record_writes(execute, sql, params, many, context):
+    if WRITE_STATEMENT.match(sql):
+        _local.wrote = True
+        _local.replica = False
+    return execute(sql, params, many, context)
+
+
+def primary_reads(view):
+    """Marks a view whose reads must be up to date, e.g. the offset of an upload."""
+    view.primary_reads = True
+    return view
+
+
+class ReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        if getattr(_local, "replica", False) and has_replica() and not connections[DEFAULT].in_atomic_block:
+            return REPLICA
+        return DEFAULT
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replica holds the same rows
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == REPLICA:
+            return False
+        return None
+
+
+class ReplicaMiddleware(object):
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _local.sticky = STICKY_COOKIE in request.COOKIES
+        _local.wrote = False
+        if request.method in SAFE_METHODS:
+            use_replica()
+        else:
+            use_primary()
+        try:
+            with connections[DEFAULT].execute_wrapper(record_writes):
+                response = self.get_response(request)
+        finally:
+            wrote = _local.wrote
+            _local.__dict__.clear()
+
+        if wrote and has_replica():
+            response.set_cookie(STICKY_COOKIE, "1", max_age=STICKY_SECONDS, httponly=True,
+                                samesite="Lax", secure=request.is_secure())
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if getattr(view_func, "primary_reads", False):
+            use_primary()
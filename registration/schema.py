@@ -2,47 +2,85 @@ import graphene
 from graphene_django.types import DjangoObjectType
 from graphene_django.fields import DjangoConnectionField
 from graphene_django.filter import DjangoFilterConnectionField
-from graphene_django.rest_framework.mutation import SerializerMutation
-from .models import Event, Booking, Discipline, Document, Day, Rate, Price, Product, ProductVariant
+from graphene_django.rest_framework.mutation import SerializerMutation, fields_for_serializer
+from graphene_django.rest_framework.serializer_converter import get_graphene_type_from_serializer_field
+from graphene_django.types import ErrorType
+from .models import Event, Booking, Discipline, Document, Day, Rate, Price, Product, ProductVariant, WebPage, \
+    ImageDerivative
+from django.db import transaction
+from django.utils import timezone
+from django.utils.translation import gettext as _
 from rest_framework import serializers
 from graphene import relay
+from graphql import GraphQLError
 from graphql_relay import from_global_id, to_global_id
+from promise import Promise
+from .attachments import missing_documents
+from .eligibility import get_rate_index
+from .group import GroupBookingSerializer, MAX_GROUP_SIZE, create_bookings, rate_errors, variant_errors
+from . import images
+from .loaders import get_loader
+from .pagination import keyset_page, to_cursor
+from .quotas import SoldOut, remaining
+from .search import search_bookings
+from .statistics import get_event_statistics
 
+CONNECTION_ARGS = ("before", "after", "first", "last")
 
-class ProductType(DjangoObjectType):
-    class Meta:
-        fields = ["name", "kind", "variants"]
-        model = Product
-        interfaces = [relay.Node]
+
+def has_filters(kwargs):
+    return any(key not in CONNECTION_ARGS for key in kwargs)
+
+
+class BatchedConnectionMixin(object):
+    """Lets a resolver return a DataLoader promise instead of a queryset."""
+
+    @classmethod
+    def resolve_queryset(cls, connection, iterable, info, args, **kwargs):
+        if Promise.is_thenable(iterable):
+            return iterable
+        return super(BatchedConnectionMixin, cls).resolve_queryset(connection, iterable, info, args, **kwargs)
+
+
+class BatchedConnectionField(BatchedConnectionMixin, DjangoConnectionField):
+    pass
+
+
+class BatchedFilterConnectionField(BatchedConnectionMixin, DjangoFilterConnectionField):
+    pass
 
 
 class ProductVariantType(DjangoObjectType):
+    remaining = graphene.Int(description="Places left, null if unlimited")
+
+    @staticmethod
+    def resolve_remaining(variant, info):
+        return remaining(variant)
+
     class Meta:
-        fields = ["name", "price"]
+        fields = ["name", "price", "capacity"]
         model = ProductVariant
         interfaces = [relay.Node]
 
 
-class PriceType(DjangoObjectType):
+class ProductType(DjangoObjectType):
+    variants = BatchedConnectionField(ProductVariantType)
+
+    @staticmethod
+    def resolve_variants(product, info, **kwargs):
+        return get_loader(info, "product.variants", ProductVariant.objects.all(), "product").load(product.pk)
+
     class Meta:
-        fields = ["valid_from", "valid_until", "price_day", "price"]
-        model = Price
+        fields = ["name", "kind", "variants"]
+        model = Product
         interfaces = [relay.Node]
 
 
-class RateType(DjangoObjectType):
+class PriceType(DjangoObjectType):
     class Meta:
-        fields = ["id", "label", "dob_from", "dob_to", "non_rider", "prices", "disciplines"]
-        model = Rate
+        fields = ["valid_from", "valid_until", "price_day", "price"]
+        model = Price
         interfaces = [relay.Node]
-        filter_fields = {
-            "dob_from": ["lte"],
-            "dob_to": ["gte"],
-        }
-
-    @classmethod
-    def get_queryset(cls, queryset, info):
-        return queryset.filter(is_active=True)
 
 
 class DayType(DjangoObjectType):
@@ -59,6 +97,38 @@ class DisciplineType(DjangoObjectType):
         interfaces = [relay.Node]
 
 
+class RateType(DjangoObjectType):
+    prices = BatchedConnectionField(PriceType)
+    disciplines = BatchedConnectionField(DisciplineType)
+
+    @staticmethod
+    def resolve_prices(rate, info, **kwargs):
+        return get_loader(info, "rate.prices", Price.objects.all(), "rate").load(rate.pk)
+
+    @staticmethod
+    def resolve_disciplines(rate, info, **kwargs):
+        return get_loader(info, "rate.disciplines", Discipline.objects.all(), "rate").load(rate.pk)
+
+    remaining = graphene.Int(description="Places left, null if unlimited")
+
+    @staticmethod
+    def resolve_remaining(rate, info):
+        return remaining(rate)
+
+    class Meta:
+        fields = ["id", "label", "dob_from", "dob_to", "non_rider", "prices", "disciplines", "capacity"]
+        model = Rate
+        interfaces = [relay.Node]
+        filter_fields = {
+            "dob_from": ["lte"],
+            "dob_to": ["gte"],
+        }
+
+    @classmethod
+    def get_queryset(cls, queryset, info):
+        return queryset.filter(is_active=True)
+
+
 class DocumentType(DjangoObjectType):
     class Meta:
         model = Document
@@ -70,54 +140,154 @@ class DocumentType(DjangoObjectType):
         return instance.document.url
 
 
+class ImageType(graphene.ObjectType):
+    """An image with its resized copies, srcsets are empty until they are built"""
+    url = graphene.String()
+    srcset = graphene.String(description="WebP copies in several widths")
+    fallback_srcset = graphene.String(description="JPEG or PNG copies for clients without WebP")
+
+    @staticmethod
+    def resolve_srcset(image, info):
+        return images.srcset(image["derivatives"])
+
+    @staticmethod
+    def resolve_fallback_srcset(image, info):
+        return images.fallback_srcset(image["derivatives"])
+
+
+class WebPageType(DjangoObjectType):
+    class Meta:
+        model = WebPage
+        fields = ["id", "slug", "name", "icon", "html", "order", "menu"]
+        interfaces = [relay.Node]
+
+    @staticmethod
+    def resolve_html(page, info):
+        names = images.page_images(page.html)
+        if not names:
+            return page.html
+        loader = get_loader(info, "image.derivatives", ImageDerivative.objects.all(), "source")
+        return loader.load_many(names).then(
+            lambda derivatives: images.add_srcsets(page.html, [row for rows in derivatives for row in rows])
+        )
+
+
 class EventType(DjangoObjectType):
     """A sports event like a competition or a convention"""
     arrival = graphene.List(DayType)
     departure = graphene.List(DayType)
     rates_available = graphene.List(RateType)
+    rates = BatchedFilterConnectionField(RateType)
+    products = BatchedConnectionField(ProductType)
+    documents = BatchedConnectionField(DocumentType)
+    disciplines = BatchedConnectionField(DisciplineType)
+    logo_image = graphene.Field(ImageType)
+    pages = BatchedConnectionField(WebPageType)
 
     @staticmethod
     def resolve_logo(event, info):
         return event.logo.url
 
+    @staticmethod
+    def resolve_logo_image(event, info):
+        if not event.logo:
+            return None
+        loader = get_loader(info, "image.derivatives", ImageDerivative.objects.all(), "source")
+        return loader.load(event.logo.name).then(
+            lambda derivatives: {"url": event.logo.url, "derivatives": derivatives}
+        )
+
+    @staticmethod
+    def resolve_pages(event, info, **kwargs):
+        return get_loader(info, "event.pages", WebPage.objects.all(), "event").load(event.pk)
+
     @staticmethod
     def resolve_arrival(event, info):
-        return event.arrival
+        return get_loader(info, "event.arrival", Day.objects.filter(arrival=True), "event").load(event.pk)
 
     @staticmethod
     def resolve_departure(event, info):
-        return event.departure
+        return get_loader(info, "event.departure", Day.objects.filter(departure=True), "event").load(event.pk)
 
     @staticmethod
     def resolve_rates_available(event, info):
-        return grapevent.rates.filter(is_active=True)
+        return get_loader(info, "event.rates", Rate.objects.filter(is_active=True), "event").load(event.pk)
+
+    @staticmethod
+    def resolve_rates(event, info, **kwargs):
+        # the filterset only works on querysets, filtered lookups are not batched
+        if has_filters(kwargs):
+            return event.rates.all()
+        return get_loader(info, "event.rates", Rate.objects.filter(is_active=True), "event").load(event.pk)
+
+    @staticmethod
+    def resolve_products(event, info, **kwargs):
+        return get_loader(info, "event.products", Product.objects.all(), "event").load(event.pk)
+
+    @staticmethod
+    def resolve_documents(event, info, **kwargs):
+        return get_loader(info, "event.documents", Document.objects.all(), "event").load(event.pk)
+
+    @staticmethod
+    def resolve_disciplines(event, info, **kwargs):
+        return get_loader(info, "event.disciplines", Discipline.objects.all(), "event").load(event.pk)
 
     class Meta:
         model = Event
         fields = ("id", "slug", "begin_date", "end_date", "name", "host", "description", "logo", "sex_is_required",
                   "address_is_required", "phone_is_required", "disciplines", "documents",
                   "arrival", "departure", "rates", "food_is_included", "vegan", "vegetarian",
-                  "vegan_breakfast_only", "products",
+                  "vegan_breakfast_only", "products", "logo_image", "pages",
                   "is_open")
         interfaces = [relay.Node]
 
 
+@get_graphene_type_from_serializer_field.register(serializers.ManyRelatedField)
+def convert_many_related_field(field):
+    # the primary keys of the related objects, graphene-django would expect a single string
+    return (graphene.List, graphene.ID)
+
+
 class BookingSerializer(serializers.ModelSerializer):
     disciplines = serializers.PrimaryKeyRelatedField(many=True, queryset=Discipline.objects.all(), required=False)
+    variants = serializers.PrimaryKeyRelatedField(many=True, queryset=ProductVariant.objects.select_related("product"),
+                                                  required=False)
 
     class Meta:
         model = Booking
         fields = ("disciplines", "event", "code", "date_of_birth", "email",  "last_name",
                   "club", "first_name", "notes", "address", "zipcode", "city",  "phone",
-                  "arrival", "departure", "rate")
+                  "arrival", "departure", "rate", "variants")
         convert_choices_to_enum = False
 
+    def validate(self, data):
+        event, errors = data["event"], {}
+        rate = data.get("rate")
+        messages = rate_errors(get_rate_index(event.pk), rate and rate.pk, data["date_of_birth"], timezone.localdate())
+        if messages:
+            errors["rate"] = messages
+
+        variants = data.get("variants", [])
+        if any(variant.product.event_id != event.pk for variant in variants):
+            errors["variants"] = [_("Unknown products: %s") % ", ".join(
+                str(variant.pk) for variant in variants if variant.product.event_id != event.pk)]
+        else:
+            required = {product.pk: product for product in Product.objects.filter(event=event, required=True)}
+            messages = variant_errors([variant.product_id for variant in variants], required)
+            if messages:
+                errors["variants"] = messages
+
+        if errors:
+            raise serializers.ValidationError(errors)
+        return data
+
 
 class BookingType(DjangoObjectType):
     class Meta:
         model = Booking
         fields = ("id", "disciplines", "event", "code", "date_of_birth", "email", "food", "last_name", "package",
-                  "club", "first_name", "sex", "notes", "address", "zipcode", "city", "country", "phone", "arrival", "departure", "rate")
+                  "club", "first_name", "sex", "notes", "address", "zipcode", "city", "country", "phone", "arrival", "departure", "rate",
+                  "variants", "amount")
         interfaces = [relay.Node]
 
 class BookingCreateMutation(SerializerMutation):
@@ -125,17 +295,181 @@ class BookingCreateMutation(SerializerMutation):
         serializer_class = BookingSerializer
         model_operations = ["create"]
 
+    @classmethod
+    def perform_mutate(cls, serializer, info):
+        try:
+            # variants are taken after the booking is inserted, a sold out one must undo the insert
+            with transaction.atomic():
+                return super(BookingCreateMutation, cls).perform_mutate(serializer, info)
+        except SoldOut as e:
+            field = "rate" if isinstance(e.obj, Rate) else "variants"
+            return cls(errors=[ErrorType(field=field, messages=e.messages)])
+
+GroupBookingInput = type("GroupBookingInput", (graphene.InputObjectType,),
+                         fields_for_serializer(GroupBookingSerializer(), (), (), is_input=True))
+
+
+class BookingRowResult(graphene.ObjectType):
+    """Outcome of one row of a group registration, in the order of the input"""
+    index = graphene.Int()
+    booking = graphene.Field(BookingType)
+    errors = graphene.List(ErrorType)
+
+
+class CreateBookingsMutation(graphene.Mutation):
+    """Books a whole group at once. Valid rows are booked even if others have errors."""
+
+    class Arguments:
+        event_id = graphene.Int(required=True)
+        bookings = graphene.List(graphene.NonNull(GroupBookingInput), required=True)
+
+    results = graphene.List(BookingRowResult)
+    ok = graphene.Boolean()
+
+    def mutate(self, info, event_id, bookings):
+        if len(bookings) > MAX_GROUP_SIZE:
+            raise GraphQLError("At most %d bookings can be created at once." % MAX_GROUP_SIZE)
+        event = Event.objects.filter(pk=event_id).first()
+        if event is None:
+            raise GraphQLError("Unknown event.")
+
+        results = create_bookings(event, [dict(row) for row in bookings])
+        return CreateBookingsMutation(
+            ok=all(result.booking is not None for result in results),
+            results=[
+                BookingRowResult(
+                    index=result.index,
+                    booking=result.booking,
+                    errors=ErrorType.from_errors(result.errors),
+                )
+                for result in results
+            ],
+        )
+
+
+class CountType(graphene.ObjectType):
+    """Number of bookings sharing one value of a statistics dimension"""
+    key = graphene.String()
+    label = graphene.String()
+    count = graphene.Int()
+
+
+def counts(dimension):
+    def resolve(statistics, info):
+        return [
+            CountType(key=None if key is None else str(key), label=label, count=count)
+            for key, label, count in statistics[dimension]
+        ]
+    return graphene.List(CountType, resolver=resolve)
+
+
+class EventStatisticsType(graphene.ObjectType):
+    """Booking counts of an event, broken down by several dimensions"""
+    total = graphene.Int(resolver=lambda statistics, info: statistics["total"])
+    by_state = counts("state")
+    by_food = counts("food")
+    by_rate = counts("rate")
+    by_country = counts("country")
+    by_club = counts("club")
+    by_age_band = counts("age_band")
+    per_day = counts("day")
+
+
+class MissingDocumentsType(graphene.ObjectType):
+    """A booking with the documents it still has to upload"""
+    booking = graphene.Field(BookingType)
+    age = graphene.Int(description="Age at the beginning of the event")
+    documents = graphene.List(DocumentType)
+
+
+class EligibleRatesType(graphene.ObjectType):
+    """The rates a single member of a group sign-up can book"""
+    date_of_birth = graphene.Date()
+    rates = graphene.List(RateType)
+
+
 class Query(graphene.ObjectType):
     """Uniconvention.com GraphQL endpoint"""
+    eligible_rates = graphene.List(
+        RateType,
+        event_id=graphene.Int(required=True),
+        date_of_birth=graphene.Date(required=True),
+        date=graphene.Date(description="Booking date, defaults to today"),
+    )
+    eligible_rates_batch = graphene.List(
+        EligibleRatesType,
+        event_id=graphene.Int(required=True),
+        dates_of_birth=graphene.List(graphene.NonNull(graphene.Date), required=True),
+        date=graphene.Date(description="Booking date, defaults to today"),
+    )
     all_events = DjangoConnectionField(EventType)
-    all_bookings = graphene.List(BookingType)
+    all_bookings = relay.ConnectionField(
+        BookingType._meta.connection,
+        event=graphene.Int(),
+        state=graphene.String(),
+        club=graphene.String(),
+        checked_in=graphene.Boolean(),
+        description="Bookings, newest first. Only for staff.",
+    )
     event = graphene.Field(EventType, id=graphene.Int())
+    event_statistics = graphene.Field(
+        EventStatisticsType,
+        event_id=graphene.Int(required=True),
+        description="Booking counts of an event. Only for staff.",
+    )
+    search_bookings = graphene.List(
+        BookingType,
+        query=graphene.String(required=True),
+        event=graphene.Int(),
+        first=graphene.Int(default_value=20),
+        description="Bookings by code, name or club, best match first. Only for staff.",
+    )
+    missing_documents = graphene.List(
+        MissingDocumentsType,
+        event_id=graphene.Int(required=True),
+        checked_in=graphene.Boolean(),
+        description="Bookings that haven't uploaded all required documents. Only for staff.",
+    )
 
     def resolve_all_events(self, info, **kwargs):
         return Event.objects.all()
 
-    def resolve_all_bookings(self, info, **kwargs):
-        return Booking.objects.all()
+    def resolve_all_bookings(self, info, first=None, after=None, last=None, before=None, **kwargs):
+        user = info.context.user
+        if not user.is_staff:
+            raise GraphQLError("Only staff can see bookings")
+        qs = Booking.objects.all()
+        if not user.is_superuser:
+            qs = qs.filter(event__admin=user)
+        if kwargs.get("event") is not None:
+            qs = qs.filter(event_id=kwargs["event"])
+        if kwargs.get("state") is not None:
+            qs = qs.filter(state=kwargs["state"])
+        if kwargs.get("club") is not None:
+            qs = qs.filter(club=kwargs["club"])
+        if kwargs.get("checked_in") is not None:
+            qs = qs.filter(checkin_date__isnull=not kwargs["checked_in"])
+
+        rows, has_previous, has_next = keyset_page(qs, first=first, after=after, last=last, before=before)
+
+        connection = BookingType._meta.connection
+        edges = [connection.Edge(node=row, cursor=to_cursor(row)) for row in rows]
+        return connection(
+            edges=edges,
+            page_info=relay.PageInfo(
+                start_cursor=edges[0].cursor if edges else None,
+                end_cursor=edges[-1].cursor if edges else None,
+                has_previous_page=has_previous,
+                has_next_page=has_next,
+            ),
+        )
+
+    def resolve_eligible_rates(self, info, event_id, date_of_birth, date=None):
+        return get_rate_index(event_id).eligible(date_of_birth, date)
+
+    def resolve_eligible_rates_batch(self, info, event_id, dates_of_birth, date=None):
+        index = get_rate_index(event_id)
+        return [EligibleRatesType(date_of_birth=dob, rates=index.eligible(dob, date)) for dob in dates_of_birth]
 
     def resolve_event(self, info, **kwargs):
         id = kwargs.get("id")
@@ -143,7 +477,49 @@ class Query(graphene.ObjectType):
             return Event.objects.get(id=id)
         return None
 
+    def resolve_event_statistics(self, info, event_id):
+        user = info.context.user
+        if not user.is_staff:
+            raise GraphQLError("Only staff can see event statistics")
+        events = Event.objects.all()
+        if not user.is_superuser:
+            events = events.filter(admin=user)
+        event = events.filter(id=event_id).first()
+        if event is None:
+            return None
+        return get_event_statistics(event)
+
+    def resolve_search_bookings(self, info, query, event=None, first=20):
+        user = info.context.user
+        if not user.is_staff:
+            raise GraphQLError("Only staff can search bookings")
+        qs = Booking.objects.all()
+        if not user.is_superuser:
+            qs = qs.filter(event__admin=user)
+        if event is not None:
+            qs = qs.filter(event_id=event)
+        return search_bookings(qs, query, limit=min(max(first, 0), 100))
+
+    def resolve_missing_documents(self, info, event_id, checked_in=None):
+        user = info.context.user
+        if not user.is_staff:
+            raise GraphQLError("Only staff can see missing documents")
+        events = Event.objects.all()
+        if not user.is_superuser:
+            events = events.filter(admin=user)
+        event = events.filter(id=event_id).first()
+        if event is None:
+            return []
+        bookings = None
+        if checked_in is not None:
+            bookings = Booking.objects.filter(checkin_date__isnull=not checked_in)
+        return [
+            MissingDocumentsType(booking=booking, age=booking.age_at_start, documents=documents)
+            for booking, documents in missing_documents(event, bookings)
+        ]
+
 class Mutation(graphene.ObjectType):
     create_booking = BookingCreateMutation.Field()
+    create_bookings = CreateBookingsMutation.Field()
 
 schema = graphene.Schema(query=Query, mutation=Mutation)
\ No newline at end of file
@@ -0,0 +1,76 @@
+"""Search of bookings by code, name and club.
+
+On SQLite the bookings are indexed in the FTS5 table ``SEARCH_TABLE``, which
+triggers keep in sync with every write to the bookings table, including bulk
+inserts and updates (see migration 0014). Every word of the search term
+matches the beginning of a word, accents and case are ignored: "mull ein"
+finds "Müller, Einradverein", "weiss" finds "Weiß". A search looks up the
+index instead of scanning all bookings with ``LIKE '%term%'``.
+
+Other databases fall back to ``icontains`` lookups.
+"""
+import re
+
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+SEARCH_TABLE = "registration_booking_search"
+FALLBACK_FIELDS = ("first_name", "last_name", "club", "code")
+WORD_RE = re.compile(r"\w+")
+# ranked searches consider this many matches at most
+MAX_RANKED = 500
+
+
+def words(term):
+    return WORD_RE.findall(term or "")
+
+
+def match_expression(term):
+    """The FTS5 query for ``term``: every word as a prefix, all words required."""
+    expressions = []
+    for word in words(term):
+        # the tokenizer removes accents but keeps "ß", which is often written "ss"
+        variants = sorted({word, word.replace("ß", "ss"), word.replace("ss", "ß")})
+        expressions.append("(%s)" % " OR ".join('"%s"*' % variant for variant in variants))
+    return " AND ".join(expressions)
+
+
+def indexed():
+    return connection.vendor == "sqlite"
+
+
+def filter_bookings(queryset, term):
+    """Restricts ``queryset`` to the bookings matching ``term``."""
+    if not words(term):
+        return queryset
+    if not indexed():
+        for word in words(term):
+            queryset = queryset.filter(
+                Q(**{"%s__icontains" % field: word for field in FALLBACK_FIELDS}, _connector=Q.OR)
+            )
+        return queryset
+    matches = RawSQL("SELECT rowid FROM %s WHERE %s MATCH %%s" % (SEARCH_TABLE, SEARCH_TABLE),
+                     [match_expression(term)])
+    return queryset.filter(pk__in=matches)
+
+
+def search_bookings(queryset, term, limit=20):
+    """The best ``limit`` bookings of ``queryset`` matching ``term``, best match first."""
+    if not words(term):
+        return []
+    if not indexed():
+        return list(filter_bookings(queryset, term)[:limit])
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT rowid FROM %s WHERE %s MATCH %%s ORDER BY rank LIMIT %%s" % (SEARCH_TABLE, SEARCH_TABLE),
+            [match_expression(term), MAX_RANKED],
+        )
+        ranked = [row[0] for row in cursor.fetchall()]
+    if len(ranked) == MAX_RANKED:
+        # too many matches to rank all of them, e.g. a single letter
+        return list(filter_bookings(queryset, term)[:limit])
+
+    bookings = {booking.pk: booking for booking in queryset.filter(pk__in=ranked)}
+    return [bookings[pk] for pk in ranked if pk in bookings][:limit]
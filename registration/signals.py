@@ -0,0 +1,264 @@
+import logging
+
+from collections import Counter
+
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, pre_save, post_save, pre_delete, post_delete
+from django.dispatch import receiver
+
+from registration.eligibility import invalidate_rate_index
+from registration.graphql_cache import bump_version
+from registration.images import page_images, schedule
+from registration.ledger import refresh_balances
+from registration.models import Booking, Price, Rate, ProductVariant, Transaction, Event, Product, Day, \
+    Discipline, Document, WebPage, local_day
+from registration.pricing import update_amounts, reprice, window_filter, dob_filter
+from registration.quotas import CANCELED, booking_places, release, take
+from registration.statistics import invalidate_event_statistics
+
+logger = logging.getLogger(__name__)
+
+PRICE_FIELDS = ("rate_id", "valid_from", "valid_until", "price_day", "price")
+RATE_FIELDS = ("dob_from", "dob_to")
+
+
+def snapshot(instance, fields):
+    return tuple(getattr(instance, field) for field in fields)
+
+
+def remember_saved_state(instance, fields):
+    """Keeps the values stored in the database before ``instance`` is saved."""
+    instance.__dict__.pop("_reprice_result", None)
+    instance._saved_state = None
+    if instance.pk is not None:
+        instance._saved_state = type(instance).objects.filter(pk=instance.pk).values_list(*fields).first()
+
+
+def log_repricing(instance, result):
+    instance._reprice_result = result
+    logger.info("%s %s: %d of %d bookings repriced", type(instance).__name__, instance.pk, result.changed, result.checked)
+
+
+@receiver(m2m_changed, sender=Booking.variants.through)
+def variants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == "pre_clear":
+        # remember the bookings, post_clear does not tell us which ones lost the variant
+        instance._cleared_bookings = list(instance.booking_set.values_list("pk", flat=True))
+        return
+
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+
+    if not reverse:
+        bookings = Booking.objects.filter(pk=instance.pk)
+    elif action == "post_clear":
+        bookings = Booking.objects.filter(pk__in=instance.__dict__.pop("_cleared_bookings", []))
+    else:
+        bookings = Booking.objects.filter(pk__in=pk_set)
+    update_amounts(bookings)
+
+
+def variant_places(instance, reverse, pk_set):
+    """Places taken by linking ``pk_set`` on the other side of ``Booking.variants`` to ``instance``."""
+    if not reverse:
+        if instance.state == CANCELED:
+            return Counter()
+        return Counter((ProductVariant, pk) for pk in pk_set)
+
+    count = Booking.objects.filter(pk__in=pk_set).exclude(state=CANCELED).count()
+    return Counter({(ProductVariant, instance.pk): count})
+
+
+@receiver(m2m_changed, sender=Booking.variants.through)
+def variant_quotas(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "pre_add":
+        take(variant_places(instance, reverse, pk_set))
+    elif action == "pre_remove":
+        # only the variants that are actually linked free a place
+        linked = instance.booking_set if reverse else instance.variants
+        instance._released_places = variant_places(
+            instance, reverse, set(linked.filter(pk__in=pk_set).values_list("pk", flat=True)))
+    elif action == "pre_clear":
+        linked = instance.booking_set if reverse else instance.variants
+        instance._released_places = variant_places(instance, reverse, set(linked.values_list("pk", flat=True)))
+    elif action in ("post_remove", "post_clear"):
+        release(instance.__dict__.pop("_released_places", Counter()))
+
+
+@receiver(pre_save, sender=Price)
+def price_pre_save(sender, instance, raw=False, **kwargs):
+    if not raw:
+        remember_saved_state(instance, PRICE_FIELDS)
+
+
+@receiver(post_save, sender=Price)
+def price_saved(sender, instance, raw=False, **kwargs):
+    old = getattr(instance, "_saved_state", None)
+    if raw or old == snapshot(instance, PRICE_FIELDS):
+        return
+
+    # a booking can only change its price if it was made inside the old or the new window
+    filters = [window_filter(instance.rate_id, instance.valid_from, instance.valid_until)]
+    if old is not None:
+        filters.append(window_filter(*old[:3]))
+    log_repricing(instance, reprice(*filters))
+
+
+@receiver(post_delete, sender=Price)
+def price_deleted(sender, instance, **kwargs):
+    log_repricing(instance, reprice(window_filter(instance.rate_id, instance.valid_from, instance.valid_until)))
+
+
+@receiver(pre_save, sender=Rate)
+def rate_pre_save(sender, instance, raw=False, **kwargs):
+    if not raw:
+        remember_saved_state(instance, RATE_FIELDS)
+
+
+@receiver(post_save, sender=Rate)
+def rate_saved(sender, instance, created, raw=False, **kwargs):
+    old = getattr(instance, "_saved_state", None)
+    if raw or created or old is None or old == snapshot(instance, RATE_FIELDS):
+        return
+
+    filters = [dob_filter(instance.pk, *old), dob_filter(instance.pk, instance.dob_from, instance.dob_to)]
+    log_repricing(instance, reprice(*filters))
+
+
+@receiver(pre_save, sender=ProductVariant)
+def variant_pre_save(sender, instance, raw=False, **kwargs):
+    if not raw:
+        remember_saved_state(instance, ("price",))
+
+
+@receiver(post_save, sender=ProductVariant)
+def variant_saved(sender, instance, created, raw=False, **kwargs):
+    old = getattr(instance, "_saved_state", None)
+    if raw or created or old == (instance.price,):
+        return
+    log_repricing(instance, update_amounts(instance.booking_set.all()))
+
+
+@receiver(pre_delete, sender=ProductVariant)
+def variant_pre_delete(sender, instance, **kwargs):
+    # the cascade deletes the links without m2m_changed, remember who had the variant
+    instance._deleted_bookings = list(instance.booking_set.values_list("pk", flat=True))
+
+
+@receiver(post_delete, sender=ProductVariant)
+def variant_deleted(sender, instance, **kwargs):
+    bookings = Booking.objects.filter(pk__in=instance.__dict__.pop("_deleted_bookings", []))
+    log_repricing(instance, update_amounts(bookings))
+
+
+@receiver(pre_delete, sender=Rate)
+@receiver(pre_delete, sender=Day)
+def booking_part_pre_delete(sender, instance, **kwargs):
+    # SET_NULL clears the bookings' rate or days without saving them, remember whose price depends on it
+    if sender is Rate:
+        bookings = Booking.objects.filter(rate=instance)
+    else:
+        bookings = Booking.objects.filter(Q(arrival=instance) | Q(departure=instance))
+    instance._deleted_bookings = list(bookings.values_list("pk", flat=True))
+
+
+@receiver(post_delete, sender=Rate)
+@receiver(post_delete, sender=Day)
+def booking_part_deleted(sender, instance, **kwargs):
+    bookings = Booking.objects.filter(pk__in=instance.__dict__.pop("_deleted_bookings", []))
+    log_repricing(instance, update_amounts(bookings))
+
+
+@receiver(post_save, sender=Rate)
+@receiver(post_delete, sender=Rate)
+def rate_changed(sender, instance, **kwargs):
+    invalidate_rate_index(instance.event_id)
+    bump_version(instance.event_id)
+
+
+@receiver(post_save, sender=Price)
+@receiver(post_delete, sender=Price)
+def price_changed(sender, instance, **kwargs):
+    for event_id in Rate.objects.filter(pk=instance.rate_id).values_list("event_id", flat=True):
+        invalidate_rate_index(event_id)
+        bump_version(event_id)
+
+
+@receiver(pre_save, sender=Transaction)
+def transaction_pre_save(sender, instance, raw=False, **kwargs):
+    if not raw:
+        remember_saved_state(instance, ("booking_id",))
+
+
+@receiver(post_save, sender=Transaction)
+@receiver(post_delete, sender=Transaction)
+def transaction_changed(sender, instance, **kwargs):
+    # a transaction moved to another booking changes the balance of both
+    old = getattr(instance, "_saved_state", None) or ()
+    refresh_balances(Booking.objects.filter(pk__in={instance.booking_id, *old}))
+
+
+@receiver(post_save, sender=Booking)
+@receiver(post_delete, sender=Booking)
+def booking_changed(sender, instance, **kwargs):
+    invalidate_event_statistics(instance.event_id)
+
+
+@receiver(pre_delete, sender=Booking)
+def booking_pre_delete(sender, instance, **kwargs):
+    instance._released_places = booking_places(instance)
+
+
+@receiver(post_delete, sender=Booking)
+def booking_deleted(sender, instance, **kwargs):
+    release(instance.__dict__.pop("_released_places", Counter()))
+
+
+@receiver(pre_save, sender=Event)
+def event_pre_save(sender, instance, **kwargs):
+    # also for fixtures, which are saved without Event.save
+    instance.begin_day = local_day(instance.begin_date)
+
+
+@receiver(post_save, sender=Event)
+@receiver(post_delete, sender=Event)
+def event_changed(sender, instance, **kwargs):
+    bump_version(instance.pk)
+
+
+@receiver(post_save, sender=Event)
+def event_logo_saved(sender, instance, **kwargs):
+    if instance.logo:
+        schedule([instance.logo.name], [instance.pk])
+
+
+@receiver(post_save, sender=WebPage)
+def page_images_saved(sender, instance, **kwargs):
+    schedule(page_images(instance.html), [instance.event_id])
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Day)
+@receiver(post_delete, sender=Day)
+@receiver(post_save, sender=Discipline)
+@receiver(post_delete, sender=Discipline)
+@receiver(post_save, sender=Document)
+@receiver(post_delete, sender=Document)
+@receiver(post_save, sender=WebPage)
+@receiver(post_delete, sender=WebPage)
+def event_part_changed(sender, instance, **kwargs):
+    bump_version(instance.event_id)
+
+
+@receiver(m2m_changed, sender=Rate.disciplines.through)
+def rate_disciplines_changed(sender, instance, action, reverse, **kwargs):
+    if action.startswith("post_"):
+        bump_version(instance.event_id)
+
+
+@receiver(post_save, sender=ProductVariant)
+@receiver(post_delete, sender=ProductVariant)
+def variant_version(sender, instance, **kwargs):
+    for event_id in Product.objects.filter(pk=instance.product_id).values_list("event_id", flat=True):
+        bump_version(event_id)
@@ -0,0 +1,277 @@
+"""Imports bank statements (CAMT.053) and PayPal CSV exports as transactions.
+
+Statements are read line by line and each line is matched to a booking with
+an in-memory index of the bookings, built with a single query:
+
+1. a booking code in the reference text,
+2. the name of the payer, if only one booking has it, or only one of those
+   still has the amount open,
+3. a similar name among the bookings with exactly that amount open that
+   share at least a first or last name with the payer.
+
+Outgoing payments (debits) are only matched by a booking code: a name alone
+doesn't tell a refund to a participant from any other payment to them.
+
+Matched lines become ``Transaction`` rows, inserted with ``bulk_create``.
+Statement lines are identified by their ``nr``, lines imported before are
+skipped, so a statement can be imported again.
+"""
+import csv
+import hashlib
+import io
+import re
+import unicodedata
+from collections import defaultdict, namedtuple
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from difflib import SequenceMatcher
+
+from django.db import transaction
+from django.utils import timezone
+from lxml import etree
+
+from registration.ledger import refresh_balances
+from registration.models import Booking, Transaction
+
+StatementLine = namedtuple("StatementLine", "nr datum betrag gebuehr name text")
+Match = namedtuple("Match", "line booking_id method")
+ImportResult = namedtuple("ImportResult", "imported duplicates unmatched")
+
+# also bounds the number of query parameters
+BATCH_SIZE = 500
+NR_LENGTH = Transaction._meta.get_field("nr").max_length
+FUZZY_CUTOFF = 0.8
+CODE_RE = re.compile(r"\b[a-z0-9]{8}\b")
+
+
+def normalize(name):
+    name = unicodedata.normalize("NFKD", name or "").encode("ascii", "ignore").decode().lower()
+    return " ".join(re.findall(r"[a-z0-9]+", name))
+
+
+def parse_amount(value):
+    """Parses amounts like ``1.234,56``, ``1,234.56`` and ``-0,59``."""
+    value = (value or "").strip().replace(" ", "")
+    if not value:
+        return Decimal(0)
+    if "," in value and value.rfind(",") > value.rfind("."):
+        value = value.replace(".", "").replace(",", ".")
+    else:
+        value = value.replace(",", "")
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        raise ValueError("Invalid amount: %s" % value)
+
+
+def line_nr(*parts):
+    # statements without a reference get a stable one from the line's content
+    return "sha1:" + hashlib.sha1("|".join(str(part) for part in parts).encode()).hexdigest()
+
+
+def child_text(element, path):
+    found = element.find(path)
+    return found.text.strip() if found is not None and found.text else ""
+
+
+def parse_camt053(fileobj):
+    """Yields the lines of a CAMT.053 bank statement, one ``Ntry``/``TxDtls`` at a time."""
+    for event, entry in etree.iterparse(fileobj, tag="{*}Ntry"):
+        credit = child_text(entry, "{*}CdtDbtInd") == "CRDT"
+        booked = child_text(entry, "{*}BookgDt/{*}Dt") or child_text(entry, "{*}BookgDt/{*}DtTm")[:10] \
+            or child_text(entry, "{*}ValDt/{*}Dt")
+        datum = timezone.make_aware(datetime.strptime(booked, "%Y-%m-%d")) if booked else timezone.now()
+        details = entry.findall("{*}NtryDtls/{*}TxDtls")
+
+        for number, detail in enumerate(details or [entry]):
+            amount = child_text(detail, "{*}AmtDtls/{*}TxAmt/{*}Amt") or child_text(detail, "{*}Amt")
+            if not amount or len(details) <= 1:
+                amount = child_text(entry, "{*}Amt")
+            betrag = parse_amount(amount) * (1 if credit else -1)
+
+            party = "{*}RltdPties/{*}Dbtr" if credit else "{*}RltdPties/{*}Cdtr"
+            name = child_text(detail, party + "/{*}Nm") or child_text(detail, party + "/{*}Pty/{*}Nm")
+            text = " ".join(
+                node.text.strip() for node in detail.iterfind("{*}RmtInf/{*}Ustrd") if node.text
+            ) or child_text(entry, "{*}AddtlNtryInf")
+
+            nr = child_text(detail, "{*}Refs/{*}AcctSvcrRef") or child_text(entry, "{*}AcctSvcrRef")
+            if nr and len(details) > 1 and not child_text(detail, "{*}Refs/{*}AcctSvcrRef"):
+                nr = "%s/%d" % (nr, number)
+            nr = nr or line_nr(booked, betrag, name, text, number)
+
+            yield StatementLine(nr[:NR_LENGTH], datum, betrag, Decimal(0), name, text)
+
+        # keep the tree from growing while the file is read
+        entry.clear()
+        while entry.getprevious() is not None:
+            del entry.getparent()[0]
+
+
+PAYPAL_COLUMNS = {
+    "nr": ("Transaction ID", "Transaktionscode"),
+    "date": ("Date", "Datum"),
+    "time": ("Time", "Uhrzeit"),
+    "name": ("Name",),
+    "gross": ("Gross", "Brutto"),
+    "fee": ("Fee", "Gebühr"),
+    "status": ("Status",),
+    "subject": ("Subject", "Betreff"),
+    "note": ("Note", "Hinweis"),
+    "invoice": ("Invoice Number", "Rechnungsnummer"),
+}
+PAYPAL_COMPLETED = ("Completed", "Abgeschlossen")
+
+
+def parse_paypal_csv(fileobj):
+    """Yields the completed payments of a PayPal activity CSV export (English or German)."""
+    if not isinstance(fileobj, io.TextIOBase):
+        fileobj = io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline="")
+    reader = csv.DictReader(fileobj)
+    header = {name.strip(): name for name in reader.fieldnames or ()}
+    columns = {
+        key: next((header[name] for name in names if name in header), None)
+        for key, names in PAYPAL_COLUMNS.items()
+    }
+    if columns["nr"] is None or columns["gross"] is None:
+        raise ValueError("Not a PayPal CSV export")
+
+    def get(row, key):
+        return (row.get(columns[key]) or "").strip() if columns[key] else ""
+
+    for row in reader:
+        if columns["status"] and get(row, "status") not in PAYPAL_COMPLETED:
+            continue
+        day = get(row, "date")
+        datum = timezone.now()
+        for date_format in ("%d.%m.%Y", "%m/%d/%Y", "%d/%m/%Y", "%Y-%m-%d"):
+            try:
+                datum = datetime.strptime(day + " " + (get(row, "time") or "00:00:00"), date_format + " %H:%M:%S")
+                datum = timezone.make_aware(datum)
+                break
+            except ValueError:
+                continue
+
+        text = " ".join(get(row, key) for key in ("subject", "note", "invoice") if get(row, key))
+        yield StatementLine(get(row, "nr")[:NR_LENGTH], datum, parse_amount(get(row, "gross")),
+                            abs(parse_amount(get(row, "fee"))), get(row, "name"), text)
+
+
+class BookingIndex(object):
+    """The bookings payments can be matched to, indexed by code, name and open amount."""
+
+    def __init__(self, bookings):
+        self.codes = {}
+        self.names = defaultdict(list)
+        self.open = {}
+        self.by_open = defaultdict(set)
+        self.full_names = {}
+        self.tokens = defaultdict(set)
+
+        rows = bookings.exclude(state="canceled").values_list("pk", "code", "first_name", "last_name", "open_amount")
+        for pk, code, first_name, last_name, open_amount in rows.iterator():
+            self.codes[code.lower()] = pk
+            name = normalize("%s %s" % (first_name, last_name))
+            self.full_names[pk] = name
+            for token in name.split():
+                self.tokens[token].add(pk)
+            self.names[name].append(pk)
+            reversed_name = normalize("%s %s" % (last_name, first_name))
+            if reversed_name != name:
+                self.names[reversed_name].append(pk)
+            self.open[pk] = open_amount
+            self.by_open[open_amount].add(pk)
+
+    def settle(self, pk, amount):
+        """Books ``amount`` onto the open amount of ``pk``, for later lines of the same statement."""
+        self.by_open[self.open[pk]].discard(pk)
+        self.open[pk] -= amount
+        self.by_open[self.open[pk]].add(pk)
+
+    def match(self, line):
+        for code in CODE_RE.findall(line.text.lower()):
+            if code in self.codes:
+                return self.codes[code], "code"
+
+        name = normalize(line.name)
+        if not name or line.betrag < 0:
+            return None, None
+
+        candidates = self.names.get(name, [])
+        if len(candidates) == 1:
+            return candidates[0], "name"
+        open_candidates = [pk for pk in candidates if self.open[pk] == line.betrag]
+        if len(open_candidates) == 1:
+            return open_candidates[0], "name"
+        if candidates:
+            return None, None
+
+        # only bookings sharing a part of the name with the payer are compared
+        # like difflib.get_close_matches: the payer's name is analysed once and
+        # the cheap upper bounds rule out most candidates before ratio()
+        candidates = set()
+        for token in name.split():
+            candidates |= self.tokens.get(token, set())
+        matcher = SequenceMatcher()
+        matcher.set_seq2(name)
+        best, best_ratio = None, FUZZY_CUTOFF
+        for pk in candidates & self.by_open.get(line.betrag, set()):
+            matcher.set_seq1(self.full_names[pk])
+            if matcher.real_quick_ratio() > best_ratio and matcher.quick_ratio() > best_ratio:
+                ratio = matcher.ratio()
+                if ratio > best_ratio:
+                    best, best_ratio = pk, ratio
+        return best, ("fuzzy" if best else None)
+
+
+def import_statement(lines, mittel, bookings=None, dry_run=False):
+    """Matches statement ``lines`` to ``bookings`` and creates their transactions.
+
+    Returns the matches created, the number of lines imported before and the
+    lines no booking was found for.
+    """
+    index = BookingIndex(bookings if bookings is not None else Booking.objects.all())
+    imported, unmatched, duplicates = [], [], 0
+    seen = set()
+
+    def flush(batch):
+        nonlocal duplicates
+        known = set(Transaction.objects.filter(mittel=mittel, nr__in=[line.nr for line in batch])
+                    .values_list("nr", flat=True))
+        for line in batch:
+            if line.nr in known or line.nr in seen:
+                duplicates += 1
+                continue
+            seen.add(line.nr)
+            booking_id, method = index.match(line)
+            if booking_id is None:
+                unmatched.append(line)
+                continue
+            index.settle(booking_id, line.betrag)
+            imported.append(Match(line, booking_id, method))
+
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= BATCH_SIZE:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+
+    if imported and not dry_run:
+        with transaction.atomic():
+            Transaction.objects.bulk_create([
+                Transaction(
+                    booking_id=match.booking_id, mittel=mittel, nr=match.line.nr,
+                    typ="incoming" if match.line.betrag >= 0 else "refund",
+                    betrag=match.line.betrag, gebuehr=match.line.gebuehr,
+                    grund=match.line.text[:255], datum=match.line.datum,
+                )
+                for match in imported
+            ], batch_size=BATCH_SIZE)
+            booking_ids = sorted({match.booking_id for match in imported})
+            for start in range(0, len(booking_ids), BATCH_SIZE):
+                refresh_balances(Booking.objects.filter(pk__in=booking_ids[start:start + BATCH_SIZE]))
+
+    return ImportResult(imported, duplicates, unmatched)
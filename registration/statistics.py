@@ -0,0 +1,72 @@
+from collections import Counter, OrderedDict
+
+from django.core.cache import cache
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+from django_countries import countries
+
+from registration import routing
+from registration.models import Booking, ESSEN_CHOICES, Rate, STATUS_CHOICES
+
+CACHE_KEY = "registration:event-statistics:%s"
+CACHE_TIMEOUT = 300
+
+DIMENSIONS = ("state", "food", "rate", "country", "club", "age_band", "day")
+
+
+def event_statistics(event):
+    """Counts the bookings of ``event`` by every dimension in one query, plus one for the rate labels.
+
+    The bookings are grouped by all dimensions at once, each group row is
+    then added to the per-dimension counters. Rates are counted by id, as
+    several may have the same label, and age bands are the ones of
+    ``BookingQuerySet.with_age`` the admin filters by. Returns an ordered
+    mapping of dimension to ``(key, label, count)`` tuples, plus the total.
+    """
+    groups = Booking.objects.filter(event=event).order_by().with_age().annotate(
+        day=TruncDate("date"),
+    ).values_list(
+        "state", "food", "rate_id", "country", "club", "age_band", "day"
+    ).annotate(count=Count("pk"))
+
+    counters = OrderedDict((dimension, Counter()) for dimension in DIMENSIONS)
+    total = 0
+    for row in groups:
+        count = row[-1]
+        total += count
+        for dimension, key in zip(DIMENSIONS, row):
+            counters[dimension][key] += count
+
+    labels = {
+        "state": dict(STATUS_CHOICES),
+        "food": dict(ESSEN_CHOICES),
+        "country": dict(countries),
+        "rate": dict(Rate.objects.filter(pk__in=[key for key in counters["rate"] if key is not None])
+                     .values_list("pk", "label")),
+    }
+
+    statistics = OrderedDict(total=total)
+    for dimension, counter in counters.items():
+        if dimension == "day":
+            keys = sorted(counter, key=lambda day: (day is None, day))
+        else:
+            keys = sorted(counter, key=lambda key: (-counter[key], str(key)))
+        statistics[dimension] = [
+            (key, str(labels.get(dimension, {}).get(key, key if key not in (None, "") else "-")), counter[key])
+            for key in keys
+        ]
+    return statistics
+
+
+def get_event_statistics(event):
+    key = CACHE_KEY % event.pk
+    statistics = cache.get(key)
+    if statistics is None:
+        with routing.primary():
+            statistics = event_statistics(event)
+        cache.set(key, statistics, CACHE_TIMEOUT)
+    return statistics
+
+
+def invalidate_event_statistics(event_id):
+    cache.delete(CACHE_KEY % event_id)
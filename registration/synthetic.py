@@ -0,0 +1,201 @@
+"""Generates events with bookings and payments for benchmarks and load tests.
+
+Everything but the booking codes is derived from a seeded ``random.Random``,
+so the same seed and sizes always produce the same data set. Bookings, their
+relations and their transactions are written with ``bulk_create``; amounts,
+balances and quota counters are then computed set-based like everywhere else,
+since bulk inserts skip the signal handlers.
+"""
+import random
+from collections import Counter, defaultdict
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.utils import timezone
+
+from registration.ledger import refresh_balances
+from registration.models import Booking, Day, Discipline, Event, Price, Product, ProductVariant, Rate, Transaction
+from registration.pricing import update_amounts
+
+SLUG_PREFIX = "synthetic-"
+BATCH_SIZE = 500
+
+FIRST_NAMES = ("Anna", "Ben", "Clara", "David", "Emma", "Felix", "Greta", "Hannah", "Jonas", "Lea", "Lukas",
+               "Marie", "Max", "Mia", "Noah", "Paul", "Sophie", "Tim", "Zoë", "Émile", "Jörg", "Núria")
+LAST_NAMES = ("Bauer", "Becker", "Dubois", "Fischer", "Hoffmann", "Koch", "Meyer", "Müller", "Núñez", "Richter",
+              "Schäfer", "Schmidt", "Schneider", "Schulz", "Straßer", "Wagner", "Weber", "Weiß", "Wolf")
+CLUBS = ("", "Einradverein München", "RSV Köln", "Uni Hamburg", "Club Unicycle Paris", "TSV Stuttgart",
+         "Einrad-Hockey Berlin", "Unicycle Club Zürich", "MTV Bremen")
+DISCIPLINES = (("100m", "100 m"), ("ir", "IUF slalom"), ("fs", "freestyle"), ("muni", "muni downhill"),
+               ("trial", "trial"), ("hockey", "hockey"), ("marathon", "marathon"), ("street", "street"))
+DAY_NAMES = ("Thursday", "Friday", "Saturday", "Sunday", "Monday")
+SHIRT_SIZES = ("XS", "S", "M", "L", "XL", "XXL")
+
+
+def create_event(rng, admin, number, begin):
+    event = Event.objects.create(
+        name="Synthetic event %d" % number, slug="%s%d" % (SLUG_PREFIX, number),
+        description="Generated for benchmarks", host="Synthetic host", admin=admin,
+        contact_name="Benchmark", contact_email="benchmark@example.com",
+        begin_date=timezone.make_aware(datetime.combine(begin, datetime.min.time())),
+        end_date=timezone.make_aware(datetime.combine(begin + timedelta(days=len(DAY_NAMES) - 1),
+                                                      datetime.min.time())),
+    )
+    days = [
+        Day.objects.create(event=event, day=name, order=i, arrival=i < 2, departure=i >= len(DAY_NAMES) - 2)
+        for i, name in enumerate(DAY_NAMES)
+    ]
+    disciplines = [
+        Discipline.objects.create(event=event, code=code, label=label, order=i)
+        for i, (code, label) in enumerate(DISCIPLINES)
+    ]
+
+    # age bands, plus a rate for helpers that don't ride
+    rates = []
+    bands = ((None, 14), (14, 18), (18, 30), (30, None))
+    for i, (youngest, oldest) in enumerate(bands):
+        rates.append(Rate.objects.create(
+            event=event, label="Rider %s-%s" % (youngest or "", oldest or ""),
+            dob_from=begin.replace(year=begin.year - oldest) if oldest else None,
+            dob_to=begin.replace(year=begin.year - youngest) if youngest else None,
+        ))
+    rates.append(Rate.objects.create(event=event, label="Helper", non_rider=True))
+    for rate in rates:
+        if not rate.non_rider:
+            rate.disciplines.set(rng.sample(disciplines, rng.randint(3, len(disciplines))))
+
+    # an early bird price, then a regular one, per rate
+    early = begin - timedelta(days=120)
+    prices = []
+    for rate in rates:
+        base = Decimal(rng.choice((40, 60, 80, 100)))
+        prices.append(Price(rate=rate, valid_until=early, price=base))
+        prices.append(Price(rate=rate, valid_from=early + timedelta(days=1), price=base + 20))
+        prices.append(Price(rate=rate, valid_from=early + timedelta(days=1), price_day=base / 4 + 5))
+    Price.objects.bulk_create(prices)
+
+    products = (
+        ("shirt", "T-shirt", False, [(size, 15) for size in SHIRT_SIZES]),
+        ("meal", "Dinner", False, [("Dinner", 12)]),
+        ("accommodation", "Accommodation", True, [("Gym", 0), ("Tent", 5), ("Hostel", 90)]),
+    )
+    variants = {}
+    for order, (kind, name, required, choices) in enumerate(products):
+        product = Product.objects.create(event=event, kind=kind, name=name, required=required, order=order)
+        variants[product] = [
+            ProductVariant.objects.create(product=product, name=variant, price=Decimal(price), order=i)
+            for i, (variant, price) in enumerate(choices)
+        ]
+
+    return event, days, disciplines, rates, variants
+
+
+def booking_rows(rng, event, begin, days, rates, count):
+    for i in range(count):
+        rate = rng.choice(rates)
+        if rate.dob_from is None and rate.dob_to is None:
+            youngest, oldest = 18, 60
+        else:
+            youngest = begin.year - rate.dob_to.year if rate.dob_to else 6
+            oldest = begin.year - rate.dob_from.year - 1 if rate.dob_from else 70
+        age = rng.randint(youngest, oldest)
+        arrival = rng.choice([day for day in days if day.arrival])
+        departure = rng.choice([day for day in days if day.departure])
+        yield Booking(
+            event=event, rate=rate, first_name=rng.choice(FIRST_NAMES), last_name=rng.choice(LAST_NAMES),
+            email="rider%d@example.com" % i, club=rng.choice(CLUBS), sex=rng.choice(("f", "m")),
+            date_of_birth=begin - timedelta(days=age * 365 + rng.randint(0, 364)),
+            food=rng.choice(("all", "all", "all", "v", "vv")), arrival=arrival, departure=departure,
+            state=rng.choice(("open", "progress", "confirmed", "confirmed", "confirmed", "canceled")),
+            city=rng.choice(("München", "Köln", "Hamburg", "Paris", "Zürich")), country="DE",
+        )
+
+
+def create_bookings(rng, event, begin, days, disciplines, rates, variants, count, transactions):
+    """Creates ``count`` bookings of ``event``, returns the number of transactions."""
+    created = list(booking_rows(rng, event, begin, days, rates, count))
+    for start in range(0, len(created), BATCH_SIZE):
+        batch = Booking.objects.bulk_create(created[start:start + BATCH_SIZE])
+        # not every database returns the keys of bulk inserts
+        pks = dict(Booking.objects.filter(code__in=[booking.code for booking in batch]).values_list("code", "pk"))
+        for booking in batch:
+            booking.pk = pks[booking.code]
+
+    # registrations come in over the months before the event, more of them towards its start
+    by_day, dates = defaultdict(list), {}
+    for booking in created:
+        days_before = int(rng.triangular(0, 240, 10))
+        by_day[days_before].append(booking.pk)
+    for days_before, pks in by_day.items():
+        booked = timezone.make_aware(datetime.combine(begin - timedelta(days=days_before), datetime.min.time()))
+        for start in range(0, len(pks), BATCH_SIZE):
+            Booking.objects.filter(pk__in=pks[start:start + BATCH_SIZE]).update(date=booked)
+        dates.update((pk, booked) for pk in pks)
+
+    rate_disciplines = {rate.pk: list(rate.disciplines.all()) for rate in rates}
+    DisciplineThrough = Booking.disciplines.through
+    VariantThrough = Booking.variants.through
+    chosen_disciplines, chosen_variants = [], []
+    for booking in created:
+        offered = rate_disciplines[booking.rate_id]
+        for discipline in rng.sample(offered, min(len(offered), rng.randint(0, 4))):
+            chosen_disciplines.append(DisciplineThrough(booking_id=booking.pk, discipline_id=discipline.pk))
+        for product, product_variants in variants.items():
+            if product.required or rng.random() < 0.6:
+                chosen_variants.append(VariantThrough(booking_id=booking.pk,
+                                                      productvariant_id=rng.choice(product_variants).pk))
+    DisciplineThrough.objects.bulk_create(chosen_disciplines, batch_size=BATCH_SIZE)
+    VariantThrough.objects.bulk_create(chosen_variants, batch_size=BATCH_SIZE)
+
+    bookings = Booking.objects.filter(event=event)
+    update_amounts(bookings)
+
+    payments = []
+    amounts = dict(bookings.values_list("pk", "amount"))
+    for booking in created:
+        if rng.random() >= transactions:
+            continue
+        amount = amounts[booking.pk]
+        mittel = rng.choice(("paypal", "paypal", "wire", "cash"))
+        paid = amount if rng.random() < 0.8 else (amount / 2).quantize(Decimal("0.01"))
+        payments.append(Transaction(
+            booking_id=booking.pk, typ="incoming", mittel=mittel, betrag=paid,
+            gebuehr=(paid * Decimal("0.0249") + Decimal("0.35")).quantize(Decimal("0.01")) if mittel == "paypal" else 0,
+            nr="SYN%d-%d" % (event.pk, booking.pk) if mittel != "cash" else "",
+            grund=booking.code, datum=dates[booking.pk] + timedelta(days=rng.randint(0, 14)),
+        ))
+    Transaction.objects.bulk_create(payments, batch_size=BATCH_SIZE)
+    refresh_balances(bookings)
+    count_places(bookings)
+    return len(payments)
+
+
+def count_places(bookings):
+    active = bookings.exclude(state="canceled")
+    for rate_id, count in Counter(active.values_list("rate_id", flat=True)).items():
+        Rate.objects.filter(pk=rate_id).update(booked=count)
+    through = Booking.variants.through.objects.filter(booking__in=active.values("pk"))
+    for variant_id, count in Counter(through.values_list("productvariant_id", flat=True)).items():
+        ProductVariant.objects.filter(pk=variant_id).update(booked=count)
+
+
+def generate(admin, events=1, bookings=10000, transactions=0.7, seed=1):
+    """Creates ``events`` events with ``bookings`` bookings each.
+
+    ``transactions`` is the share of bookings that paid. Returns the events.
+    """
+    rng = random.Random(seed)
+    first = Event.objects.filter(slug__startswith=SLUG_PREFIX).count()
+    created = []
+    for number in range(first, first + events):
+        begin = date(2021, 7, 1) + timedelta(days=7 * number)
+        with transaction.atomic():
+            event, days, disciplines, rates, variants = create_event(rng, admin, number, begin)
+            create_bookings(rng, event, begin, days, disciplines, rates, variants, bookings, transactions)
+        created.append(event)
+    return created
+
+
+def delete_all():
+    return Event.objects.filter(slug__startswith=SLUG_PREFIX).delete()
@@ -1,3 +1,1787 @@
-from django.test import TestCase
+import csv
+import hashlib
+import hmac
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date, datetime
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import openpyxl
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+from PIL import Image
+from django.contrib.auth.models import Permission, User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.core.signals import request_finished
+from django.db import OperationalError, connection, connections, router, transaction
+from django.db.models import Count, Q
+from django.forms import modelform_factory
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone, translation
+from django.utils.functional import lazy
+
+from registration import benchmarks, codes, documents, export, images, instrumentation, payments, routing, synthetic, \
+    uploads
+from registration.admin import BookingForm
+from registration.attachments import missing_documents
+from registration.eligibility import get_rate_index
+from registration.export import headers, iter_rows, stream_csv, write_xlsx
+from registration.handlers import PooledASGIHandler
+from registration.instrumentation import QueryBudgetExceeded
+from registration.ledger import refresh_balances, stale_balances
+from registration.models import Attachment, Booking, CodeSequence, Day, Discipline, Document, Event, ImageDerivative, \
+    PersistedQuery, Price, Product, ProductVariant, Rate, Transaction, Upload, WebPage, blob_name
+from registration.pricing import PriceTimeline, update_amounts
+from registration.quotas import SoldOut
+from registration.search import filter_bookings, search_bookings
+from registration.statements import import_statement, parse_camt053, parse_paypal_csv
+from registration.statistics import get_event_statistics
+from registration.views import CachedGraphQLView
+from unicycle_events.schema import schema
+
+
+def create_event(admin, i=0):
+    return Event.objects.create(
+        name="Event %d" % i, slug="event-%d" % i, description="", host="", admin=admin,
+        contact_name="", contact_email="event@example.com",
+        begin_date=timezone.make_aware(datetime(2020, 7, 1)),
+        end_date=timezone.make_aware(datetime(2020, 7, 5)),
+    )
+
+
+def create_booking(event, **kwargs):
+    return Booking.objects.create(**dict({
+        "event": event, "first_name": "Rider", "last_name": "One", "email": "rider@example.com",
+        "date_of_birth": date(2000, 1, 1), "food": "all",
+    }, **kwargs))
+
+
+EVENTS_QUERY = """
+query Events {
+  allEvents { edges { node { name rates { edges { node { label disciplines { edges { node { code } } } } } } } } }
+}
+"""
+
+
+@override_settings(GRAPHQL_QUERY_BUDGET_STRICT=True, GRAPHQL_QUERY_BUDGETS={"Events": 4})
+class QueryBudgetTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        admin = User.objects.create(username="admin")
+        for i in range(10):
+            event = create_event(admin, i)
+            Rate.objects.create(event=event, label="Rate %d" % i)
+
+    def query(self):
+        return self.client.post("/graphql", json.dumps({"query": EVENTS_QUERY}), content_type="application/json")
+
+    def test_events_within_budget(self):
+        response = self.query()
+        self.assertEqual(len(response.json()["data"]["allEvents"]["edges"]), 10)
+
+    @override_settings(GRAPHQL_QUERY_BUDGETS={"Events": 3})
+    def test_budget_exceeded(self):
+        with self.assertRaises(QueryBudgetExceeded):
+            self.query()
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        instrumentation.reset_metrics()
+        self.addCleanup(instrumentation.reset_metrics)
+        patcher = mock.patch.object(documents, "_operations", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        create_event(User.objects.create(username="admin"))
+        PersistedQuery.objects.create(sha256=documents.query_hash(EVENTS_QUERY), name="events.graphql", query=EVENTS_QUERY)
+
+    def query(self, query):
+        self.client.post("/graphql", json.dumps({"query": query}), content_type="application/json")
+
+    def test_registered_operations(self):
+        self.query(EVENTS_QUERY)
+        for i in range(3):
+            self.query("query Client%d { allEvents { edges { node { name } } } }" % i)
+        metrics = instrumentation.metrics()
+        self.assertEqual(sorted(metrics), ["(other)", "Events"])
+        self.assertEqual(metrics["(other)"]["count"], 3)
+
+    @mock.patch.object(instrumentation, "METRICS_FIELDS", 3)
+    def test_field_limit(self):
+        aliases = " ".join("a%d: allEvents { edges { node { name } } }" % i for i in range(10))
+        self.query("query Aliases { %s }" % aliases)
+        fields = instrumentation.metrics()["(other)"]["fields"]
+        self.assertEqual(len(fields), 4)
+        self.assertIn("(other)", fields)
+
+
+def retry(func):
+    # SQLite's shared in-memory test database reports lock conflicts at once
+    # instead of waiting for the lock, the caller has to try again
+    while True:
+        try:
+            return func()
+        except OperationalError as e:
+            if "locked" not in str(e):
+                raise
+            time.sleep(random.uniform(0.001, 0.01))
+
+
+class QuotaConcurrencyTest(TransactionTestCase):
+    """Hundreds of bookings at once must not take more places than there are."""
+    attempts = 300
+
+    def setUp(self):
+        self.event = create_event(User.objects.create(username="admin"))
+        self.rate = Rate.objects.create(event=self.event, label="Rider", capacity=100)
+        product = Product.objects.create(event=self.event, kind="shirt", name="Shirt")
+        self.variant = ProductVariant.objects.create(product=product, name="M", price=10, capacity=40)
+
+    def book(self, i):
+        try:
+            booking = retry(lambda: Booking.objects.create(
+                event=self.event, rate=self.rate, first_name="Rider", last_name=str(i),
+                email="rider@example.com", date_of_birth=date(2000, 1, 1), food="all",
+            ))
+            try:
+                retry(lambda: booking.variants.add(self.variant))
+            except SoldOut:
+                pass
+            return True
+        except SoldOut:
+            return False
+        finally:
+            connection.close()
+
+    def test_no_oversell(self):
+        with ThreadPoolExecutor(max_workers=10) as pool:
+            results = list(pool.map(self.book, range(self.attempts)))
+
+        self.rate.refresh_from_db()
+        self.variant.refresh_from_db()
+        self.assertEqual(results.count(True), 100)
+        self.assertEqual(self.rate.booked, 100)
+        self.assertEqual(Booking.objects.filter(rate=self.rate).count(), 100)
+        self.assertEqual(self.variant.booked, 40)
+        self.assertEqual(Booking.variants.through.objects.filter(productvariant=self.variant).count(), 40)
+
+
+class BenchmarkTest(TestCase):
+    """The benchmarks must keep working against the current schema and admin."""
+
+    def test_benchmarks_run(self):
+        user = benchmarks.benchmark_user()
+        event, = synthetic.generate(user, bookings=50, seed=3)
+        self.assertEqual(Booking.objects.filter(event=event).count(), 50)
+
+        results = benchmarks.run(event, user, repeat=1)
+        self.assertEqual(set(results["results"]), {benchmark.name for benchmark in benchmarks.benchmarks(event, user)})
+        lines, regressed = benchmarks.compare(results, results)
+        self.assertFalse(regressed)
+
+    def test_replica_queries(self):
+        # reads routed to a replica count as well
+        replica = dict(connections.databases["default"], NAME=":memory:")
+        with mock.patch.dict(connections.databases, {routing.REPLICA: replica}):
+            self.addCleanup(connections[routing.REPLICA].close)
+            replica_query = lambda: connections[routing.REPLICA].cursor().execute("SELECT 1")
+            self.assertEqual(benchmarks.Benchmark("replica", replica_query).measure(repeat=1)["queries"], 1)
+
+
+class PooledASGIHandlerTest(TransactionTestCase):
+    """Under ASGI, views and streamed responses must query the database off the event loop."""
+
+    def setUp(self):
+        self.event = create_event(User.objects.create(username="admin"))
+        self.handler = PooledASGIHandler(threads=2)
+
+    @async_to_sync
+    async def get(self, path, query_string=b""):
+        communicator = ApplicationCommunicator(self.handler, {
+            "type": "http", "method": "GET", "path": path, "query_string": query_string,
+            "headers": [(b"host", b"testserver"), (b"accept", b"application/json")],
+        })
+        await communicator.send_input({"type": "http.request"})
+        start = await communicator.receive_output(5)
+        body = b""
+        while True:
+            message = await communicator.receive_output(5)
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                await communicator.wait(5)
+                return start["status"], body
+
+    def finished(self):
+        # the threads request_finished is sent on, which closes their database connections
+        threads = []
+
+        def receiver(**kwargs):
+            threads.append(threading.current_thread().name.split("_")[0])
+
+        request_finished.connect(receiver)
+        self.addCleanup(request_finished.disconnect, receiver)
+        return threads
+
+    def test_graphql(self):
+        finished = self.finished()
+        status, body = self.get("/graphql", b"query=%7BallEvents%7Bedges%7Bnode%7Bname%7D%7D%7D%7D")
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode())["data"]["allEvents"]["edges"], [{"node": {"name": "Event 0"}}])
+        self.assertEqual(finished, ["asgi"])
+
+    def test_streamed_view(self):
+        finished = self.finished()
+        closed = []
+        response = StreamingHttpResponse(iter([b"a", b"b"]))
+        with mock.patch("registration.handlers.BaseHandler.get_response", return_value=response), \
+                mock.patch("registration.handlers.close_old_connections",
+                           side_effect=lambda: closed.append(threading.current_thread().name.split("_")[0])):
+            self.assertEqual(self.get("/export"), (200, b"ab"))
+        self.assertEqual(closed, ["asgi"])
+        self.assertEqual(finished, ["asgi-stream"])
+
+    def test_streaming_response(self):
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        response = StreamingHttpResponse(
+            "%s\n" % name for name in Event.objects.values_list("name", flat=True).iterator()
+        )
+        async_to_sync(self.handler.send_response)(response, send)
+        self.assertEqual(b"".join(message.get("body", b"") for message in sent[1:]), b"Event 0\n")
+
+
+class ReplicaRoutingTest(SimpleTestCase):
+    """Safe requests read from the replica, unless the client has just written."""
+    databases = {"default"}
+
+    def setUp(self):
+        replica = mock.patch.dict(connections.databases, {routing.REPLICA: dict(connections.databases["default"])})
+        replica.start()
+        self.addCleanup(replica.stop)
+
+    def route(self, request, write=False):
+        reads = []
+
+        def view(request):
+            if write:
+                Event.objects.filter(pk=0).update(name="")
+            # like the admin change form, that only reads in a transaction
+            with transaction.atomic(using=router.db_for_write(Event)):
+                pass
+            reads.append(router.db_for_read(Event))
+            return HttpResponse()
+
+        response = routing.ReplicaMiddleware(view)(request)
+        return reads[0], response
+
+    def test_routing(self):
+        factory = RequestFactory()
+        self.assertEqual(self.route(factory.get("/"))[0], routing.REPLICA)
+        self.assertEqual(self.route(factory.post("/"))[0], routing.DEFAULT)
+        self.assertEqual(router.db_for_read(Event), routing.DEFAULT)
+
+        db, response = self.route(factory.get("/"))
+        self.assertEqual(db, routing.REPLICA)
+        self.assertNotIn(routing.STICKY_COOKIE, response.cookies)
+
+        db, response = self.route(factory.get("/"), write=True)
+        self.assertEqual(db, routing.DEFAULT)
+        self.assertIn(routing.STICKY_COOKIE, response.cookies)
+
+        factory.cookies[routing.STICKY_COOKIE] = "1"
+        self.assertEqual(self.route(factory.get("/"))[0], routing.DEFAULT)
+
+    def test_primary(self):
+        reads = []
+
+        def view(request):
+            with routing.primary():
+                routing.use_replica()
+                reads.append(router.db_for_read(Event))
+            reads.append(router.db_for_read(Event))
+            return HttpResponse()
+
+        routing.ReplicaMiddleware(view)(RequestFactory().get("/"))
+        self.assertEqual(reads, [routing.DEFAULT, routing.REPLICA])
+
+    def test_caches_filled_from_primary(self):
+        reads = []
+
+        def build(*args):
+            reads.append(router.db_for_read(Event))
+            return {}
+
+        def view(request):
+            with mock.patch("registration.eligibility.RateIndex.build", build), \
+                    mock.patch("registration.statistics.event_statistics", build):
+                get_rate_index(0)
+                get_event_statistics(Event(pk=0))
+            return HttpResponse()
+
+        cache.clear()
+        routing.ReplicaMiddleware(view)(RequestFactory().get("/"))
+        self.assertEqual(reads, [routing.DEFAULT, routing.DEFAULT])
+
+
+CREATE_BOOKING = """
+mutation CreateBooking($input: BookingCreateMutationInput!) {
+  createBooking(input: $input) { code errors { field messages } }
+}
+"""
+
+
+def book(client, event, rate, **data):
+    """Books through the createBooking mutation, like the registration form."""
+    data = dict({
+        "event": event.pk, "rate": rate.pk, "firstName": "Rider", "lastName": "One",
+        "email": "rider@example.com", "dateOfBirth": "2000-01-01",
+    }, **data)
+    response = client.post("/graphql", json.dumps({"query": CREATE_BOOKING, "variables": {"input": data}}),
+                           content_type="application/json")
+    return response.json()["data"]["createBooking"]
+
+
+
+class EventLoaderTest(TestCase):
+    """Nested lists of allEvents are loaded with one query per list, however many events there are."""
+    query = """
+    query AllEvents {
+      allEvents { edges { node { name
+        rates { edges { node { label prices { edges { node { price } } } disciplines { edges { node { code } } } } } }
+        products { edges { node { name variants { edges { node { name price } } } } } }
+      } } }
+    }
+    """
+
+    def setUp(self):
+        # the registered operations are loaded once per process, not per request
+        for name, value in (("_operations", frozenset()), ("_version", None)):
+            patcher = mock.patch.object(documents, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.admin = User.objects.create(username="admin")
+
+    def add_events(self, count):
+        for i in range(Event.objects.count(), Event.objects.count() + count):
+            event = create_event(self.admin, i)
+            for label in ("Rider", "Child"):
+                rate = Rate.objects.create(event=event, label=label)
+                Price.objects.create(rate=rate, price=40)
+                rate.disciplines.add(Discipline.objects.create(event=event, code=label, label=label))
+            product = Product.objects.create(event=event, kind="shirt", name="Shirt")
+            ProductVariant.objects.create(product=product, name="M", price=15)
+
+    def count_queries(self):
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post("/graphql", json.dumps({"query": self.query}), content_type="application/json")
+        edges = response.json()["data"]["allEvents"]["edges"]
+        self.assertTrue(all(len(edge["node"]["rates"]["edges"]) == 2 for edge in edges))
+        return len(edges), len(context)
+
+    def test_constant_queries(self):
+        self.add_events(2)
+        events, queries = self.count_queries()
+        self.add_events(8)
+        self.assertEqual(self.count_queries(), (events + 8, queries))
+
+
+ALL_BOOKINGS = """
+query Bookings($first: Int, $after: String, $last: Int, $before: String, $event: Int, $state: String, $club: String,
+               $checkedIn: Boolean) {
+  allBookings(first: $first, after: $after, last: $last, before: $before, event: $event, state: $state, club: $club,
+              checkedIn: $checkedIn) {
+    edges { node { lastName } }
+    pageInfo { startCursor endCursor hasPreviousPage hasNextPage }
+  }
+}
+"""
+
+
+class BookingPaginationTest(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create(username="admin", is_staff=True)
+        self.event = create_event(self.admin)
+        for i in range(7):
+            create_booking(self.event, last_name="B%d" % i, club="Club" if i % 2 else "", state="open" if i < 5 else "paid")
+        other = create_event(User.objects.create(username="other", is_staff=True), 1)
+        create_booking(other, last_name="Other")
+        self.client.force_login(self.admin)
+
+    def query(self, **variables):
+        response = self.client.post("/graphql", json.dumps({"query": ALL_BOOKINGS, "variables": variables}),
+                                    content_type="application/json")
+        return response.json()
+
+    def page(self, **variables):
+        result = self.query(**variables)["data"]["allBookings"]
+        return [edge["node"]["lastName"] for edge in result["edges"]], result["pageInfo"]
+
+    def test_staff_only(self):
+        self.client.logout()
+        result = self.query()
+        self.assertIsNone(result["data"]["allBookings"])
+        self.assertEqual(result["errors"][0]["message"], "Only staff can see bookings")
+
+        # event admins only see the bookings of their events, superusers all
+        self.client.force_login(self.admin)
+        self.assertEqual(len(self.page()[0]), 7)
+        self.client.force_login(User.objects.create(username="root", is_staff=True, is_superuser=True))
+        self.assertEqual(len(self.page()[0]), 8)
+
+    def test_forward(self):
+        names, info = self.page(first=3)
+        self.assertEqual(names, ["B6", "B5", "B4"])
+        self.assertTrue(info["hasNextPage"])
+        names, info = self.page(first=3, after=info["endCursor"])
+        self.assertEqual(names, ["B3", "B2", "B1"])
+        names, info = self.page(first=3, after=info["endCursor"])
+        self.assertEqual(names, ["B0"])
+        self.assertFalse(info["hasNextPage"])
+
+    def test_backward(self):
+        names, info = self.page(last=3)
+        self.assertEqual(names, ["B2", "B1", "B0"])
+        self.assertTrue(info["hasPreviousPage"])
+        names, info = self.page(last=3, before=info["startCursor"])
+        self.assertEqual(names, ["B5", "B4", "B3"])
+        names, info = self.page(last=3, before=info["startCursor"])
+        self.assertEqual(names, ["B6"])
+        self.assertFalse(info["hasPreviousPage"])
+
+    def test_page_size(self):
+        self.assertEqual(len(self.page()[0]), 7)
+        names, info = self.page(first=0)
+        self.assertEqual(names, [])
+        self.assertTrue(info["hasNextPage"])
+        for variables in ({"first": -1}, {"last": -1}):
+            result = self.query(**variables)
+            self.assertEqual(result["errors"][0]["message"], "Page size must not be negative")
+
+    def test_filters(self):
+        self.assertEqual(self.page(state="paid")[0], ["B6", "B5"])
+        self.assertEqual(self.page(club="Club")[0], ["B5", "B3", "B1"])
+        self.assertEqual(self.page(event=self.event.pk + 1)[0], [])
+        Booking.objects.filter(last_name="B2").update(checkin_date=timezone.now())
+        self.assertEqual(self.page(checkedIn=True)[0], ["B2"])
+        self.assertEqual(len(self.page(checkedIn=False)[0]), 6)
+
+    def test_constant_queries(self):
+        with CaptureQueriesContext(connection) as first_page:
+            names, info = self.page(first=2)
+        while info["hasNextPage"]:
+            with CaptureQueriesContext(connection) as last_page:
+                names, info = self.page(first=2, after=info["endCursor"])
+        self.assertEqual(names, ["B0"])
+        self.assertEqual(len(last_page), len(first_page))
+
+
+class PricingTest(TestCase):
+    """Amounts follow the price valid on the booking date, the days booked and the variants."""
+
+    def setUp(self):
+        self.event = create_event(User.objects.create(username="admin"))
+        self.rate = Rate.objects.create(event=self.event, label="Rider")
+        self.days = [
+            Day.objects.create(event=self.event, day=name, order=i, arrival=i < 2, departure=i >= 2)
+            for i, name in enumerate(("Thursday", "Friday", "Saturday", "Sunday"))
+        ]
+        Price.objects.create(rate=self.rate, valid_until=date(2020, 3, 31), price=40)
+        Price.objects.create(rate=self.rate, valid_from=date(2020, 4, 1), price=60, price_day=20)
+
+    def book(self, **data):
+        return book(self.client, self.event, self.rate, **data)
+
+    def test_timeline(self):
+        timeline = PriceTimeline(self.event.pk)
+        thursday, friday, saturday, sunday = (day.pk for day in self.days)
+        self.assertEqual(timeline.amount(self.rate.pk, date(2020, 3, 1), thursday, sunday), 40)
+        self.assertEqual(timeline.amount(self.rate.pk, date(2020, 5, 1), friday, saturday), 40)
+        # four days at 20 are capped at the total price
+        self.assertEqual(timeline.amount(self.rate.pk, date(2020, 5, 1), thursday, sunday), 60)
+        self.assertEqual(timeline.amount(self.rate.pk, date(2020, 5, 1), None, None), 60)
+
+    def test_create_booking_with_variant(self):
+        product = Product.objects.create(event=self.event, kind="shirt", name="Shirt")
+        variant = ProductVariant.objects.create(product=product, name="M", price=15)
+
+        result = self.book(variants=[variant.pk], arrival=self.days[1].pk, departure=self.days[2].pk)
+        self.assertIsNone(result["errors"])
+        booking = Booking.objects.get(code=result["code"])
+        self.assertEqual(list(booking.variants.all()), [variant])
+        self.assertEqual(booking.amount, 2 * 20 + 15)
+        self.assertEqual(booking.open_amount, booking.amount)
+
+
+class RepricingTest(TestCase):
+    """Price, rate and variant edits reprice the bookings they affect, and only those."""
+
+    def setUp(self):
+        self.event = create_event(User.objects.create(username="admin"))
+        self.rate = Rate.objects.create(event=self.event, label="Rider")
+        self.early = Price.objects.create(rate=self.rate, valid_until=date(2020, 3, 31), price=40)
+        self.late = Price.objects.create(rate=self.rate, valid_from=date(2020, 4, 1), price=60)
+        self.early_booking = self.book(date(2020, 3, 1))
+        self.late_booking = self.book(date(2020, 5, 1))
+
+    def book(self, on, **kwargs):
+        kwargs.setdefault("rate", self.rate)
+        booking = create_booking(self.event, **kwargs)
+        Booking.objects.filter(pk=booking.pk).update(date=timezone.make_aware(datetime.combine(on, datetime.min.time())))
+        update_amounts(Booking.objects.filter(pk=booking.pk))
+        return booking
+
+    def amounts(self):
+        return [Booking.objects.get(pk=booking.pk).amount for booking in (self.early_booking, self.late_booking)]
+
+    def test_booking_date(self):
+        self.assertEqual(self.amounts(), [40, 60])
+
+    def test_price_edit(self):
+        self.late.price = 70
+        self.late.save()
+        self.assertEqual(self.amounts(), [40, 70])
+        self.assertEqual(self.late._reprice_result.checked, 1)
+
+    def test_window_moved(self):
+        # the early price now also covers the late booking
+        self.late.delete()
+        self.early.valid_until = None
+        self.early.save()
+        self.assertEqual(self.amounts(), [40, 40])
+
+    def test_rate_edit(self):
+        child = Rate.objects.create(event=self.event, label="Child", dob_from=date(2010, 1, 1))
+        Price.objects.create(rate=child, price=20)
+        booking = self.book(date(2020, 5, 1), rate=child, date_of_birth=date(2005, 1, 1))
+        self.assertEqual(Booking.objects.get(pk=booking.pk).amount, 20)
+
+        # only the child's bookings in the old or new band are checked
+        child.dob_from = date(2000, 1, 1)
+        child.save()
+        self.assertEqual(child._reprice_result, (1, 0))
+        self.assertEqual(self.amounts(), [40, 60])
+
+    def test_variant_edit(self):
+        product = Product.objects.create(event=self.event, kind="shirt", name="Shirt")
+        variant = ProductVariant.objects.create(product=product, name="M", price=15)
+        self.late_booking.variants.add(variant)
+        self.assertEqual(self.amounts(), [40, 75])
+
+        variant.price = 10
+        variant.save()
+        self.assertEqual(self.amounts(), [40, 70])
+        booking = Booking.objects.get(pk=self.late_booking.pk)
+        self.assertEqual(booking.open_amount, 70)
+
+    def test_variant_delete(self):
+        product = Product.objects.create(event=self.event, kind="shirt", name="Shirt")
+        variant = ProductVariant.objects.create(product=product, name="M", price=15)
+        self.late_booking.variants.add(variant)
+
+        variant.delete()
+        self.assertEqual(self.amounts(), [40, 60])
+        self.assertEqual(Booking.objects.get(pk=self.late_booking.pk).open_amount, 60)
+
+        # deleting the product deletes its variants one by one as well
+        variant = ProductVariant.objects.create(product=product, name="L", price=15)
+        self.early_booking.variants.add(variant)
+        product.delete()
+        self.assertEqual(self.amounts(), [40, 60])
+
+    def test_rate_delete(self):
+        self.rate.delete()
+        self.assertEqual(self.amounts(), [0, 0])
+        self.assertEqual(self.rate._reprice_result, (2, 2))
+        self.assertEqual(Booking.objects.get(pk=self.late_booking.pk).open_amount, 0)
+
+    def test_day_delete(self):
+        days = [Day.objects.create(event=self.event, day=str(i), order=i) for i in range(3)]
+        per_day = Rate.objects.create(event=self.event, label="Per day")
+        Price.objects.create(rate=per_day, price_day=10)
+        booking = self.book(date(2020, 5, 1), rate=per_day, arrival=days[0], departure=days[2])
+        self.assertEqual(Booking.objects.get(pk=booking.pk).amount, 30)
+
+        # without a departure day all days of the event are charged
+        days[2].delete()
+        self.assertEqual(Booking.objects.get(pk=booking.pk).amount, 20)
+        self.assertEqual(self.amounts(), [40, 60])
+
+
+class RateIndexTest(TestCase):
+    """The rate index finds the same rates as filtering by the date of birth band and the price windows."""
+    on = date(2020, 5, 1)
+
+    def setUp(self):
+        self.event = create_event(User.objects.create(username="admin"))
+        rate = lambda label, **kwargs: Rate.objects.create(event=self.event, label=label, **kwargs)
+        self.adult = rate("Adult", dob_to=date(2002, 7, 1))
+        self.youth = rate("Youth", dob_from=date(2002, 7, 2), dob_to=date(2008, 7, 1))
+        self.child = rate("Child", dob_from=date(2008, 7, 2))
+        self.anyone = rate("Anyone")
+        rate("Inactive", is_active=False)
+        self.early = rate("Early", dob_from=date(2000, 1, 1))
+        self.late = rate("Late")
+        Price.objects.create(rate=self.adult, price=60)
+        Price.objects.create(rate=self.early, valid_until=date(2020, 3, 31), price=40)
+        Price.objects.create(rate=self.late, valid_from=date(2020, 6, 1), valid_until=date(2020, 6, 30), price=80)
+
+    def filtered(self, date_of_birth, on):
+        # the queries the index replaces
+        rates = Rate.objects.filter(event=self.event, is_active=True).filter(
+            Q(dob_from__isnull=True) | Q(dob_from__lte=date_of_birth),
+            Q(dob_to__isnull=True) | Q(dob_to__gte=date_of_birth),
+        )
+        valid = Price.objects.filter(
+            Q(valid_from__isnull=True) | Q(valid_from__lte=on),
+            Q(valid_until__isnull=True) | Q(valid_until__gte=on),
+        )
+        return list(rates.filter(Q(prices__isnull=True) | Q(prices__in=valid)).distinct())
+
+    def test_same_as_filter(self):
+        index = get_rate_index(self.event.pk)
+        dates_of_birth = [date(1950, 1, 1), date(1999, 12, 31), date(2000, 1, 1), date(2002, 7, 1), date(2002, 7, 2),
+                          date(2008, 7, 1), date(2008, 7, 2), date(2015, 1, 1)]
+        for on in (date(2020, 3, 31), self.on, date(2020, 6, 1), date(2020, 7, 1)):
+            for date_of_birth in dates_of_birth:
+                self.assertEqual(index.eligible(date_of_birth, on), self.filtered(date_of_birth, on),
+                                 (date_of_birth, on))
+
+    def test_bands(self):
+        # in the order of the rates
+        index = get_rate_index(self.event.pk)
+        self.assertEqual(index.eligible(date(2002, 7, 1), self.on), [self.adult, self.anyone])
+        self.assertEqual(index.eligible(date(2002, 7, 2), self.on), [self.anyone, self.youth])
+        self.assertEqual(index.eligible(date(2008, 7, 2), self.on), [self.anyone, self.child])
+
+    def test_price_windows(self):
+        # rates with prices can only be booked while one of them is valid
+        index = get_rate_index(self.event.pk)
+        self.assertIn(self.early, index.eligible(date(2002, 7, 2), date(2020, 3, 31)))
+        self.assertNotIn(self.early, index.eligible(date(2002, 7, 2), date(2020, 4, 1)))
+        self.assertNotIn(self.late, index.eligible(date(2002, 7, 2), date(2020, 5, 31)))
+        self.assertIn(self.late, index.eligible(date(2002, 7, 2), date(2020, 6, 30)))
+        self.assertNotIn(self.late, index.eligible(date(2002, 7, 2), date(2020, 7, 1)))
+
+    def test_index_invalidated(self):
+        self.assertNotIn(self.late, get_rate_index(self.event.pk).eligible(date(2002, 7, 2), self.on))
+        Price.objects.create(rate=self.late, valid_from=date(2020, 4, 1), price=80)
+        self.assertIn(self.late, get_rate_index(self.event.pk).eligible(date(2002, 7, 2), self.on))
+
+    def test_graphql(self):
+        query = """
+        query Eligible($event: Int!, $dob: Date!, $dobs: [Date!]!, $on: Date) {
+          eligibleRates(eventId: $event, dateOfBirth: $dob, date: $on) { label }
+          eligibleRatesBatch(eventId: $event, datesOfBirth: $dobs, date: $on) { dateOfBirth rates { label } }
+        }
+        """
+        variables = {"event": self.event.pk, "dob": "2002-07-01", "dobs": ["2002-07-02", "2010-01-01"],
+                     "on": self.on.isoformat()}
+        response = self.client.post("/graphql", json.dumps({"query": query, "variables": variables}),
+                                    content_type="application/json")
+        data = response.json()["data"]
+        self.assertEqual([rate["label"] for rate in data["eligibleRates"]], ["Adult", "Anyone"])
+        self.assertEqual([(entry["dateOfBirth"], [rate["label"] for rate in entry["rates"]])
+                          for entry in data["eligibleRatesBatch"]],
+                         [("2002-07-02", ["Anyone", "Youth"]), ("2010-01-01", ["Anyone", "Child"])])
+
+
+class CodeTest(TestCase):
+    def setUp(self):
+        codes._pool.clear()
+
+    def test_permutation(self):
+        key = bytes(32)
+        values = [codes.permute(value, key) for value in range(2000)]
+        self.assertEqual(len(set(values)), len(values))
+        self.assertTrue(all(0 <= value < codes.DOMAIN for value in values))
+        self.assertEqual(codes.encode(0), "aaaaaaaa")
+        self.assertEqual(codes.encode(codes.DOMAIN - 1), "99999999")
+        with self.assertRaises(ValueError):
+            codes.permute(codes.DOMAIN, key)
+
+    def test_unique_codes(self):
+        event = create_event(User.objects.create(username="admin"))
+        issued = [create_booking(event).code for i in range(codes.BLOCK_SIZE + 10)]
+        self.assertEqual(len(set(issued)), len(issued))
+        self.assertTrue(all(len(code) == codes.CODE_LENGTH and set(code) <= set(codes.ALPHABET) for code in issued))
+        self.assertEqual(CodeSequence.objects.get().next_value, 2 * codes.BLOCK_SIZE)
+
+    def test_taken_codes_skipped(self):
+        codes.reserve_block(5)
+        key, start = CodeSequence.objects.values_list("key", "next_value").get()
+        taken = codes.encode(codes.permute(start, bytes.fromhex(key)))
+        create_booking(create_event(User.objects.create(username="admin")), code=taken)
+
+        block = codes.reserve_block(5)
+        self.assertEqual(len(block), 4)
+        self.assertNotIn(taken, block)
+
+    def test_rollback(self):
+        # the reservation is rolled back with the booking, so its code is issued again
+        CodeSequence.objects.create(name=codes.SEQUENCE_NAME, key="00" * 32)
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            first = codes.next_code()
+            raise RuntimeError
+        self.assertIsNone(codes.pending_block())
+        self.assertEqual(codes.next_code(), first)
+
+
+class ExportTest(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create(username="admin", is_staff=True)
+        self.admin.user_permissions.add(Permission.objects.get(codename="view_booking"))
+        self.event = create_event(self.admin)
+        rate = Rate.objects.create(event=self.event, label="Rider")
+        disciplines = [
+            Discipline.objects.create(event=self.event, code=code, label=code, order=order)
+            for order, code in enumerate(("trial", "flat", "muni"))
+        ]
+        product = Product.objects.create(event=self.event, kind="shirt", name="Shirt")
+        variant = ProductVariant.objects.create(product=product, name="M", price=15)
+        self.bookings = []
+        for i in range(5):
+            booking = create_booking(self.event, rate=rate, last_name=str(i))
+            booking.disciplines.set(disciplines[:i % 4])
+            if i % 2:
+                booking.variants.add(variant)
+            self.bookings.append(booking)
+        create_booking(create_event(User.objects.create(username="other"), 1), last_name="Other")
+
+    def column(self, rows, name):
+        position = [name for name, lookup in export.COLUMNS].index(name)
+        return [row[position] for row in rows]
+
+    def test_rows(self):
+        rows = list(iter_rows(Booking.objects.filter(event=self.event)))
+        self.assertEqual(self.column(rows, "code"), [booking.code for booking in self.bookings])
+        self.assertEqual(self.column(rows, "disciplines"), ["", "trial", "trial, flat", "trial, flat, muni", ""])
+        self.assertEqual(self.column(rows, "variants"), ["", "M", "", "M", ""])
+        self.assertEqual(self.column(rows, "rate"), ["Rider"] * 5)
+        self.assertEqual(set(self.column(rows, "event")), {"Event 0"})
+        self.assertEqual(len(headers()), len(rows[0]))
+
+    def test_constant_queries(self):
+        with self.assertNumQueries(3):
+            self.assertEqual(len(list(iter_rows(Booking.objects.all()))), 6)
+
+    def test_formats(self):
+        queryset = Booking.objects.filter(event=self.event)
+        rows = list(csv.reader("".join(stream_csv(queryset)).splitlines()))
+        self.assertEqual(rows[0], headers())
+        self.assertEqual(self.column(rows[1:], "disciplines")[2], "trial, flat")
+
+        sheet = openpyxl.load_workbook(write_xlsx(queryset), read_only=True).active
+        rows = [list(row) for row in sheet.iter_rows(values_only=True)]
+        self.assertEqual(rows[0], headers())
+        self.assertEqual(self.column(rows[1:], "code"), [booking.code for booking in self.bookings])
+
+    def test_food_language(self):
+        label = lazy(lambda: {"de": "alles", "en": "all"}[translation.get_language()[:2]], str)()
+        queryset = Booking.objects.filter(event=self.event)
+        with mock.patch.object(export, "ESSEN_CHOICES", (("all", label),)):
+            with translation.override("en"):
+                lines = stream_csv(queryset)
+                rows = iter_rows(queryset)
+            # streamed after the request's language was deactivated
+            with translation.override("de"):
+                rows = list(rows)
+                lines = list(csv.reader("".join(lines).splitlines()))
+            self.assertEqual(set(self.column(rows, "food")), {"all"})
+            self.assertEqual(set(self.column(lines[1:], "food")), {"all"})
+            with translation.override("de"):
+                self.assertEqual(set(self.column(iter_rows(queryset), "food")), {"alles"})
+
+    def export(self, user):
+        self.client.force_login(user)
+        response = self.client.post("/admin/registration/booking/export/", {"file_format": "0"})
+        rows = list(csv.reader(b"".join(response.streaming_content).decode().splitlines()))
+        return self.column(rows[1:], "last_name")
+
+    def test_admin_export(self):
+        # event admins only export the bookings of their events
+        self.assertEqual(sorted(self.export(self.admin)), ["0", "1", "2", "3", "4"])
+        superuser = User.objects.create(username="root", is_staff=True, is_superuser=True)
+        self.assertEqual(len(self.export(superuser)), 6)
+
+
+class LedgerTest(TestCase):
+    """Paid, fees and the open amount follow the transactions of a booking."""
+
+    def setUp(self):
+        event = create_event(User.objects.create(username="admin"))
+        rate = Rate.objects.create(event=event, label="Rider")
+        Price.objects.create(rate=rate, price=100)
+        self.booking = create_booking(event, rate=rate)
+        self.other = create_booking(event, rate=rate)
+
+    def pay(self, booking, amount, fee=0):
+        return Transaction.objects.create(booking=booking, typ="incoming", mittel="paypal", betrag=amount, gebuehr=fee)
+
+    def balance(self, booking):
+        return Booking.objects.filter(pk=booking.pk).values_list("amount", "paid", "fees", "open_amount").get()
+
+    def test_transactions(self):
+        self.assertEqual(self.balance(self.booking), (100, 0, 0, 100))
+        payment = self.pay(self.booking, 60, 2)
+        self.pay(self.booking, 30)
+        self.assertEqual(self.balance(self.booking), (100, 90, 2, 10))
+
+        # moved to another booking, both balances change
+        payment.booking = self.other
+        payment.save()
+        self.assertEqual(self.balance(self.booking), (100, 30, 0, 70))
+        self.assertEqual(self.balance(self.other), (100, 60, 2, 40))
+
+        payment.delete()
+        self.assertEqual(self.balance(self.other), (100, 0, 0, 100))
+
+    def test_stale_instance(self):
+        # an instance loaded before a payment doesn't write its old balance back
+        booking = Booking.objects.get(pk=self.booking.pk)
+        self.pay(self.booking, 60, 2)
+        booking.notes = "edited"
+        booking.save()
+        self.assertEqual(self.balance(self.booking), (100, 60, 2, 40))
+        self.assertEqual((booking.paid, booking.fees, booking.open_amount), (60, 2, 40))
+
+    def test_refresh(self):
+        self.pay(self.booking, 60)
+        Booking.objects.filter(pk=self.booking.pk).update(paid=0, open_amount=100)
+        self.assertEqual(list(stale_balances(Booking.objects.all())), [self.booking])
+
+        refresh_balances(Booking.objects.all())
+        self.assertFalse(stale_balances(Booking.objects.all()).exists())
+        self.assertEqual(self.balance(self.booking), (100, 60, 0, 40))
+
+
+class StatisticsAccessTest(TestCase):
+    query = "query Statistics($id: Int!) { eventStatistics(eventId: $id) { total byState { key count } } }"
+
+    def setUp(self):
+        self.admin = User.objects.create(username="admin", is_staff=True)
+        self.event = create_event(self.admin)
+        create_booking(self.event)
+
+    def statistics(self):
+        response = self.client.post("/graphql", json.dumps({"query": self.query, "variables": {"id": self.event.pk}}),
+                                    content_type="application/json")
+        return response.json()
+
+    def test_anonymous(self):
+        result = self.statistics()
+        self.assertIsNone(result["data"]["eventStatistics"])
+        self.assertEqual(result["errors"][0]["message"], "Only staff can see event statistics")
+
+    def test_other_event_admin(self):
+        self.client.force_login(User.objects.create(username="other", is_staff=True))
+        result = self.statistics()
+        self.assertNotIn("errors", result)
+        self.assertIsNone(result["data"]["eventStatistics"])
+
+    def test_event_admin(self):
+        self.client.force_login(self.admin)
+        statistics = self.statistics()["data"]["eventStatistics"]
+        self.assertEqual(statistics["total"], 1)
+        self.assertEqual(statistics["byState"], [{"key": "open", "count": 1}])
+
+
+class StatisticsTest(TestCase):
+    def setUp(self):
+        self.event = create_event(User.objects.create(username="admin"))
+
+    def test_rates_with_same_label(self):
+        rates = [Rate.objects.create(event=self.event, label="Rider") for i in range(2)]
+        create_booking(self.event, rate=rates[0])
+        create_booking(self.event, rate=rates[0])
+        create_booking(self.event, rate=rates[1])
+        statistics = get_event_statistics(self.event)
+        self.assertEqual(statistics["rate"], [(rates[0].pk, "Rider", 2), (rates[1].pk, "Rider", 1)])
+
+    def test_age_bands_of_admin_filter(self):
+        for date_of_birth in (date(2002, 7, 1), date(2002, 7, 2), date(1960, 1, 1)):
+            create_booking(self.event, date_of_birth=date_of_birth)
+        statistics = get_event_statistics(self.event)
+        bands = Booking.objects.with_age().order_by().values_list("age_band").annotate(count=Count("pk"))
+        self.assertEqual({key: count for key, label, count in statistics["age_band"]}, dict(bands))
+        self.assertEqual(dict(bands), {"18-29": 1, "12-17": 1, "50+": 1})
+
+
+class CheckinTest(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create(username="admin", is_staff=True)
+        self.event = create_event(self.admin)
+        self.booking = create_booking(self.event, club="Unicycle Club")
+        self.client.force_login(self.admin)
+
+    def test_checkin(self):
+        response = self.client.post("/checkin/%s" % self.booking.code)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["status"], "checked_in")
+        self.assertIn("Server-Timing", response)
+        checked_in = Booking.objects.get(pk=self.booking.pk).checkin_date
+        self.assertIsNotNone(checked_in)
+
+        # scanning twice keeps the first check-in date
+        response = self.client.post("/checkin/%s" % self.booking.code)
+        self.assertEqual(response.json()["status"], "already_checked_in")
+        self.assertEqual(Booking.objects.get(pk=self.booking.pk).checkin_date, checked_in)
+
+    def test_canceled(self):
+        Booking.objects.filter(pk=self.booking.pk).update(state="canceled")
+        response = self.client.post("/checkin/%s" % self.booking.code)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["status"], "canceled")
+        self.assertIsNone(Booking.objects.get(pk=self.booking.pk).checkin_date)
+
+    def test_unknown_code(self):
+        self.assertEqual(self.client.post("/checkin/unknown").status_code, 404)
+
+    def test_other_events(self):
+        # bookings of events administered by someone else are unknown
+        self.client.force_login(User.objects.create(username="other", is_staff=True))
+        self.assertEqual(self.client.post("/checkin/%s" % self.booking.code).status_code, 404)
+        self.assertIsNone(Booking.objects.get(pk=self.booking.pk).checkin_date)
+
+    def test_staff_only(self):
+        self.client.logout()
+        self.assertEqual(self.client.post("/checkin/%s" % self.booking.code).status_code, 302)
+        self.assertEqual(self.client.get("/checkin/%s" % self.booking.code).status_code, 405)
+
+    def test_club(self):
+        create_booking(self.event, club="Unicycle Club")
+        create_booking(self.event, club="Other Club")
+        self.client.post("/checkin/%s" % self.booking.code)
+
+        response = self.client.post("/checkin/club", {"event": self.event.pk, "club": "Unicycle Club"})
+        self.assertEqual(response.json()["checked_in"], 1)
+        self.assertEqual(Booking.objects.filter(checkin_date__isnull=False).count(), 2)
+        self.assertEqual(self.client.post("/checkin/club", {"club": "Unicycle Club"}).status_code, 400)
+
+    def test_club_required(self):
+        create_booking(self.event, club="")
+        for club in ("", "  "):
+            response = self.client.post("/checkin/club", {"event": self.event.pk, "club": club})
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(Booking.objects.filter(checkin_date__isnull=False).exists())
+
+    def test_club_canceled(self):
+        create_booking(self.event, club="Unicycle Club", state="canceled")
+        response = self.client.post("/checkin/club", {"event": self.event.pk, "club": " Unicycle Club "})
+        self.assertEqual(response.json()["checked_in"], 1)
+        self.assertFalse(Booking.objects.filter(state="canceled", checkin_date__isnull=False).exists())
+
+
+class ResponseCacheTest(TestCase):
+    query = "query AllEvents { allEvents { edges { node { name } } } }"
+
+    def setUp(self):
+        cache.clear()
+        create_event(User.objects.create(username="admin"))
+
+    def get(self, **headers):
+        return self.client.get("/graphql", {"query": self.query}, HTTP_ACCEPT="application/json", **headers)
+
+    def test_etag(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["data"]["allEvents"]["edges"], [{"node": {"name": "Event 0"}}])
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 304)
+
+        create_event(User.objects.get(), 1)
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 200)
+
+    def test_csrf_cookie(self):
+        # new clients get the token for their mutations, with a response only for them
+        response = self.get()
+        self.assertIn("csrftoken", response.cookies)
+        self.assertEqual(response["Cache-Control"], "private, no-cache")
+
+        # afterwards the shared response, without Set-Cookie and Vary: Cookie
+        response = self.get()
+        self.assertNotIn("csrftoken", response.cookies)
+        self.assertEqual(response["Cache-Control"], "no-cache")
+        self.assertNotIn("Cookie", response["Vary"])
+
+
+
+class PersistedQueryTest(TestCase):
+    query = "query AllEvents { allEvents { edges { node { name } } } }"
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(documents, "_persisted", {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        create_event(User.objects.create(username="admin"))
+        PersistedQuery.objects.create(sha256=documents.query_hash(self.query), name="events.graphql", query=self.query)
+
+    def post(self, query=None, sha256=None):
+        data = {"query": query} if query else {}
+        if sha256:
+            data["extensions"] = {"persistedQuery": {"version": 1, "sha256Hash": sha256}}
+        return self.client.post("/graphql", json.dumps(data), content_type="application/json")
+
+    def test_document_cache(self):
+        backend = documents.ValidatedDocumentBackend(max_size=2)
+        first = backend.document_from_string(schema, self.query)
+        self.assertIs(backend.document_from_string(schema, self.query), first)
+        backend.document_from_string(schema, "{ allEvents { edges { node { id } } } }")
+        backend.document_from_string(schema, "{ allEvents { edges { node { slug } } } }")
+        self.assertIsNot(backend.document_from_string(schema, self.query), first)
+        self.assertEqual(len(backend.documents), 2)
+
+    def test_hash(self):
+        response = self.post(sha256=documents.query_hash(self.query))
+        self.assertEqual(response.json()["data"]["allEvents"]["edges"], [{"node": {"name": "Event 0"}}])
+
+        response = self.post(self.query, sha256=documents.query_hash(self.query + " "))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["errors"][0]["message"], "provided sha does not match query")
+
+        response = self.post(sha256="0" * 64)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["errors"][0]["message"], "PersistedQueryNotFound")
+
+    @mock.patch.object(CachedGraphQLView, "persisted_only", True)
+    def test_persisted_only(self):
+        self.assertEqual(self.post(self.query).status_code, 200)
+        response = self.post("query Other { allEvents { edges { node { id } } } }")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["errors"][0]["message"], "Only persisted queries are allowed.")
+
+    def test_register_queries(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        event = Event.objects.get()
+        rate = Rate.objects.create(event=event, label="Rider")
+        # literal input, the old check executed documents and this would have booked
+        mutation = """
+mutation CreateBooking {
+  createBooking(input: {event: "%d", rate: "%d", firstName: "Rider", lastName: "One",
+                        email: "rider@example.com", dateOfBirth: "2000-01-01"}) { code }
+}
+""" % (event.pk, rate.pk)
+        paths = []
+        for name, query in (("booking.graphql", mutation), ("events.graphql", self.query)):
+            paths.append(os.path.join(directory, name))
+            with open(paths[-1], "w", encoding="utf-8") as f:
+                f.write(query)
+
+        call_command("register_queries", *paths, "--replace", stdout=io.StringIO())
+        self.assertEqual(set(PersistedQuery.objects.values_list("name", flat=True)), set(paths))
+        self.assertFalse(Booking.objects.exists())
+
+        # the replaced query isn't accepted any more, though this process had loaded it
+        self.assertEqual(self.post(sha256=documents.query_hash(self.query)).status_code, 200)
+        renamed = "query Events { allEvents { edges { node { name } } } }"
+        with open(paths[1], "w", encoding="utf-8") as f:
+            f.write(renamed)
+        call_command("register_queries", *paths, "--replace", stdout=io.StringIO())
+        self.assertEqual(self.post(sha256=documents.query_hash(self.query)).status_code, 400)
+        self.assertEqual(self.post(sha256=documents.query_hash(renamed)).status_code, 200)
+        self.assertEqual(documents.registered_operations(), {"CreateBooking", "Events"})
+
+        with open(paths[0], "w", encoding="utf-8") as f:
+            f.write("query Broken { allEvents { nothing } }")
+        with self.assertRaises(CommandError):
+            call_command("register_queries", paths[0], stdout=io.StringIO())
+        with open(paths[0], "w", encoding="utf-8") as f:
+            f.write("query Broken {")
+        with self.assertRaises(CommandError):
+            call_command("register_queries", paths[0], stdout=io.StringIO())
+
+
+CREATE_BOOKINGS = """
+mutation CreateBookings($eventId: Int!, $bookings: [GroupBookingInput!]!) {
+  createBookings(eventId: $eventId, bookings: $bookings) {
+    ok results { index booking { code amount } errors { field messages } }
+  }
+}
+"""
+
+
+class GroupBookingTest(TestCase):
+    def setUp(self):
+        self.event = create_event(User.objects.create(username="admin"))
+        self.rate = Rate.objects.create(event=self.event, label="Rider")
+        self.child = Rate.objects.create(event=self.event, label="Child", dob_from=date(2010, 1, 1))
+        Price.objects.create(rate=self.rate, price=60, price_day=20)
+        Price.objects.create(rate=self.child, price=30)
+        self.days = [
+            Day.objects.create(event=self.event, day=name, order=i, arrival=i < 2, departure=i >= 2)
+            for i, name in enumerate(("Thursday", "Friday", "Saturday", "Sunday"))
+        ]
+        self.discipline = Discipline.objects.create(event=self.event, code="trial", label="Trial")
+        shirt = Product.objects.create(event=self.event, kind="shirt", name="Shirt")
+        self.variants = [ProductVariant.objects.create(product=shirt, name=size, price=15) for size in ("M", "L")]
+
+    def row(self, i, **data):
+        return dict({
+            "rate": self.rate.pk, "firstName": "Rider", "lastName": str(i), "email": "rider@example.com",
+            "dateOfBirth": "2000-01-01", "variants": [self.variants[0].pk],
+        }, **data)
+
+    def create(self, rows):
+        response = self.client.post("/graphql", json.dumps({
+            "query": CREATE_BOOKINGS, "variables": {"eventId": self.event.pk, "bookings": rows},
+        }), content_type="application/json")
+        return response.json()
+
+    def test_valid_rows_booked(self):
+        result = self.create([
+            self.row(0, disciplines=[self.discipline.pk]),
+            self.row(1, rate=self.child.pk),
+            self.row(2, variants=[]),
+            self.row(3, variants=[variant.pk for variant in self.variants]),
+            self.row(4, arrival=self.days[2].pk),
+            self.row(5, email="not an address"),
+        ])["data"]["createBookings"]
+        self.assertFalse(result["ok"])
+        errors = {row["index"]: [error["field"] for error in row["errors"]] for row in result["results"]}
+        self.assertEqual(errors, {0: [], 1: ["rate"], 2: ["variants"], 3: ["variants"], 4: ["arrival"],
+                                  5: ["email"]})
+
+        booking = Booking.objects.get()
+        self.assertEqual(booking.code, result["results"][0]["booking"]["code"])
+        self.assertEqual(list(booking.disciplines.all()), [self.discipline])
+        self.assertEqual(list(booking.variants.all()), [self.variants[0]])
+
+    def test_amounts(self):
+        days = {"arrival": self.days[1].pk, "departure": self.days[2].pk}
+        result = self.create([self.row(0, **days)])["data"]["createBookings"]
+        self.assertTrue(result["ok"])
+        single = book(self.client, self.event, self.rate, variants=[self.variants[0].pk], **days)
+        self.assertIsNone(single["errors"])
+        amounts = [Booking.objects.get(code=code).amount for code in
+                   (result["results"][0]["booking"]["code"], single["code"])]
+        self.assertEqual(amounts, [2 * 20 + 15] * 2)
+        self.assertEqual(Booking.objects.get(code=single["code"]).open_amount, amounts[0])
+
+    def test_sold_out(self):
+        Rate.objects.filter(pk=self.rate.pk).update(capacity=2)
+        result = self.create([self.row(i) for i in range(3)])["data"]["createBookings"]
+        # the group doesn't fit, the rows are booked one by one until the rate is sold out
+        self.assertEqual([bool(row["booking"]) for row in result["results"]], [True, True, False])
+        self.assertEqual(result["results"][2]["errors"][0]["field"], "rate")
+        self.assertEqual(Rate.objects.get(pk=self.rate.pk).booked, 2)
+        self.assertEqual(Booking.objects.count(), 2)
+
+    @mock.patch("registration.schema.MAX_GROUP_SIZE", 2)
+    def test_max_group_size(self):
+        result = self.create([self.row(i) for i in range(3)])
+        self.assertEqual(result["errors"][0]["message"], "At most 2 bookings can be created at once.")
+        self.assertFalse(Booking.objects.exists())
+
+    def test_create_booking_rules(self):
+        # createBooking checks rates and products like the group rows
+        cases = [
+            (self.child, [self.variants[0].pk], "rate"),
+            (self.rate, [], "variants"),
+            (self.rate, [variant.pk for variant in self.variants], "variants"),
+        ]
+        for rate, variants, field in cases:
+            result = book(self.client, self.event, rate, variants=variants)
+            self.assertEqual([error["field"] for error in result["errors"]], [field])
+        self.assertFalse(Booking.objects.exists())
+
+
+class SoldOutMutationTest(TestCase):
+    def setUp(self):
+        self.event = create_event(User.objects.create(username="admin"))
+        self.rate = Rate.objects.create(event=self.event, label="Rider", capacity=1)
+        product = Product.objects.create(event=self.event, kind="shirt", name="Shirt", required=False)
+        self.variant = ProductVariant.objects.create(product=product, name="M", price=15, capacity=0)
+
+    def book(self, **data):
+        return book(self.client, self.event, self.rate, **data)
+
+    def test_sold_out_variant(self):
+        result = self.book(variants=[self.variant.pk])
+        self.assertEqual(result["errors"][0]["field"], "variants")
+        # neither the booking nor its place at the rate are kept
+        self.assertFalse(Booking.objects.exists())
+        self.assertEqual(Rate.objects.get(pk=self.rate.pk).booked, 0)
+
+    def test_sold_out_rate(self):
+        self.assertIsNone(self.book()["errors"])
+        result = self.book()
+        self.assertEqual(result["errors"][0]["field"], "rate")
+        self.assertEqual(Booking.objects.count(), 1)
+
+
+class SoldOutAdminTest(TestCase):
+    """The booking admin reports sold-out quotas as form errors."""
+
+    def setUp(self):
+        self.event = create_event(User.objects.create(username="admin"))
+        self.rate = Rate.objects.create(event=self.event, label="Rider")
+        self.full_rate = Rate.objects.create(event=self.event, label="Full", capacity=0)
+        product = Product.objects.create(event=self.event, kind="shirt", name="Shirt", required=False)
+        self.variant = ProductVariant.objects.create(product=product, name="M", price=15, capacity=0)
+        self.booking = create_booking(self.event, rate=self.rate)
+        self.form_class = modelform_factory(Booking, form=BookingForm, fields=("rate", "variants", "state"))
+
+    def form(self, **data):
+        data = dict({"rate": self.rate.pk, "variants": [], "state": "open"}, **data)
+        return self.form_class(data, instance=Booking.objects.get(pk=self.booking.pk))
+
+    def test_sold_out(self):
+        self.assertIn("rate", self.form(rate=self.full_rate.pk).errors)
+        self.assertIn("variants", self.form(variants=[self.variant.pk]).errors)
+
+    def test_reopen(self):
+        self.booking.rate = self.full_rate
+        self.booking.state = "canceled"
+        self.booking.save()
+        self.assertIn("rate", self.form(rate=self.full_rate.pk, state="open").errors)
+        self.assertTrue(self.form(rate=self.full_rate.pk, state="canceled").is_valid())
+
+    def test_places_kept(self):
+        # a booking keeps the place it already has
+        Rate.objects.filter(pk=self.rate.pk).update(capacity=1)
+        self.assertTrue(self.form(state="confirmed").is_valid())
+
+
+CAMT_ENTRY = """
+<Ntry>
+  <Amt Ccy="EUR">{amount}</Amt><CdtDbtInd>{direction}</CdtDbtInd><BookgDt><Dt>2020-05-04</Dt></BookgDt>
+  <AcctSvcrRef>{nr}</AcctSvcrRef>
+  <NtryDtls><TxDtls>
+    <RltdPties><Dbtr><Nm>{name}</Nm></Dbtr><Cdtr><Nm>{name}</Nm></Cdtr></RltdPties>
+    <RmtInf><Ustrd>{text}</Ustrd></RmtInf>
+  </TxDtls></NtryDtls>
+</Ntry>
+"""
+
+CAMT = """<?xml version="1.0" encoding="UTF-8"?>
+<Document xmlns="urn:iso:std:iso:20022:tech:xsd:camt.053.001.02"><BkToCstmrStmt><Stmt>{entries}</Stmt></BkToCstmrStmt></Document>
+"""
+
+PAYPAL_CSV = """\ufeff"Datum","Uhrzeit","Name","Status","Brutto","Gebühr","Transaktionscode","Betreff"
+"04.05.2020","10:00:00","Somebody Else","Abgeschlossen","100,00","-2,25","PP-1","Anmeldung {code}"
+"04.05.2020","11:00:00","Anna Schmidt","Ausstehend","100,00","-2,25","PP-2",""
+"04.05.2020","12:00:00","Anna Schmidt","Abgeschlossen","-100,00","0,00","PP-3","Rückzahlung"
+"""
+
+
+class StatementImportTest(TestCase):
+    def setUp(self):
+        event = create_event(User.objects.create(username="admin"))
+        rate = Rate.objects.create(event=event, label="Rider")
+        Price.objects.create(rate=rate, price=100)
+        self.hans = create_booking(event, rate=rate, first_name="Hans", last_name="Müller")
+        self.anna = create_booking(event, rate=rate, first_name="Anna", last_name="Schmidt")
+
+    def camt(self, *entries):
+        xml = CAMT.format(entries="".join(CAMT_ENTRY.format(**dict({
+            "direction": "CRDT", "name": "", "text": "",
+        }, **entry)) for entry in entries))
+        return list(parse_camt053(io.BytesIO(xml.encode())))
+
+    def test_camt(self):
+        lines = self.camt(
+            {"amount": "40.00", "nr": "B-1", "text": "Booking %s" % self.anna.code},
+            {"amount": "100.00", "nr": "B-2", "name": "HANS MUELLER"},
+            {"amount": "100.00", "nr": "B-3", "name": "Hans Müller"},
+            # payments to a participant are only refunds if they name the booking
+            {"amount": "20.00", "nr": "B-4", "direction": "DBIT", "name": "Hans Müller"},
+            {"amount": "10.00", "nr": "B-5", "direction": "DBIT", "text": "Refund %s" % self.anna.code},
+        )
+        self.assertEqual([line.betrag for line in lines], [40, 100, 100, -20, -10])
+
+        result = import_statement(lines, "wire")
+        self.assertEqual([(match.line.nr, match.method) for match in result.imported],
+                         [("B-1", "code"), ("B-2", "fuzzy"), ("B-3", "name"), ("B-5", "code")])
+        self.assertEqual([line.nr for line in result.unmatched], ["B-4"])
+        self.assertEqual(Transaction.objects.get(nr="B-5").typ, "refund")
+        self.assertEqual(Booking.objects.get(pk=self.anna.pk).open_amount, 70)
+
+        # imported again, nothing changes
+        result = import_statement(lines, "wire")
+        self.assertEqual((len(result.imported), result.duplicates), (0, 4))
+        self.assertEqual(Transaction.objects.count(), 4)
+
+    def test_long_nr(self):
+        lines = self.camt({"amount": "40.00", "nr": "X" * 300, "text": self.anna.code})
+        self.assertEqual(len(lines[0].nr), 255)
+        import_statement(lines, "wire")
+        self.assertEqual(import_statement(lines, "wire").duplicates, 1)
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_paypal(self):
+        lines = list(parse_paypal_csv(io.BytesIO(PAYPAL_CSV.format(code=self.hans.code).encode("utf-8"))))
+        self.assertEqual([(line.nr, line.betrag, line.gebuehr) for line in lines],
+                         [("PP-1", 100, Decimal("2.25")), ("PP-3", -100, 0)])
+        self.assertEqual(lines[0].datum, timezone.make_aware(datetime(2020, 5, 4, 10)))
+
+        result = import_statement(lines, "paypal")
+        self.assertEqual([match.booking_id for match in result.imported], [self.hans.pk])
+        self.assertEqual([line.nr for line in result.unmatched], ["PP-3"])
+        self.assertEqual(Booking.objects.filter(pk=self.hans.pk).values_list("paid", "fees", "open_amount").get(),
+                         (100, Decimal("2.25"), 0))
+
+    def test_not_paypal(self):
+        with self.assertRaises(ValueError):
+            list(parse_paypal_csv(io.BytesIO(b"a,b\n1,2\n")))
+
+
+@override_settings(PAYMENT_WEBHOOK_SECRET="secret")
+class PaymentWebhookTest(TestCase):
+    def setUp(self):
+        event = create_event(User.objects.create(username="admin"))
+        rate = Rate.objects.create(event=event, label="Rider")
+        Price.objects.create(rate=rate, price=100)
+        self.booking = create_booking(event, rate=rate)
+        # the notifications are written on this thread, inside the test's transaction
+        patcher = mock.patch.object(payments.writer, "submit", side_effect=self.write)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, notification):
+        future = Future()
+        future.set_result(payments.write_batch([notification])[0])
+        return future
+
+    def notify(self, body, content_type="application/json"):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        signature = hmac.new(b"secret", body, hashlib.sha256).hexdigest()
+        return self.client.post("/payments/paypal", body, content_type=content_type,
+                                HTTP_X_WEBHOOK_SIGNATURE=signature)
+
+    def payment(self, nr="TX-1", **data):
+        return dict({"txn_id": nr, "payment_status": "Completed", "mc_gross": "100.00", "mc_fee": "2.20",
+                     "custom": self.booking.code}, **data)
+
+    def test_payment(self):
+        response = self.notify(self.payment())
+        self.assertEqual(response.json(), {"nr": "TX-1", "status": "created"})
+        booking = Booking.objects.get(pk=self.booking.pk)
+        self.assertEqual((booking.paid, booking.fees, booking.open_amount, booking.state),
+                         (100, Decimal("2.20"), 0, "confirmed"))
+
+    def test_duplicate(self):
+        self.notify(self.payment())
+        self.assertEqual(self.notify(self.payment()).json()["status"], "duplicate")
+        self.assertEqual(payments.write_batch([payments.parse_notification(self.payment("TX-2"))] * 2),
+                         ["created", "duplicate"])
+        self.assertEqual(Transaction.objects.count(), 2)
+
+    def test_concurrent_duplicate(self):
+        # another process writes TX-1 after the batch looked for known notifications
+        known_nrs = payments.known_nrs
+
+        def written_meanwhile(nrs):
+            known = known_nrs(nrs)
+            if not Transaction.objects.exists():
+                Transaction.objects.create(booking=self.booking, typ="incoming", mittel="paypal", nr="TX-1", betrag=100)
+            return known
+
+        notifications = [payments.parse_notification(self.payment(nr)) for nr in ("TX-1", "TX-2")]
+        with mock.patch.object(payments, "known_nrs", side_effect=written_meanwhile):
+            self.assertEqual(payments.write_batch(notifications), ["duplicate", "created"])
+        self.assertEqual(sorted(Transaction.objects.values_list("nr", flat=True)), ["TX-1", "TX-2"])
+        self.assertEqual(Booking.objects.get(pk=self.booking.pk).paid, 200)
+
+    def test_bad_body(self):
+        self.assertEqual(self.notify([self.payment()]).status_code, 400)
+        self.assertEqual(self.notify(b"{").status_code, 400)
+        self.assertEqual(self.notify(self.payment(nr="")).status_code, 400)
+        self.assertEqual(self.notify(self.payment(mc_gross="lots")).status_code, 400)
+
+    def test_signature(self):
+        response = self.client.post("/payments/paypal", json.dumps(self.payment()), content_type="application/json",
+                                    HTTP_X_WEBHOOK_SIGNATURE="0" * 64)
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Transaction.objects.exists())
+
+
+class UploadTest(TestCase):
+    content = b"signed consent form " * 1000
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        media_root = override_settings(MEDIA_ROOT=media)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        for patcher in (mock.patch.object(uploads, "UPLOAD_DIR", os.path.join(media, "uploads")),
+                        mock.patch.object(uploads, "CHUNK_SIZE", 1024)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        event = create_event(User.objects.create(username="admin"))
+        self.booking = create_booking(event, email="Rider@example.com")
+        self.document = Document.objects.create(event=event, name="Consent", document="consent.pdf", upload=True)
+
+    def start(self, **data):
+        data = dict({
+            "booking": self.booking.code.upper(), "email": "rider@example.com", "document": self.document.pk,
+            "filename": "C:\\scans\\consent.pdf", "size": len(self.content),
+        }, **data)
+        return self.client.post("/uploads", json.dumps(data), content_type="application/json")
+
+    def send(self, response, chunk, offset):
+        return self.client.patch(response["Location"], chunk, content_type="application/offset+octet-stream",
+                                 HTTP_UPLOAD_OFFSET=str(offset))
+
+    def upload(self, content=None, **data):
+        content = content or self.content
+        response = self.start(size=len(content), **data)
+        self.assertEqual(response.status_code, 201)
+        middle = len(content) // 2
+        self.assertFalse(self.send(response, content[:middle], 0).json()["complete"])
+        return self.send(response, content[middle:], middle)
+
+    def test_upload(self):
+        response = self.upload()
+        self.assertTrue(response.json()["complete"])
+        attachment = Attachment.objects.get()
+        self.assertEqual(attachment.filename, "consent.pdf")
+        self.assertEqual(attachment.sha256, hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(attachment.file.name, blob_name(attachment.sha256))
+        with attachment.file.open("rb") as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertFalse(Upload.objects.exists())
+
+    def test_booking_email_required(self):
+        self.assertEqual(self.start(email="someone@example.com").status_code, 403)
+        self.assertEqual(self.start(email=None).status_code, 403)
+        response = self.client.post("/uploads", json.dumps({"booking": self.booking.code}),
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Upload.objects.exists())
+
+    def test_known_hash(self):
+        # naming the hash of a stored file attaches nothing before the bytes arrived
+        self.upload()
+        Attachment.objects.all().delete()
+        response = self.start(sha256=hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()["offset"], 0)
+        self.assertFalse(Attachment.objects.exists())
+
+    def test_checksum(self):
+        response = self.upload(sha256=hashlib.sha256(b"another file").hexdigest())
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Attachment.objects.exists())
+        self.assertFalse(Upload.objects.exists())
+
+    def test_replace(self):
+        self.upload()
+        self.assertEqual(self.start().status_code, 409)
+
+        other = b"signed again " * 100
+        self.assertTrue(self.upload(other, replace=True).json()["complete"])
+        self.assertEqual(Attachment.objects.get().sha256, hashlib.sha256(other).hexdigest())
+        # the replaced file isn't referenced any more
+        self.assertFalse(default_storage.exists(blob_name(hashlib.sha256(self.content).hexdigest())))
+
+    def test_purge_unused_files(self):
+        self.upload()
+        used = Attachment.objects.get().file.name
+        unused = default_storage.save(blob_name(hashlib.sha256(b"orphan").hexdigest()), ContentFile(b"orphan"))
+        call_command("purge_uploads", days=0, stdout=io.StringIO())
+        self.assertTrue(default_storage.exists(used))
+        self.assertFalse(default_storage.exists(unused))
+
+    def test_chunks_locked(self):
+        # select_for_update locks nothing on SQLite, the partial file is locked instead
+        response = self.start()
+        with mock.patch("registration.uploads.fcntl.flock") as flock:
+            self.send(response, self.content[:100], 0)
+        flock.assert_called_once_with(mock.ANY, uploads.fcntl.LOCK_EX)
+        self.assertEqual(flock.call_args[0][0].name, uploads.partial_path(Upload.objects.get()))
+
+    def test_uploaded_meanwhile(self):
+        response = self.start()
+        self.upload()
+        response = self.send(response, self.content, 0)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Attachment.objects.count(), 1)
+
+    def test_offset_mismatch(self):
+        response = self.start()
+        self.send(response, self.content[:100], 0)
+        conflict = self.send(response, self.content[50:150], 50)
+        self.assertEqual(conflict.status_code, 409)
+        self.assertEqual(conflict["Upload-Offset"], "100")
+        self.assertEqual(self.client.get(response["Location"]).json()["offset"], 100)
+
+    def test_chunk_read_before_lock(self):
+        self.start()
+        outside = list(connection.savepoint_ids)
+        locked = []
+        stream = io.BytesIO(self.content)
+
+        def read(size):
+            # the upload is locked in a transaction of its own
+            locked.append(connection.savepoint_ids != outside)
+            return io.BytesIO.read(stream, size)
+
+        with mock.patch.object(stream, "read", side_effect=read):
+            upload, attachment = uploads.append(Upload.objects.get(), 0, stream, len(self.content))
+        self.assertIsNotNone(attachment)
+        self.assertEqual(set(locked), {False})
+
+
+class ImageDerivativeTest(TestCase):
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        media_root = override_settings(MEDIA_ROOT=media, MEDIA_URL="/media/")
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.event = create_event(User.objects.create(username="admin"))
+
+    def image(self, name, size=(500, 250), mode="RGB", image_format="JPEG", color=(200, 30, 30)):
+        out = io.BytesIO()
+        Image.new(mode, size, color).save(out, image_format)
+        return default_storage.save(name, ContentFile(out.getvalue()))
+
+    def derivatives(self, name):
+        return sorted(ImageDerivative.objects.filter(source=name).values_list("width", "height", "format"))
+
+    def test_widths(self):
+        name = self.image("logos/logo.jpg")
+        self.assertTrue(images.build(name))
+        # 640 and 1280 would be larger than the original, its own width is kept instead
+        self.assertEqual(self.derivatives(name), [
+            (160, 80, "jpeg"), (160, 80, "webp"), (320, 160, "jpeg"), (320, 160, "webp"),
+            (500, 250, "jpeg"), (500, 250, "webp"),
+        ])
+        for row in ImageDerivative.objects.filter(source=name):
+            with default_storage.open(row.file, "rb") as f:
+                self.assertEqual(Image.open(f).size, (row.width, row.height))
+        # up to date
+        self.assertFalse(images.build(name))
+
+    def test_same_image_reused(self):
+        name = self.image("logos/logo.jpg")
+        images.build(name)
+        with default_storage.open(name, "rb") as f:
+            other = default_storage.save("logos/copy.jpg", ContentFile(f.read()))
+
+        with mock.patch.object(images, "render") as render:
+            self.assertTrue(images.build(other))
+        render.assert_not_called()
+        files = lambda source: set(ImageDerivative.objects.filter(source=source).values_list("file", flat=True))
+        self.assertEqual(files(other), files(name))
+
+    def test_transparent_png(self):
+        name = self.image("logos/logo.png", size=(100, 100), mode="RGBA", image_format="PNG", color=(0, 0, 0, 0))
+        images.build(name)
+        self.assertEqual(self.derivatives(name), [(100, 100, "png"), (100, 100, "webp")])
+
+    def test_page_images(self):
+        html = (
+            '<p><img src="/media/uploads/a%20b.jpg?v=2"><img alt="" src=\'/media/uploads/c.png\' />'
+            '<img src="https://example.com/d.jpg"><img src="/media/uploads/c.png"></p>'
+        )
+        self.assertEqual(images.page_images(html), ["uploads/a b.jpg", "uploads/c.png"])
+        self.assertEqual(images.page_images(None), [])
+
+    def test_add_srcsets(self):
+        rows = [
+            ImageDerivative(source="uploads/a.jpg", sha256="ab", width=width, height=width, format=image_format,
+                            file="derivatives/ab/ab/%d.%s" % (width, image_format))
+            for width in (320, 160) for image_format in ("webp", "jpeg")
+        ]
+        html = '<img src="/media/uploads/a.jpg" /><img src="/media/uploads/a.jpg" srcset="x"><img src="/media/b.jpg">'
+        self.assertEqual(images.add_srcsets(html, rows), (
+            '<img src="/media/uploads/a.jpg" srcset="/media/derivatives/ab/ab/160.webp 160w, '
+            '/media/derivatives/ab/ab/320.webp 320w" sizes="100vw"/>'
+            '<img src="/media/uploads/a.jpg" srcset="x"><img src="/media/b.jpg">'
+        ))
+
+    def test_graphql(self):
+        logo = self.image("logos/logo.jpg")
+        picture = self.image("uploads/picture.jpg", size=(200, 100))
+        Event.objects.filter(pk=self.event.pk).update(logo=logo)
+        WebPage.objects.create(event=self.event, name="Home", html='<img src="/media/%s">' % picture)
+        query = """
+        query Event($id: Int) {
+          event(id: $id) { logoImage { url srcset fallbackSrcset } pages { edges { node { html } } } }
+        }
+        """
+
+        def event():
+            cache.clear()
+            response = self.client.post("/graphql", json.dumps({"query": query, "variables": {"id": self.event.pk}}),
+                                        content_type="application/json")
+            return response.json()["data"]["event"]
+
+        # until the derivatives are built, clients use the original
+        data = event()
+        self.assertEqual(data["logoImage"], {"url": "/media/%s" % logo, "srcset": "", "fallbackSrcset": ""})
+        self.assertNotIn("srcset", data["pages"]["edges"][0]["node"]["html"])
+
+        images.build(logo)
+        images.build(picture)
+        data = event()
+        self.assertEqual(data["logoImage"]["srcset"].count(" 160w"), 1)
+        self.assertTrue(data["logoImage"]["srcset"].endswith(".webp 500w"))
+        self.assertTrue(data["logoImage"]["fallbackSrcset"].endswith(".jpg 500w"))
+        self.assertIn('.webp 200w" sizes="100vw"', data["pages"]["edges"][0]["node"]["html"])
+
+
+class SearchTest(TestCase):
+    query = "query Search($query: String!) { searchBookings(query: $query) { code lastName } }"
+
+    def setUp(self):
+        self.admin = User.objects.create(username="admin", is_staff=True)
+        self.event = create_event(self.admin)
+        self.mueller = create_booking(self.event, first_name="Jörg", last_name="Müller", club="Einradverein Köln")
+        self.weiss = create_booking(self.event, first_name="Anna", last_name="Weiß", club="")
+
+    def search(self, term):
+        return [booking.pk for booking in search_bookings(Booking.objects.all(), term)]
+
+    def test_prefixes_and_accents(self):
+        self.assertEqual(self.search("mull ein"), [self.mueller.pk])
+        self.assertEqual(self.search("JORG"), [self.mueller.pk])
+        self.assertEqual(self.search("weiss"), [self.weiss.pk])
+        self.assertEqual(self.search(self.weiss.code), [self.weiss.pk])
+        self.assertEqual(self.search("mull anna"), [])
+        self.assertEqual(self.search(" .. "), [])
+
+    def test_triggers(self):
+        # the index follows saves, bulk updates, bulk inserts and deletes
+        self.mueller.last_name = "Schmidt"
+        self.mueller.save()
+        self.assertEqual(self.search("müller"), [])
+        self.assertEqual(self.search("schmi"), [self.mueller.pk])
+
+        Booking.objects.filter(pk=self.weiss.pk).update(club="Unicycle Club")
+        self.assertEqual(self.search("unicycle"), [self.weiss.pk])
+
+        Booking.objects.bulk_create([Booking(event=self.event, code="bulkcode", first_name="Bulk", last_name="Rider",
+                                             email="bulk@example.com", date_of_birth=date(2000, 1, 1), food="all")])
+        self.assertEqual(len(self.search("bulk")), 1)
+
+        self.weiss.delete()
+        self.assertEqual(self.search("unicycle"), [])
+        self.assertEqual(list(filter_bookings(Booking.objects.all(), "rider")), list(Booking.objects.filter(code="bulkcode")))
+
+    def test_graphql(self):
+        other = create_event(User.objects.create(username="other", is_staff=True), 1)
+        create_booking(other, first_name="Jörg", last_name="Müller")
+        self.client.force_login(self.admin)
+        response = self.client.post("/graphql", json.dumps({"query": self.query, "variables": {"query": "müller"}}),
+                                    content_type="application/json")
+        # only the bookings of the admin's own events
+        self.assertEqual(response.json()["data"]["searchBookings"], [{"code": self.mueller.code, "lastName": "Müller"}])
+
+
+class AgeTest(TestCase):
+    def setUp(self):
+        self.event = create_event(User.objects.create(username="admin"))
+
+    def ages(self):
+        return list(Booking.objects.with_age().order_by("pk").values_list("age_at_start", "is_minor", "age_band"))
+
+    def test_age_at_start(self):
+        # the event begins 2020-07-01
+        for date_of_birth in (date(2002, 7, 1), date(2002, 7, 2), date(1970, 7, 1), date(2015, 1, 1)):
+            create_booking(self.event, date_of_birth=date_of_birth)
+        self.assertEqual(self.ages(), [(18, False, "18-29"), (17, True, "12-17"), (50, False, "50+"), (5, True, "<12")])
+        for booking in Booking.objects.with_age():
+            self.assertEqual(booking.age_at_start, booking.age().years)
+
+    def test_unknown_begin_day(self):
+        create_booking(self.event)
+        Event.objects.filter(pk=self.event.pk).update(begin_day=None)
+        self.assertEqual(self.ages(), [(None, None, None)])
+
+    def test_bulk_writes(self):
+        begin = timezone.make_aware(datetime(2021, 8, 1, 23, 30))
+        Event.objects.filter(pk=self.event.pk).update(begin_date=begin)
+        self.assertEqual(Event.objects.get(pk=self.event.pk).begin_day, date(2021, 8, 1))
+
+        event = Event.objects.get(pk=self.event.pk)
+        event.begin_date = begin.replace(year=2022)
+        Event.objects.bulk_update([event], ["begin_date"])
+        self.assertEqual(Event.objects.get(pk=self.event.pk).begin_day, date(2022, 8, 1))
+
+        Event.objects.bulk_create([Event(
+            name="Bulk", slug="bulk", description="", host="", admin=event.admin, contact_name="",
+            contact_email="event@example.com", begin_date=begin, end_date=begin,
+        )])
+        self.assertEqual(Event.objects.get(slug="bulk").begin_day, date(2021, 8, 1))
+
+
+class MissingDocumentsTest(TestCase):
+    query = """
+    query Missing($id: Int!, $checkedIn: Boolean) {
+      missingDocuments(eventId: $id, checkedIn: $checkedIn) { booking { lastName } age documents { name } }
+    }
+    """
+
+    def setUp(self):
+        self.admin = User.objects.create(username="admin", is_staff=True)
+        self.event = create_event(self.admin)
+        self.consent = Document.objects.create(event=self.event, name="Consent", document="c.pdf", upload=True, u18=True)
+        self.waiver = Document.objects.create(event=self.event, name="Waiver", document="w.pdf", upload=True)
+        Document.objects.create(event=self.event, name="Schedule", document="s.pdf")
+
+        self.minor = create_booking(self.event, last_name="Minor", date_of_birth=date(2005, 1, 1))
+        self.adult = create_booking(self.event, last_name="Adult", date_of_birth=date(1990, 1, 1))
+        complete = create_booking(self.event, last_name="Complete", date_of_birth=date(1990, 1, 1))
+        self.attach(complete, self.waiver)
+        create_booking(self.event, last_name="Canceled", state="canceled")
+
+    def attach(self, booking, document):
+        Attachment.objects.create(booking=booking, document=document, file="blobs/x", sha256="x")
+
+    def report(self, bookings=None):
+        return [(booking.last_name, [document.name for document in documents])
+                for booking, documents in missing_documents(self.event, bookings)]
+
+    def test_report(self):
+        self.assertEqual(self.report(), [("Adult", ["Waiver"]), ("Minor", ["Consent", "Waiver"])])
+
+        self.attach(self.minor, self.consent)
+        self.assertEqual(self.report(), [("Adult", ["Waiver"]), ("Minor", ["Waiver"])])
+        self.attach(self.minor, self.waiver)
+        self.assertEqual(self.report(Booking.objects.exclude(pk=self.adult.pk)), [])
+
+    def test_queries(self):
+        for i in range(10):
+            create_booking(self.event, date_of_birth=date(2005, 1, 1))
+        with self.assertNumQueries(2):
+            self.assertEqual(len(self.report()), 12)
+
+    def missing(self, **variables):
+        variables["id"] = self.event.pk
+        response = self.client.post("/graphql", json.dumps({"query": self.query, "variables": variables}),
+                                    content_type="application/json")
+        return response.json()["data"]["missingDocuments"]
+
+    def test_graphql(self):
+        self.assertIsNone(self.missing())
+        self.client.force_login(self.admin)
+        self.assertEqual(self.missing(), [
+            {"booking": {"lastName": "Adult"}, "age": 30, "documents": [{"name": "Waiver"}]},
+            {"booking": {"lastName": "Minor"}, "age": 15, "documents": [{"name": "Consent"}, {"name": "Waiver"}]},
+        ])
+
+        Booking.objects.filter(pk=self.adult.pk).update(checkin_date=timezone.now())
+        self.assertEqual([row["booking"]["lastName"] for row in self.missing(checkedIn=False)], ["Minor"])
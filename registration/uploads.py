@@ -0,0 +1,261 @@
+"""Resumable, chunked uploads of attachments.
+
+An upload is started with the booking code and the e-mail address of the
+booking, the size of the file and its SHA-256 if the client knows it. Then
+the file is sent in chunks, each with the offset it starts at. A chunk is
+streamed to a temporary file first; only then is the partial file locked,
+the chunk appended to it and hashed, and the offset moved on. No
+chunk is held in memory as a whole. If the connection breaks, the client asks
+for the offset that arrived and continues from there.
+
+Complete files are stored once per content under ``blob_name(sha256)``, the
+hash being the one computed from the bytes received; the ``Attachment`` keeps
+the original file name. A document that was uploaded before is only replaced
+if the upload was started with ``replace``; a file no attachment refers to
+any more is removed.
+"""
+import fcntl
+import hashlib
+import os
+import secrets
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.utils.translation import gettext as _
+
+from registration.models import Attachment, Upload, blob_name
+
+CHUNK_SIZE = 64 * 1024
+MAX_SIZE = getattr(settings, "ATTACHMENT_MAX_SIZE", 50 * 1024 * 1024)
+UPLOAD_DIR = getattr(settings, "ATTACHMENT_UPLOAD_DIR", os.path.join(settings.MEDIA_ROOT, "uploads"))
+
+# hashes of the chunks received so far, so the next chunk only hashes itself
+MAX_HASHERS = 256
+_hashers = OrderedDict()
+
+
+class UploadError(Exception):
+    status = 400
+
+
+class OffsetMismatch(UploadError):
+    status = 409
+
+    def __init__(self, offset):
+        super(OffsetMismatch, self).__init__(_("The upload continues at offset %d.") % offset)
+        self.offset = offset
+
+
+class Canceled(UploadError):
+    status = 404
+
+    def __init__(self):
+        super(Canceled, self).__init__(_("The upload was canceled."))
+
+
+class AlreadyUploaded(UploadError):
+    status = 409
+
+    def __init__(self):
+        super(AlreadyUploaded, self).__init__(_("This document was uploaded already, start again to replace it."))
+
+
+class PartialFile(File):
+    # lets FileSystemStorage move the file into place instead of copying it
+    def temporary_file_path(self):
+        return self.name
+
+
+def partial_path(upload):
+    return os.path.join(UPLOAD_DIR, upload.token)
+
+
+def hasher(upload):
+    cached = _hashers.pop(upload.token, None)
+    if cached is not None and cached[0] == upload.offset:
+        return cached[1]
+    # the previous chunks went to another process (or it was restarted)
+    digest = hashlib.sha256()
+    remaining = upload.offset
+    with open(partial_path(upload), "rb") as f:
+        while remaining:
+            data = f.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                break
+            digest.update(data)
+            remaining -= len(data)
+    return digest
+
+
+def remember(upload, digest):
+    _hashers[upload.token] = (upload.offset, digest)
+    while len(_hashers) > MAX_HASHERS:
+        _hashers.popitem(last=False)
+
+
+@contextmanager
+def locked_partial(upload):
+    """Opens the partial file of ``upload``, locked against other requests for the same upload.
+
+    ``select_for_update`` locks nothing on SQLite; the file lock serializes the
+    chunks of an upload across the threads and processes of a host. The lock
+    is released when the file is closed.
+    """
+    try:
+        f = open(partial_path(upload), "r+b")
+    except FileNotFoundError:
+        raise Canceled()
+    with f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield f
+
+
+def remove_unused(name):
+    """Deletes the stored file ``name`` unless an attachment still refers to it."""
+    if not Attachment.objects.filter(file=name).exists():
+        default_storage.delete(name)
+
+
+def unused_blobs(before):
+    """Names of the stored blobs no attachment refers to, last modified before ``before``."""
+    if not default_storage.exists("blobs"):
+        return
+    used = set(Attachment.objects.filter(file__startswith="blobs/").values_list("file", flat=True))
+    for first in default_storage.listdir("blobs")[0]:
+        for second in default_storage.listdir("blobs/%s" % first)[0]:
+            directory = "blobs/%s/%s" % (first, second)
+            for filename in default_storage.listdir(directory)[1]:
+                name = "%s/%s" % (directory, filename)
+                if name not in used and default_storage.get_modified_time(name) < before:
+                    yield name
+
+
+def attach(booking, document, filename, sha256, name, replace=False):
+    fields = {"file": name, "filename": filename, "sha256": sha256}
+    if replace:
+        replaced = Attachment.objects.filter(booking=booking, document=document).values_list("file", flat=True).first()
+        attachment, created = Attachment.objects.update_or_create(booking=booking, document=document, defaults=fields)
+        if replaced and replaced != name:
+            remove_unused(replaced)
+        return attachment
+    try:
+        with transaction.atomic():
+            return Attachment.objects.create(booking=booking, document=document, **fields)
+    except IntegrityError:
+        raise AlreadyUploaded()
+
+
+def start(booking, document, filename, size, sha256="", replace=False):
+    """Starts an upload of ``document`` for ``booking``.
+
+    Raises ``AlreadyUploaded`` if the booking has the document already, unless
+    it is to be replaced.
+    """
+    if document.event_id != booking.event_id or not document.upload:
+        raise UploadError(_("This document can't be uploaded for this booking."))
+    if not 0 < size <= MAX_SIZE:
+        raise UploadError(_("Files must be between 1 byte and %d bytes.") % MAX_SIZE)
+    filename = os.path.basename(filename.replace("\\", "/"))[:255]
+    if not filename:
+        raise UploadError(_("The file name is missing."))
+    if not replace and Attachment.objects.filter(booking=booking, document=document).exists():
+        raise AlreadyUploaded()
+
+    upload = Upload.objects.create(
+        token=secrets.token_urlsafe(32), booking=booking, document=document,
+        filename=filename, size=size, sha256=sha256.lower(), replace=replace,
+    )
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    open(partial_path(upload), "wb").close()
+    return upload
+
+
+def check_offset(upload, offset, length):
+    if offset != upload.offset:
+        raise OffsetMismatch(upload.offset)
+    if length > upload.size - offset:
+        raise UploadError(_("The chunk ends after the end of the file."))
+
+
+def receive(stream, length):
+    """Reads up to ``length`` bytes from ``stream`` into a temporary file, returns it and the bytes read."""
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    chunk = tempfile.TemporaryFile(dir=UPLOAD_DIR)
+    received = 0
+    while received < length:
+        data = stream.read(min(CHUNK_SIZE, length - received))
+        if not data:
+            break
+        chunk.write(data)
+        received += len(data)
+    chunk.seek(0)
+    return chunk, received
+
+
+def append(upload, offset, stream, length):
+    """Writes ``length`` bytes read from ``stream`` at ``offset``.
+
+    Returns the upload and, once it is complete, the attachment. If the stream
+    ends early, the bytes that arrived are kept and the upload can be resumed.
+    The upload is only locked once the chunk arrived, however slow the client,
+    and stays locked until the offset is committed and a complete file stored.
+    """
+    check_offset(upload, offset, length)
+    chunk, received = receive(stream, length)
+    with chunk, locked_partial(upload) as f:
+        with transaction.atomic():
+            upload = Upload.objects.select_for_update().filter(pk=upload.pk).first()
+            if upload is None:
+                raise Canceled()
+            # another request may have sent the chunk meanwhile
+            check_offset(upload, offset, length)
+
+            digest = hasher(upload)
+            # a chunk that was interrupted before may have left some bytes
+            f.seek(offset)
+            f.truncate()
+            for data in iter(lambda: chunk.read(CHUNK_SIZE), b""):
+                f.write(data)
+                digest.update(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+            upload.offset = offset + received
+            upload.save(update_fields=["offset", "updated"])
+
+        if upload.offset < upload.size:
+            remember(upload, digest)
+            return upload, None
+        return upload, complete(upload, digest.hexdigest())
+
+
+def complete(upload, sha256):
+    path = partial_path(upload)
+    if upload.sha256 and upload.sha256 != sha256:
+        discard(upload)
+        raise UploadError(_("The file doesn't match its checksum, please upload it again."))
+
+    name = blob_name(sha256)
+    if default_storage.exists(name):
+        os.remove(path)
+    else:
+        with open(path, "rb") as f:
+            name = default_storage.save(name, PartialFile(f, name=path))
+    try:
+        return attach(upload.booking, upload.document, upload.filename, sha256, name, upload.replace)
+    finally:
+        upload.delete()
+
+
+def discard(upload):
+    _hashers.pop(upload.token, None)
+    try:
+        os.remove(partial_path(upload))
+    except FileNotFoundError:
+        pass
+    upload.delete()
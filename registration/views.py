@@ -1,3 +1,316 @@
-from django.shortcuts import render
+import json
+import logging
+import time
+from concurrent.futures import TimeoutError
 
-# Create your views here.
+from django.contrib.admin.views.decorators import staff_member_required
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotModified, \
+    JsonResponse
+from django.middleware.csrf import get_token
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods, require_POST
+from graphene_django.views import GraphQLView, HttpError
+from graphql.utils.get_operation_ast import get_operation_ast
+
+from registration import documents, graphql_cache, instrumentation, payments, routing, uploads
+from registration.routing import primary_reads
+from registration.models import Booking, Document, Upload
+
+logger = logging.getLogger(__name__)
+
+
+def bookings_for(user):
+    qs = Booking.objects.all()
+    if not user.is_superuser:
+        qs = qs.filter(event__admin=user)
+    return qs
+
+
+def timed_response(data, started, status=200):
+    latency = (time.perf_counter() - started) * 1000
+    data["latency_ms"] = round(latency, 3)
+    response = JsonResponse(data, status=status)
+    response["Server-Timing"] = "checkin;dur=%.3f" % latency
+    return response
+
+
+@require_POST
+@staff_member_required
+def checkin(request, code):
+    """Checks in the booking with the scanned ``code``.
+
+    The lookup goes through the unique index on the code and the check-in is
+    a single conditional UPDATE, so scanning the same code twice can't
+    overwrite the first check-in date. Canceled bookings aren't checked in.
+    """
+    started = time.perf_counter()
+    bookings = bookings_for(request.user).filter(code=code)
+    now = timezone.now()
+
+    checked_in = bookings.exclude(state="canceled").filter(checkin_date__isnull=True).update(checkin_date=now)
+
+    booking = bookings.values("code", "first_name", "last_name", "club", "state", "checkin_date").first()
+    if booking is None:
+        return timed_response({"code": code, "status": "unknown"}, started, status=404)
+
+    if checked_in:
+        status = "checked_in"
+    elif booking["state"] == "canceled":
+        status = "canceled"
+    else:
+        status = "already_checked_in"
+    booking["status"] = status
+    response = timed_response(booking, started)
+    logger.info("check-in %s: %s in %sms", code, status, booking["latency_ms"])
+    return response
+
+
+@require_POST
+@staff_member_required
+def checkin_club(request):
+    """Checks in all bookings of a club at an event with a single UPDATE, except canceled ones."""
+    started = time.perf_counter()
+    event, club = request.POST.get("event"), request.POST.get("club", "").strip()
+    # an empty club would check in everyone who didn't name one
+    if not event or not event.isdigit() or not club:
+        return timed_response({"error": "event and club are required"}, started, status=400)
+
+    count = bookings_for(request.user).filter(
+        event_id=event, club=club, checkin_date__isnull=True
+    ).exclude(state="canceled").update(checkin_date=timezone.now())
+
+    response = timed_response({"event": int(event), "club": club, "checked_in": count}, started)
+    logger.info("check-in of club %s at event %s: %d bookings", club, event, count)
+    return response
+
+
+@csrf_exempt
+@require_POST
+def payment_webhook(request):
+    """Receives a PayPal payment notification, see ``registration.payments``.
+
+    The response is sent once the transaction is written. Notifications that
+    can't be written in time get a 503, so the sender delivers them again.
+    """
+    if not payments.valid_signature(request):
+        return HttpResponseForbidden()
+    try:
+        if request.content_type == "application/json":
+            data = json.loads(request.body)
+            if not isinstance(data, dict):
+                raise ValueError("JSON object expected")
+        else:
+            data = request.POST
+        notification = payments.parse_notification(data)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    try:
+        status = payments.writer.submit(notification).result(timeout=payments.WRITE_TIMEOUT)
+    except TimeoutError:
+        return JsonResponse({"nr": notification.nr, "status": "retry"}, status=503)
+    return JsonResponse({"nr": notification.nr, "status": status})
+
+
+def upload_response(upload, attachment=None, status=200):
+    data = {"complete": attachment is not None}
+    if upload is not None:
+        data.update(token=upload.token, offset=upload.offset, size=upload.size)
+    if attachment is not None:
+        data.update(attachment=attachment.pk, sha256=attachment.sha256)
+    response = JsonResponse(data, status=status)
+    if upload is not None:
+        response["Upload-Offset"] = upload.offset
+    return response
+
+
+@csrf_exempt
+@require_POST
+def upload_start(request):
+    """Starts a chunked upload of an attachment, see ``registration.uploads``.
+
+    Expects the booking code and e-mail address, the document, the file name
+    and size, optionally the SHA-256 of the file and ``replace`` to replace a
+    document uploaded before, as JSON.
+    """
+    try:
+        data = json.loads(request.body)
+        code, email = str(data["booking"]).lower(), str(data["email"]).strip()
+        document_id, filename, size = int(data["document"]), str(data["filename"]), int(data["size"])
+        sha256, replace = str(data.get("sha256") or ""), data.get("replace") is True
+    except (ValueError, KeyError, TypeError):
+        return HttpResponseBadRequest("booking, email, document, filename and size are required")
+
+    booking = Booking.objects.filter(code=code, email__iexact=email).first()
+    if booking is None:
+        return HttpResponseForbidden("The booking code and e-mail address don't match")
+    try:
+        upload = uploads.start(booking, Document.objects.get(pk=document_id), filename, size, sha256, replace)
+    except Document.DoesNotExist:
+        return HttpResponseBadRequest("The document doesn't exist")
+    except uploads.UploadError as e:
+        return JsonResponse({"error": str(e)}, status=e.status)
+
+    response = upload_response(upload, status=201)
+    response["Location"] = reverse("upload", args=(upload.token,))
+    return response
+
+
+@csrf_exempt
+@primary_reads
+@require_http_methods(["GET", "HEAD", "PATCH", "DELETE"])
+def upload_chunk(request, token):
+    """The offset of an upload (GET/HEAD), its next chunk (PATCH) or its cancellation (DELETE).
+
+    A chunk is the raw request body, ``Upload-Offset`` is where it starts.
+    The body is read as a stream, so chunks may be as large as the file.
+    """
+    upload = get_object_or_404(Upload, token=token)
+    if request.method == "DELETE":
+        uploads.discard(upload)
+        return HttpResponse(status=204)
+    if request.method != "PATCH":
+        return upload_response(upload)
+
+    try:
+        offset = int(request.META["HTTP_UPLOAD_OFFSET"])
+        length = int(request.META.get("CONTENT_LENGTH") or "")
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest("Upload-Offset and Content-Length are required")
+    try:
+        upload, attachment = uploads.append(upload, offset, request, length)
+    except uploads.OffsetMismatch as e:
+        response = JsonResponse({"error": str(e), "offset": e.offset}, status=e.status)
+        response["Upload-Offset"] = e.offset
+        return response
+    except uploads.UploadError as e:
+        return JsonResponse({"error": str(e)}, status=e.status)
+    return upload_response(upload, attachment)
+
+
+class CachedGraphQLView(GraphQLView):
+    """GraphQLView that serves cacheable read-only queries from the response cache.
+
+    Cached responses carry an ETag, conditional GET requests are answered with
+    304 Not Modified, and the stored gzip body is sent to clients accepting it.
+    Parsed documents come from the shared LRU of ``registration.documents``, and
+    registered queries can be sent as a hash only. Executed operations are
+    profiled, see ``registration.instrumentation``.
+    """
+    persisted_only = getattr(settings, "GRAPHQL_PERSISTED_QUERIES_ONLY", False)
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("backend", documents.backend)
+        super(CachedGraphQLView, self).__init__(**kwargs)
+
+    def get_graphql_params(self, request, data):
+        query, variables, operation_name, id = super(CachedGraphQLView, self).get_graphql_params(request, data)
+
+        extensions = request.GET.get("extensions") or data.get("extensions")
+        if isinstance(extensions, str):
+            try:
+                extensions = json.loads(extensions)
+            except ValueError:
+                raise HttpError(HttpResponseBadRequest("Extensions are invalid JSON."))
+        persisted = (extensions or {}).get("persistedQuery") or {}
+        sha256 = persisted.get("sha256Hash") if isinstance(persisted, dict) else None
+
+        if sha256:
+            if query and documents.query_hash(query) != sha256:
+                raise HttpError(HttpResponseBadRequest("provided sha does not match query"))
+            query = documents.persisted_query(sha256)
+            if query is None:
+                raise HttpError(HttpResponseBadRequest("PersistedQueryNotFound"))
+        elif query and self.persisted_only and documents.persisted_query(documents.query_hash(query)) is None:
+            raise HttpError(HttpResponseBadRequest("Only persisted queries are allowed."))
+
+        return query, variables, operation_name, id
+
+    def execute_graphql_request(self, request, data, query, variables, operation_name, show_graphiql=False):
+        if not query:
+            return super(CachedGraphQLView, self).execute_graphql_request(
+                request, data, query, variables, operation_name, show_graphiql)
+
+        name = operation_name
+        try:
+            document = self.get_backend(request).document_from_string(self.schema, query)
+        except Exception:
+            pass
+        else:
+            name = name or instrumentation.operation_name(document.document_ast)
+            # queries may read from the replica even when they are POSTed, mutations never
+            operation = get_operation_ast(document.document_ast, operation_name)
+            if operation is not None and operation.operation == "query":
+                routing.use_replica()
+            else:
+                routing.use_primary()
+
+        with instrumentation.profile_operation(name):
+            return super(CachedGraphQLView, self).execute_graphql_request(
+                request, data, query, variables, operation_name, show_graphiql)
+
+    def dispatch(self, request, *args, **kwargs):
+        key = self.response_key(request)
+        if key is None:
+            return super(CachedGraphQLView, self).dispatch(request, *args, **kwargs)
+
+        entry = graphql_cache.get_entry(key)
+        if entry is None:
+            # shared by all clients, so not from a replica that may lag behind
+            with routing.primary():
+                response = super(CachedGraphQLView, self).dispatch(request, *args, **kwargs)
+            if response.status_code != 200 or "errors" in json.loads(response.content):
+                return response
+            entry = graphql_cache.make_entry(response.content)
+            graphql_cache.set_entry(key, entry)
+
+        return self.cached_response(request, entry)
+
+    def response_key(self, request):
+        if request.method not in ("GET", "POST") or self.batch:
+            return None
+        try:
+            data = self.parse_body(request)
+            if self.graphiql and self.can_display_graphiql(request, data):
+                return None
+            query, variables, operation_name, id = self.get_graphql_params(request, data)
+        except HttpError:
+            return None
+        if not query:
+            return None
+        return graphql_cache.response_key(query, variables, operation_name)
+
+    def cached_response(self, request, entry):
+        if request.method == "GET" and entry["etag"] in request.META.get("HTTP_IF_NONE_MATCH", ""):
+            response = HttpResponseNotModified()
+        elif "gzip" in request.META.get("HTTP_ACCEPT_ENCODING", ""):
+            response = HttpResponse(entry["gzip"], content_type="application/json")
+            response["Content-Encoding"] = "gzip"
+        else:
+            response = HttpResponse(entry["content"], content_type="application/json")
+
+        response["ETag"] = entry["etag"]
+        response["Cache-Control"] = "no-cache"
+        patch_vary_headers(response, ("Accept-Encoding",))
+
+        # the registration form posts its mutations with the CSRF token it gets from these queries
+        if settings.CSRF_COOKIE_NAME in request.COOKIES:
+            # the client has one, keep Set-Cookie and Vary: Cookie off the response that is the same for everyone
+            request.META["CSRF_COOKIE_USED"] = False
+        else:
+            get_token(request)
+            response["Cache-Control"] = "private, no-cache"
+        return response
+
+
+@staff_member_required
+def graphql_metrics(request):
+    """Resolver timings and SQL counts of the GraphQL operations run by this process."""
+    if request.method == "POST":
+        instrumentation.reset_metrics()
+    return JsonResponse(instrumentation.metrics())
@@ -0,0 +1,17 @@
+"""
+ASGI config for unicycle_events project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Views run in a bounded thread pool, see ``registration.handlers``.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
+"""
+
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'unicycle_events.settings')
+
+from registration.handlers import get_asgi_application
+
+application = get_asgi_application()
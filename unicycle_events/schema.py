@@ -1,6 +1,6 @@
 import graphene
 
-from registration.schema import Query
+from registration.schema import Mutation, Query
 
 
 class Query(Query, graphene.ObjectType):
@@ -8,4 +8,8 @@ class Query(Query, graphene.ObjectType):
     # as we begin to add more apps to our project
     pass
 
-schema = graphene.Schema(query=Query)
\ No newline at end of file
+
+class Mutation(Mutation, graphene.ObjectType):
+    pass
+
+schema = graphene.Schema(query=Query, mutation=Mutation)
\ No newline at end of file
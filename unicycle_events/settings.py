@@ -45,6 +45,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'registration.routing.ReplicaMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -84,6 +85,35 @@ DATABASES = {
     }
 }
 
+# Safe requests and GraphQL queries read from a replica if there is one, see
+# registration.routing. Locally, DATABASE_REPLICA=replica.sqlite3 with a copy
+# made by the copy_replica command.
+if os.environ.get('DATABASE_REPLICA'):
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, os.environ['DATABASE_REPLICA']),
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['registration.routing.ReplicaRouter']
+
+
+# Cache
+# https://docs.djangoproject.com/en/2.2/topics/cache/
+
+# The GraphQL response cache, the rate index and the event statistics are
+# invalidated through the cache, so every worker process has to use the same
+# one. Files are shared by all workers on a host, deployments with several
+# hosts set CACHE_BACKEND and CACHE_LOCATION to e.g. Memcached.
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', os.path.join(BASE_DIR, 'cache')),
+    }
+}
+
+TEST_RUNNER = 'unicycle_events.runner.TestRunner'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
@@ -123,6 +153,10 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+MEDIA_URL = '/media/'
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
 GRAPHENE = {
-    'SCHEMA': 'unicycle_events.schema.schema'
+    'SCHEMA': 'unicycle_events.schema.schema',
+    'MIDDLEWARE': ['registration.instrumentation.InstrumentationMiddleware'],
 }
@@ -15,10 +15,16 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path
-from graphene_django.views import GraphQLView
+from registration import views
 
 
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path("graphql", GraphQLView.as_view(graphiql=True)),
+    path("graphql", views.CachedGraphQLView.as_view(graphiql=True)),
+    path("graphql/metrics", views.graphql_metrics, name="graphql-metrics"),
+    path("payments/paypal", views.payment_webhook, name="payment-webhook"),
+    path("uploads", views.upload_start, name="upload-start"),
+    path("uploads/<str:token>", views.upload_chunk, name="upload"),
+    path("checkin/club", views.checkin_club, name="checkin-club"),
+    path("checkin/<str:code>", views.checkin, name="checkin"),
 ]